@@ -0,0 +1,164 @@
+"""Set-based analytics for the /analytics page.
+
+Every figure is produced by a grouped aggregate over the full dataset, so the
+number of queries is fixed (about nine) no matter how many products,
+customers or sales there are. Revenue and category figures read the daily
+rollups in ``rollups``. Costs and margins are the cost of goods sold stored
+on the sale lines (see ``costing``), against their net revenue.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, desc, func
+
+from app import db
+from costing import cost_of_sales
+from models import Customer, DailySalesSummary, Product, Sale, SaleItem
+from rollups import DOCUMENT_ROW, PURCHASES, SALES, category_totals, daily_totals, totals
+
+PERIOD_DAYS = 30
+CHART_DAYS = 7
+TOP_LIMIT = 5
+MARGIN_POINTS = 100
+STOCK_ALERTS_LIMIT = 20
+
+
+def _period_sum(column, condition):
+    return func.coalesce(func.sum(case((condition, column), else_=0)), 0)
+
+
+def sales_kpis(now, days=PERIOD_DAYS):
+    """Current/previous period revenue and order count in a single rollup scan"""
+    current_start = (now - timedelta(days=days)).date()
+    previous_start = (now - timedelta(days=days * 2)).date()
+    summary = DailySalesSummary
+    in_current = summary.day >= current_start
+
+    current, previous, orders = db.session.query(
+        _period_sum(summary.total_amount, in_current),
+        _period_sum(summary.total_amount, summary.day < current_start),
+        _period_sum(summary.document_count, in_current),
+    ).filter(
+        summary.category_id == DOCUMENT_ROW,
+        summary.day >= previous_start
+    ).one()
+
+    return {
+        'current_revenue': float(current),
+        'previous_revenue': float(previous),
+        'orders': int(orders),
+    }
+
+
+def top_products(start, limit=TOP_LIMIT):
+    """Best selling products by revenue since ``start``"""
+    rows = db.session.query(
+        Product.name, func.sum(SaleItem.total_price).label('revenue')
+    ).join(SaleItem, SaleItem.product_id == Product.id).join(
+        Sale, Sale.id == SaleItem.sale_id
+    ).filter(
+        Sale.sale_date >= start,
+        Sale.status != 'cancelado'
+    ).group_by(Product.id, Product.name).order_by(desc('revenue')).limit(limit).all()
+
+    return [(name, float(revenue)) for name, revenue in rows]
+
+
+def top_customers(start, limit=TOP_LIMIT):
+    """Customers with the highest sales total since ``start``"""
+    rows = db.session.query(
+        Customer.name,
+        func.count(Sale.id).label('sales_count'),
+        func.sum(Sale.total_amount).label('total_amount')
+    ).join(Sale, Sale.customer_id == Customer.id).filter(
+        Sale.sale_date >= start,
+        Sale.status != 'cancelado'
+    ).group_by(Customer.id, Customer.name).order_by(desc('total_amount')).limit(limit).all()
+
+    return [
+        {'name': name, 'sales_count': sales_count, 'total_amount': float(total_amount)}
+        for name, sales_count, total_amount in rows
+    ]
+
+
+def margin_analysis(start=None, end=None, limit=MARGIN_POINTS):
+    """(volume sold, margin % over cost) per product, for the best selling products of the period
+
+    Lines sold before costing existed have no ``cost_amount``; they are
+    costed at the product's purchase price.
+    """
+    volume = func.sum(SaleItem.quantity).label('volume')
+    cost = func.coalesce(SaleItem.cost_amount, SaleItem.quantity * Product.purchase_price)
+    query = db.session.query(
+        volume, func.sum(SaleItem.quantity * SaleItem.unit_price), func.sum(cost)
+    ).join(Sale, Sale.id == SaleItem.sale_id).join(
+        Product, Product.id == SaleItem.product_id
+    ).filter(Sale.status != 'cancelado')
+    if start:
+        query = query.filter(Sale.sale_date >= start)
+    if end:
+        query = query.filter(Sale.sale_date < end)
+    rows = query.group_by(SaleItem.product_id).order_by(desc('volume')).limit(limit).all()
+
+    points = []
+    for units, revenue, cost in rows:
+        margin = 0
+        if cost and cost > 0:
+            margin = (revenue - cost) / cost * 100
+        points.append({'x': int(units), 'y': float(margin)})
+    return points
+
+
+def compute_analytics(now=None):
+    """Build the ``analytics`` dict rendered by templates/analytics.html"""
+    now = now or datetime.now()
+    period_start = now - timedelta(days=PERIOD_DAYS)
+    chart_start = (now - timedelta(days=CHART_DAYS - 1)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+    kpis = sales_kpis(now)
+    current_revenue = kpis['current_revenue']
+    previous_revenue = kpis['previous_revenue']
+
+    net_revenue, cost = cost_of_sales(start=period_start)
+    net_revenue, total_costs = float(net_revenue), float(cost)
+    sold_units = totals(SALES, start=period_start.date())['quantity']
+    total_products = Product.query.count()
+
+    daily_sales = daily_totals(SALES, chart_start.date())
+    daily_purchases = daily_totals(PURCHASES, chart_start.date())
+    chart_days = [chart_start + timedelta(days=i) for i in range(CHART_DAYS)]
+
+    categories = category_totals(SALES, start=period_start.date())
+    products = top_products(period_start)
+
+    stock_alerts = Product.query.filter(
+        Product.stock_quantity <= Product.min_stock,
+        Product.is_active == True  # noqa: E712
+    ).order_by(Product.stock_quantity).limit(STOCK_ALERTS_LIMIT).all()
+
+    revenue_growth = ((current_revenue - previous_revenue) / previous_revenue * 100) if previous_revenue > 0 else 0
+    avg_order_value = (current_revenue / kpis['orders']) if kpis['orders'] else 0
+    gross_profit = net_revenue - total_costs
+    profit_margin = (gross_profit / net_revenue * 100) if net_revenue > 0 else 0
+    inventory_turnover = (float(sold_units) / total_products * 12) if total_products else 0
+    roi = (gross_profit / total_costs * 100) if total_costs > 0 else 0
+
+    return {
+        'revenue_growth': round(revenue_growth, 1),
+        'profit_margin': round(profit_margin, 1),
+        'avg_order_value': avg_order_value,
+        'inventory_turnover': round(inventory_turnover, 1),
+        'revenue_labels': [day.strftime('%d/%m') for day in chart_days],
+        'revenue_data': [daily_sales.get(day.strftime('%Y-%m-%d'), 0.0) for day in chart_days],
+        'purchase_data': [daily_purchases.get(day.strftime('%Y-%m-%d'), 0.0) for day in chart_days],
+        'category_labels': [name for name, _ in categories],
+        'category_data': [revenue for _, revenue in categories],
+        'top_products_labels': [name for name, _ in products],
+        'top_products_data': [revenue for _, revenue in products],
+        'margin_analysis': margin_analysis(period_start),
+        'top_customers': top_customers(period_start),
+        'stock_alerts': stock_alerts,
+        'total_revenue': net_revenue,
+        'total_costs': total_costs,
+        'gross_profit': gross_profit,
+        'roi': round(roi, 1)
+    }
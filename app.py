@@ -7,7 +7,7 @@ from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "DEBUG").upper())
 
 class Base(DeclarativeBase):
     pass
@@ -27,6 +27,21 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
 }
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# request instrumentation (see instrumentation.py)
+app.config["SLOW_QUERY_MS"] = float(os.environ.get("SLOW_QUERY_MS", 500))
+app.config["SERVER_TIMING_HEADER"] = os.environ.get("SERVER_TIMING_HEADER", "1") != "0"
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+
+# per-till document series, "CX1=10.0.0.21,CX2=10.0.0.22" (see numbering.py)
+app.config["TERMINALS"] = os.environ.get("TERMINALS", "")
+
+# application cache (see cache.py)
+app.config["CACHE_ENABLED"] = os.environ.get("CACHE_ENABLED", "1") != "0"
+app.config["CACHE_MAX_ENTRIES"] = int(os.environ.get("CACHE_MAX_ENTRIES", 1024))
+app.config["CACHE_DEFAULT_TTL"] = int(os.environ.get("CACHE_DEFAULT_TTL", 300))
+app.config["CACHE_REDIS_URL"] = os.environ.get("CACHE_REDIS_URL")
+app.config["CACHE_DIR"] = os.environ.get("CACHE_DIR", os.path.join(app.instance_path, "cache"))
+
 # initialize the app with the extension
 db.init_app(app)
 
@@ -43,4 +58,15 @@ def init_database():
 
 # Import routes
 import simple_routes  # noqa: F401
+import query_budget  # noqa: F401  # registers the check-query-budgets command
+import rollups  # noqa: F401  # registers the rebuild-rollups command
+import numbering  # noqa: F401  # registers the reserve-numbers and check-numbering commands
+import indexes  # noqa: F401  # registers the upgrade-schema, create-indexes and check-indexes commands
+import jobs  # noqa: F401  # registers the run-jobs command and job handlers
+import ledger  # noqa: F401  # registers the stock-snapshot, rebuild-stock-ledger and reconcile-stock commands
+import costing  # noqa: F401  # registers the rebuild-costs command
+import replenishment  # noqa: F401  # registers the replenishment command
+import classification  # noqa: F401  # registers the classify-products command
+import instrumentation  # noqa: F401  # Server-Timing header, request log and slow-query EXPLAIN
+import metrics  # noqa: F401  # Prometheus /metrics endpoint
 # import routes  # noqa: F401  # Temporarily disabled due to conflicts
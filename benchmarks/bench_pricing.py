@@ -0,0 +1,114 @@
+"""Posting throughput of the pricing engine for 1-500 line documents.
+
+    python benchmarks/bench_pricing.py            # pricing only
+    python benchmarks/bench_pricing.py --post     # full sale posting
+
+``--post`` runs the same steps as ``add_sale`` (pricing, sale and items,
+row-locked stock update, rollup upkeep, flush) against ``DATABASE_URL`` and
+rolls every document back, so it leaves the database unchanged. It needs
+active products with stock.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pricing import Line, price_document  # noqa: E402
+
+SIZES = (1, 10, 50, 100, 250, 500)
+RATES = ('23', '13', '6', '0')
+
+
+def _lines(size, product_ids=(1,)):
+    return [
+        (product_ids[i % len(product_ids)], 1 + i % 3, f'{1 + (i * 37) % 500}.{i % 100:02d}', RATES[i % len(RATES)])
+        for i in range(size)
+    ]
+
+
+def _measure(run, seconds):
+    count = 0
+    start = time.perf_counter()
+    while True:
+        run()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return count, elapsed
+
+
+def bench_pricing(sizes, seconds):
+    results = []
+    for size in sizes:
+        raw = _lines(size)
+        count, elapsed = _measure(lambda: price_document(Line(*line) for line in raw), seconds)
+        results.append({'lines': size, 'documents_per_s': round(count / elapsed, 1),
+                        'lines_per_s': round(count * size / elapsed)})
+    return results
+
+
+def bench_posting(sizes, seconds):
+    from app import app, db
+    from models import Customer, Product, Sale, SaleItem, User
+    from rollups import record_sale
+    from stock import post_sale
+
+    results = []
+    with app.app_context():
+        user = User.query.first()
+        customer = Customer.query.first()
+        if user is None or customer is None:
+            raise SystemExit('Sem utilizadores ou clientes na base de dados.')
+
+        for size in sizes:
+            product_ids = [row.id for row in db.session.query(Product.id).filter(
+                Product.is_active == True, Product.stock_quantity >= size * 3  # noqa: E712
+            ).limit(size)]
+            if not product_ids:
+                results.append({'lines': size, 'skipped': 'sem produtos com stock suficiente'})
+                continue
+            raw = _lines(size, product_ids)
+
+            def post():
+                document = price_document(Line(*line) for line in raw)
+                sale = Sale(invoice_number='BENCH', customer_id=customer.id, user_id=user.id,
+                            sale_date=datetime.now(), subtotal=document.subtotal,
+                            tax_amount=document.tax_amount, total_amount=document.total_amount,
+                            status='concluida', payment_method='dinheiro')
+                db.session.add(sale)
+                db.session.flush()
+                items = [SaleItem(sale_id=sale.id, product_id=line.product_id, quantity=line.quantity,
+                                  unit_price=line.unit_price, tax_rate=line.tax_rate, total_price=line.total)
+                         for line in document.lines]
+                post_sale(sale, items, user.id)
+                record_sale(sale, items)
+                db.session.flush()
+                db.session.rollback()
+
+            count, elapsed = _measure(post, seconds)
+            results.append({'lines': size, 'documents_per_s': round(count / elapsed, 1),
+                            'lines_per_s': round(count * size / elapsed),
+                            'ms_per_document': round(elapsed / count * 1000, 2)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--post', action='store_true', help='benchmark full sale posting against the database')
+    parser.add_argument('--seconds', type=float, default=1.0, help='time spent per document size')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in SIZES))
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    report = {'pricing': bench_pricing(sizes, args.seconds)}
+    if args.post:
+        report['posting'] = bench_posting(sizes, args.seconds)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
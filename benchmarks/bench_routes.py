@@ -0,0 +1,203 @@
+"""Route benchmark: latency, query count and peak RSS per page.
+
+    python benchmarks/bench_routes.py --repeat 20 --output before.json
+    python benchmarks/bench_routes.py --repeat 20 --compare before.json
+
+Drives the app through the Flask test client, logged in as the first admin
+user, against ``DATABASE_URL`` (fill it with generate_data.py first). Each
+route runs in its own forked process, so the recorded ``peak_rss_mb`` is that
+route's high-water mark. The report is JSON; ``--compare`` prints the p95
+and query-count change against an earlier report.
+
+``add_sale`` really posts sales (one per repetition). ``saft_export`` runs
+the SAF-T generator for the last 30 days in-process, as the job worker does,
+since ``/generate-saft`` itself only queues the job.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.engine import Engine  # noqa: E402
+
+from app import app, db  # noqa: E402
+
+QUERIES = [0]
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count(conn, cursor, statement, parameters, context, executemany):
+    QUERIES[0] += 1
+
+
+def _client():
+    from models import User
+    client = app.test_client()
+    with app.app_context():
+        user = User.query.filter_by(role='admin').order_by(User.id).first() or User.query.first()
+        if user is None:
+            raise SystemExit('Sem utilizadores: carregue dados com generate_data.py')
+        with client.session_transaction() as session:
+            session.update(user_id=user.id, username=user.username, user_role=user.role,
+                           full_name=user.full_name)
+    return client
+
+
+def _sale_form():
+    from models import Customer, Product
+    with app.app_context():
+        customer = Customer.query.order_by(Customer.id).first()
+        products = Product.query.filter(Product.is_active == True, Product.stock_quantity >= 50).order_by(  # noqa: E712
+            Product.id).limit(5).all()
+    form = {'customer_id': customer.id, 'payment_method': 'dinheiro'}
+    for i, product in enumerate(products):
+        form.update({f'products[{i}][id]': product.id, f'products[{i}][price]': str(product.sale_price),
+                     f'products[{i}][quantity]': 1, f'products[{i}][tax_rate]': str(product.tax_rate)})
+    return form
+
+
+def _saft_export():
+    from saft import generate_saft_xml
+    end = datetime.now()
+    with app.app_context():
+        size = sum(len(chunk) for chunk in generate_saft_xml(end - timedelta(days=30), end))
+    return 200 if size else 500
+
+
+ROUTES = {
+    'dashboard': ('GET', '/dashboard'),
+    'reports': ('GET', '/reports?period=30'),
+    'analytics': ('GET', '/analytics'),
+    'products': ('GET', '/products'),
+    'products_search': ('GET', '/products?search=caneta'),
+    'product_lookup': ('GET', '/api/products/search?q=caneta&in_stock=1'),
+    'product_lookup_code': ('GET', '/api/products/search?q=P0001234'),
+    'customers': ('GET', '/customers'),
+    'suppliers': ('GET', '/suppliers'),
+    'sales': ('GET', '/sales'),
+    'sales_page_2': ('GET', None),
+    'purchases': ('GET', '/purchases'),
+    'inventory': ('GET', '/inventory'),
+    'add_sale': ('POST', '/sales/add'),
+    'generate_saft': ('POST', '/generate-saft'),
+    'saft_export': ('CALL', _saft_export),
+}
+
+
+def _request(client, name, method, target):
+    if method == 'CALL':
+        return target()
+    if name == 'sales_page_2':
+        from listing import SALES
+        with app.test_request_context('/sales'):
+            first = SALES.page({})
+        target = '/sales?' + '&'.join(f'{k}={v}' for k, v in first.next_args.items())
+    if name == 'add_sale':
+        return client.post(target, data=_sale_form()).status_code
+    if name == 'generate_saft':
+        end = datetime.now().date()
+        return client.post(target, data={'start_date': (end - timedelta(days=30)).isoformat(),
+                                         'end_date': end.isoformat()}).status_code
+    return client.get(target).status_code
+
+
+def _bench_route(name, repeat, warmup, results):
+    with app.app_context():
+        db.engine.dispose(close=False)  # fresh connections in the forked process
+    client = _client()
+    method, target = ROUTES[name]
+
+    for _ in range(warmup):
+        _request(client, name, method, target)
+
+    timings, queries, statuses = [], [], set()
+    for _ in range(repeat):
+        QUERIES[0] = 0
+        start = time.perf_counter()
+        statuses.add(_request(client, name, method, target))
+        timings.append((time.perf_counter() - start) * 1000)
+        queries.append(QUERIES[0])
+
+    timings.sort()
+    results.put((name, {
+        'p50_ms': round(statistics.median(timings), 2),
+        'p95_ms': round(timings[min(len(timings) - 1, int(round(0.95 * (len(timings) - 1))))], 2),
+        'mean_ms': round(statistics.fmean(timings), 2),
+        'queries': max(queries),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'status': sorted(statuses),
+    }))
+
+
+def _meta():
+    from sqlalchemy import func, select
+    from models import InventoryMovement, Product, Sale, SaleItem
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    with app.app_context():
+        rows = {model.__tablename__: db.session.execute(select(func.count()).select_from(model)).scalar()
+                for model in (Product, Sale, SaleItem, InventoryMovement)}
+        dialect = db.engine.dialect.name
+    return {'date': datetime.now().isoformat(timespec='seconds'), 'commit': commit,
+            'database': dialect, 'rows': rows}
+
+
+def compare(report, baseline):
+    print(f"{'route':<18}{'p95 antes':>12}{'p95 agora':>12}{'variação':>10}{'queries':>14}")
+    for name, now in report['routes'].items():
+        before = baseline.get('routes', {}).get(name)
+        if not before or 'p95_ms' not in before or 'p95_ms' not in now:
+            continue
+        change = (now['p95_ms'] / before['p95_ms'] - 1) * 100 if before['p95_ms'] else 0
+        print(f"{name:<18}{before['p95_ms']:>12.1f}{now['p95_ms']:>12.1f}{change:>+9.0f}%"
+              f"{before['queries']:>7} -> {now['queries']:<4}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--routes', default=','.join(ROUTES), help='comma-separated route names')
+    parser.add_argument('--output', help='write the JSON report here (default: stdout)')
+    parser.add_argument('--compare', help='earlier JSON report to compare against')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    report = {'meta': _meta(), 'routes': {}}
+    for name in args.routes.split(','):
+        process = context.Process(target=_bench_route, args=(name, args.repeat, args.warmup, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            report['routes'][name] = {'error': f'exit code {process.exitcode}'}
+            continue
+        route, result = results.get()
+        report['routes'][route] = result
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
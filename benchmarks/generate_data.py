@@ -0,0 +1,276 @@
+"""Deterministic synthetic data for benchmarks.
+
+    python benchmarks/generate_data.py --products 50000 --customers 200000 \\
+        --sale-lines 5000000 --movements 10000000 --reset
+
+Loads categories, suppliers, products, customers, sales with their lines,
+purchases and inventory movements into ``DATABASE_URL``. It uses
+``COPY ... FROM STDIN`` on PostgreSQL and batched INSERTs elsewhere. The same
+``--seed`` and ``--until`` always give the same rows. Amounts come from the
+pricing engine and numbers follow the document series. Cancelled sales put
+their stock back, and each product gets an opening stock movement, so its
+``stock_quantity`` is the sum of its movements and ``flask reconcile-stock``
+finds no drift. At the end the series counters are set, and the movement
+balances and stock snapshots (ledger.py), the average costs and COGS
+(costing.py) and the daily rollups are rebuilt from the generated rows.
+
+The target tables must be empty; ``--reset`` drops and recreates the schema.
+"""
+import argparse
+import csv
+import io
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func, select
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db  # noqa: E402
+from models import (Category, Customer, DocumentSeries, InventoryMovement, Product,  # noqa: E402
+                    Purchase, PurchaseItem, Sale, SaleItem, Supplier, User)
+from numbering import DEFAULT_SERIES, PURCHASE, SALE, format_number  # noqa: E402
+from pricing import line_amounts  # noqa: E402
+
+BATCH = 50000
+TAX_RATES = (23, 23, 23, 13, 6)
+PAYMENT_METHODS = ('dinheiro', 'cartao', 'multibanco', 'transferencia')
+SALE_STATUSES = ('concluida', 'concluida', 'pago', 'pendente', 'cancelado')
+CITIES = ('Lisboa', 'Porto', 'Braga', 'Coimbra', 'Faro', 'Aveiro', 'Setúbal', 'Viseu')
+MOVEMENT_COLUMNS = ('id', 'product_id', 'movement_type', 'quantity', 'reference_type', 'reference_id',
+                    'notes', 'created_at', 'user_id')
+WORDS = ('Caneta', 'Caderno', 'Cabo', 'Lâmpada', 'Café', 'Arroz', 'Toalha', 'Copo', 'Mochila', 'Pilha',
+         'Tesoura', 'Agenda', 'Sabonete', 'Garrafa', 'Teclado', 'Rato', 'Prato', 'Vela', 'Fita', 'Cola')
+
+
+class Loader:
+    """Bulk writer: COPY on PostgreSQL, executemany INSERT elsewhere"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.copy = connection.dialect.name == 'postgresql'
+        self.counts = {}
+
+    def load(self, model, columns, rows):
+        table = model.__table__
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= BATCH:
+                self._write(table, columns, batch)
+                batch = []
+        if batch:
+            self._write(table, columns, batch)
+
+    def _write(self, table, columns, batch):
+        self.counts[table.name] = self.counts.get(table.name, 0) + len(batch)
+        if self.copy:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in batch:
+                writer.writerow('' if value is None else value for value in row)
+            buffer.seek(0)
+            cursor = self.connection.connection.cursor()
+            cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+            cursor.close()
+        else:
+            self.connection.execute(table.insert(), [dict(zip(columns, row)) for row in batch])
+
+
+def _nif(rng):
+    return str(rng.randrange(100000000, 299999999))
+
+
+def generate(args):
+    rng = random.Random(args.seed)
+    until = datetime.combine(args.until, datetime.min.time()) + timedelta(hours=20)
+    start = until - timedelta(days=args.days)
+    now = datetime(args.until.year, args.until.month, args.until.day)
+
+    def moment():
+        return start + timedelta(seconds=rng.randrange(args.days * 86400))
+
+    with db.engine.begin() as connection:
+        loader = Loader(connection)
+        from werkzeug.security import generate_password_hash
+        loader.load(User, ('id', 'username', 'email', 'password_hash', 'full_name', 'role', 'is_active',
+                           'created_at', 'updated_at'),
+                    [(1, 'admin', 'admin@gestvendas.com', generate_password_hash('admin123'), 'Administrador',
+                      'admin', True, now, now)])
+
+        loader.load(Category, ('id', 'name', 'description', 'is_active', 'created_at', 'updated_at'),
+                    ((i, f'Categoria {i}', None, True, now, now) for i in range(1, args.categories + 1)))
+
+        loader.load(Supplier, ('id', 'name', 'email', 'city', 'country', 'tax_number', 'is_active',
+                               'created_at', 'updated_at'),
+                    ((i, f'Fornecedor {i}', f'fornecedor{i}@example.com', rng.choice(CITIES), 'Portugal',
+                      _nif(rng), True, now, now) for i in range(1, args.suppliers + 1)))
+
+        products, stock = [], [0] * (args.products + 1)
+        for i in range(1, args.products + 1):
+            purchase_price = rng.randrange(50, 20000) / 100
+            sale_price = round(purchase_price * rng.uniform(1.1, 1.8), 2)
+            products.append((i, sale_price, rng.choice(TAX_RATES), purchase_price))
+            stock[i] = rng.randrange(0, 500)
+        loader.load(Product, ('id', 'code', 'name', 'category_id', 'supplier_id', 'unit', 'purchase_price',
+                              'sale_price', 'stock_quantity', 'min_stock', 'max_stock', 'tax_rate',
+                              'is_active', 'created_at', 'updated_at'),
+                    ((i, f'P{i:07d}', f'{rng.choice(WORDS)} {rng.choice(WORDS).lower()} {i}',
+                      rng.randrange(1, args.categories + 1), rng.randrange(1, args.suppliers + 1), 'unidade',
+                      purchase_price, sale_price, stock[i], 10, 400, rate, rng.random() > 0.02,
+                      now, now) for i, sale_price, rate, purchase_price in products))
+
+        loader.load(Customer, ('id', 'name', 'email', 'city', 'postal_code', 'country', 'tax_number',
+                               'customer_type', 'is_active', 'created_at', 'updated_at'),
+                    ((i, f'Cliente {i}', f'cliente{i}@example.com', rng.choice(CITIES),
+                      f'{rng.randrange(1000, 9999)}-{rng.randrange(100, 999)}', 'Portugal',
+                      _nif(rng) if rng.random() > 0.3 else None,
+                      'empresa' if rng.random() < 0.2 else 'particular', True, now, now)
+                     for i in range(1, args.customers + 1)))
+
+        movement_id = [0]
+        counters = {}
+        moved = [0] * (args.products + 1)  # net movement per product, for the opening stock
+
+        def movement(product_id, movement_type, quantity, reference, reference_id, notes, when):
+            movement_id[0] += 1
+            moved[product_id] += quantity
+            return (movement_id[0], product_id, movement_type, quantity, reference, reference_id, notes, when, 1)
+
+        def documents(kind, count, lines_total, party_count):
+            """Sales or purchases with their lines and stock movements"""
+            model, item_model = (Sale, SaleItem) if kind == SALE else (Purchase, PurchaseItem)
+            party = 'customer_id' if kind == SALE else 'supplier_id'
+            date_column = 'sale_date' if kind == SALE else 'purchase_date'
+            item_fk = 'sale_id' if kind == SALE else 'purchase_id'
+            sign, movement_type, reference = (-1, 'saida', 'venda') if kind == SALE else (1, 'entrada', 'compra')
+
+            # Documents are numbered in date order within each year
+            dates = sorted(moment() for _ in range(count))
+            line_counts = [1] * count
+            for _ in range(max(lines_total - count, 0)):
+                line_counts[rng.randrange(count)] += 1
+
+            item_id = 0
+            for first in range(0, count, BATCH):
+                headers, items, movements = [], [], []
+                for doc_id in range(first + 1, min(first + BATCH, count) + 1):
+                    when = dates[doc_id - 1]
+                    number = counters[(kind, when.year)] = counters.get((kind, when.year), 0) + 1
+                    status = rng.choice(SALE_STATUSES) if kind == SALE else 'concluida'
+                    subtotal = tax = 0
+                    for _ in range(line_counts[doc_id - 1]):
+                        product_id, sale_price, rate, purchase_price = products[rng.randrange(len(products))]
+                        unit_price = sale_price if kind == SALE else purchase_price
+                        quantity = rng.randrange(1, 6) if kind == SALE else rng.randrange(5, 50)
+                        net, line_tax = line_amounts(quantity, unit_price, rate)
+                        subtotal += net
+                        tax += line_tax
+                        item_id += 1
+                        items.append((item_id, doc_id, product_id, quantity, unit_price, rate, net + line_tax))
+                        movements.append(movement(product_id, movement_type, sign * quantity, reference, doc_id,
+                                                  f'{reference.capitalize()} {doc_id}', when))
+                        if status == 'cancelado':  # the cancellation returned the stock
+                            movements.append(movement(product_id, 'entrada', quantity, reference, doc_id,
+                                                      f'Anulação da venda {doc_id}', when))
+                    headers.append((doc_id, format_number(kind, DEFAULT_SERIES, when.year, number),
+                                      rng.randrange(1, party_count + 1), 1, when, subtotal, tax, subtotal + tax,
+                                      status, rng.choice(PAYMENT_METHODS), when, when))
+
+                loader.load(model, ('id', 'invoice_number', party, 'user_id', date_column, 'subtotal',
+                                    'tax_amount', 'total_amount', 'status', 'payment_method', 'created_at',
+                                    'updated_at'), headers)
+                loader.load(item_model, ('id', item_fk, 'product_id', 'quantity', 'unit_price', 'tax_rate',
+                                         'total_price'), items)
+                loader.load(InventoryMovement, MOVEMENT_COLUMNS, movements)
+
+        sales = max(args.sale_lines // args.lines_per_sale, 1) if args.sale_lines else 0
+        if sales:
+            documents(SALE, sales, args.sale_lines, args.customers)
+        if args.purchases:
+            documents(PURCHASE, args.purchases, args.purchases * 4, args.suppliers)
+
+        # Manual adjustments up to the requested number of movements
+        def adjustments():
+            while movement_id[0] < args.movements - args.products:
+                yield movement(rng.randrange(1, args.products + 1), 'ajuste', rng.randrange(-5, 10),
+                               'ajuste', None, 'Ajuste de inventário', moment())
+        loader.load(InventoryMovement, MOVEMENT_COLUMNS, adjustments())
+
+        # Opening stock, before any other movement, that ends at the product's stock_quantity
+        opening = start - timedelta(days=1)
+        loader.load(InventoryMovement, MOVEMENT_COLUMNS, (
+            movement(i, 'ajuste', stock[i] - moved[i], 'inicial', None, 'Stock inicial', opening)
+            for i in range(1, args.products + 1)))
+
+        # Movement ids in time order, as stock.py writes them (the last id is the current balance)
+        table = InventoryMovement.__table__
+        connection.execute(table.update().values(id=-table.c.id))
+        ranked = select(table.c.id, func.row_number().over(
+            order_by=(table.c.created_at, table.c.id.desc())).label('position')).subquery()
+        connection.execute(table.update().where(table.c.id == ranked.c.id).values(id=ranked.c.position))
+
+        connection.execute(DocumentSeries.__table__.delete())
+        if counters:
+            connection.execute(DocumentSeries.__table__.insert(), [
+                dict(doc_type=kind, series=DEFAULT_SERIES, year=year, next_number=last + 1,
+                     created_at=now, updated_at=now)
+                for (kind, year), last in sorted(counters.items())
+            ])
+
+        if loader.copy:
+            for table in db.metadata.sorted_tables:
+                if 'id' in table.c and table.c.id.autoincrement is not False and table.name in loader.counts:
+                    connection.exec_driver_sql(
+                        f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                        f"(SELECT COALESCE(MAX(id), 1) FROM {table.name}))"
+                    )
+
+    return loader.counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--until', type=date.fromisoformat, default=date.today() - timedelta(days=1),
+                        help='last day with documents (YYYY-MM-DD); yesterday by default, so none is in the future')
+    parser.add_argument('--days', type=int, default=730, help='days of history before --until')
+    parser.add_argument('--categories', type=int, default=50)
+    parser.add_argument('--suppliers', type=int, default=500)
+    parser.add_argument('--products', type=int, default=50000)
+    parser.add_argument('--customers', type=int, default=200000)
+    parser.add_argument('--sale-lines', type=int, default=5000000)
+    parser.add_argument('--lines-per-sale', type=int, default=5)
+    parser.add_argument('--purchases', type=int, default=20000)
+    parser.add_argument('--movements', type=int, default=10000000,
+                        help='total inventory movements (document lines, opening stock and adjustments)')
+    parser.add_argument('--reset', action='store_true', help='drop and recreate all tables first')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    with app.app_context():
+        if args.reset:
+            db.drop_all()
+        db.create_all()
+
+        counts = generate(args)
+        print('Dados carregados: ' + ', '.join(f'{table} {count}' for table, count in counts.items()))
+
+        from costing import rebuild_costs
+        from ledger import rebuild_ledger
+        from rollups import rebuild_all
+        rebuild_ledger()
+        rebuild_costs()
+        db.session.commit()
+        rebuild_all()
+        if db.engine.dialect.name == 'postgresql':
+            with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                connection.exec_driver_sql('ANALYZE')
+    print(f'Concluído em {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+"""Application cache for read-mostly query results.
+
+There are two levels:
+
+* ``LocalCache``: an in-process LRU with a TTL per entry. It is always
+  used.
+* An optional shared backend behind it. Redis is used when ``CACHE_REDIS_URL``
+  is set and the ``redis`` package is installed. Otherwise ``CACHE_DIR``
+  (``instance/cache`` by default, empty to disable) selects ``FileBackend``,
+  a stand-in that keeps entries as files in a directory shared by the
+  workers of one host.
+
+Every entry carries tags, one per table it was read from. Invalidation does
+not delete entries. It bumps the version of a tag, and since the versions
+are part of the cache key, the stale entries are never read again and age
+out. With a shared backend the versions live there, so a write in one
+gunicorn worker is seen by all of them. Without one, other workers keep
+their copy until its TTL runs out.
+
+Invalidation is automatic. A session hook collects the tables of the
+objects flushed in a transaction and bumps their tags when it commits, so
+``add_product``, ``add_sale``, the delete routes and the jobs need no
+explicit calls. Writes that bypass the ORM call ``cache.invalidate(table)``
+themselves.
+
+Hits and misses are counted per entry name. They show up in ``/metrics``
+and, for the answering worker, in ``cache.stats()`` (``/admin/cache``).
+
+Values must be picklable: cache rows (``select(Model.col, ...)``), not
+ORM instances, which would be detached from the session that loaded them.
+"""
+import hashlib
+import os
+import pickle
+import random
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from itertools import chain
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app import app
+from metrics import cache_lookup
+
+try:
+    import redis
+except ImportError:  # optional: only needed with CACHE_REDIS_URL
+    redis = None
+
+DEFAULT_TTL = 300
+MAX_ENTRIES = 1024
+MISSING = object()
+
+
+class LocalCache:
+    """Thread-safe LRU of ``key -> value`` with a TTL per entry"""
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FileBackend:
+    """Shared stand-in for Redis: pickled entries in a directory
+
+    A tag's version is the size of its version file, and bumping it appends
+    one byte, so concurrent bumps from several processes are never lost.
+    """
+
+    SWEEP_EVERY = 200
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, 'tags'), exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return MISSING
+        return value if expires >= time.time() else MISSING
+
+    def set(self, key, value, ttl):
+        path = self._path(key)
+        temporary = f'{path}.{os.getpid()}.{threading.get_ident()}'
+        with open(temporary, 'wb') as f:
+            pickle.dump((time.time() + ttl, value), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+        if random.randrange(self.SWEEP_EVERY) == 0:
+            self._sweep()
+
+    def _sweep(self):
+        """Remove expired entries (stale versions are never read again)"""
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and '.' not in entry.name:
+                try:
+                    with open(entry.path, 'rb') as f:
+                        expires, _ = pickle.load(f)
+                    if expires < now:
+                        os.remove(entry.path)
+                except (OSError, EOFError, pickle.UnpicklingError):
+                    pass
+
+    def versions(self, tags):
+        sizes = []
+        for tag in tags:
+            try:
+                sizes.append(os.stat(os.path.join(self.directory, 'tags', tag)).st_size)
+            except FileNotFoundError:
+                sizes.append(0)
+        return sizes
+
+    def bump(self, tag):
+        with open(os.path.join(self.directory, 'tags', tag), 'ab') as f:
+            f.write(b'.')
+
+
+class RedisBackend:
+    """Shared backend on Redis (``CACHE_REDIS_URL``)"""
+
+    PREFIX = 'gestvendas:'
+
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        data = self.client.get(self.PREFIX + key)
+        return MISSING if data is None else pickle.loads(data)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.PREFIX + key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ex=max(int(ttl), 1))
+
+    def versions(self, tags):
+        return [int(value or 0) for value in self.client.mget([f'{self.PREFIX}tag:{tag}' for tag in tags])]
+
+    def bump(self, tag):
+        self.client.incr(f'{self.PREFIX}tag:{tag}')
+
+
+class Cache:
+    """Two-level cache with tag versions (see the module docstring)"""
+
+    def __init__(self, local, shared=None, default_ttl=DEFAULT_TTL, enabled=True):
+        self.local = local
+        self.shared = shared
+        self.default_ttl = default_ttl
+        self.enabled = enabled
+        self.tags = set()
+        self.counts = {}
+        self._versions = {}  # tag versions of this process when there is no shared backend
+
+    def versions(self, tags):
+        if self.shared is not None:
+            return self.shared.versions(tags)
+        return [self._versions.get(tag, 0) for tag in tags]
+
+    def get_or_set(self, name, key, tags, compute, ttl=None):
+        """Cached ``compute()``, stored under ``name``/``key`` and tagged with ``tags``"""
+        if not self.enabled:
+            return compute()
+
+        versions = '.'.join(map(str, self.versions(tags)))
+        full_key = f'{name}:{versions}:{key}'
+
+        value = self.local.get(full_key)
+        if value is MISSING and self.shared is not None:
+            value = self.shared.get(full_key)
+            if value is not MISSING:
+                self.local.set(full_key, value, ttl or self.default_ttl)
+        self._count(name, value is not MISSING)
+
+        if value is MISSING:
+            value = compute()
+            self.local.set(full_key, value, ttl or self.default_ttl)
+            if self.shared is not None:
+                self.shared.set(full_key, value, ttl or self.default_ttl)
+        return value
+
+    def cached(self, name, tags, ttl=None):
+        """Decorate a function so its result is cached per positional/keyword arguments"""
+        self.tags.update(tags)
+
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                key = repr((args, sorted(kwargs.items())))
+                return self.get_or_set(name, key, tags, lambda: function(*args, **kwargs), ttl)
+            return wrapper
+        return decorator
+
+    def invalidate(self, *tags):
+        """Make every entry tagged with one of ``tags`` stale"""
+        for tag in set(tags) & self.tags:
+            if self.shared is not None:
+                self.shared.bump(tag)
+            else:
+                self._versions[tag] = self._versions.get(tag, 0) + 1
+
+    def _count(self, name, hit):
+        hits, misses = self.counts.get(name, (0, 0))
+        self.counts[name] = (hits + 1, misses) if hit else (hits, misses + 1)
+        cache_lookup(name, hit)
+
+    def stats(self):
+        """Hits, misses and hit ratio per entry name for this process"""
+        return {
+            'backend': type(self.shared).__name__ if self.shared is not None else None,
+            'entries': len(self.local),
+            'max_entries': self.local.max_entries,
+            'evictions': self.local.evictions,
+            'names': {
+                name: {'hits': hits, 'misses': misses, 'hit_ratio': round(hits / (hits + misses), 3)}
+                for name, (hits, misses) in sorted(self.counts.items())
+            },
+        }
+
+
+def _shared_backend(config):
+    if config.get('CACHE_REDIS_URL'):
+        if redis is None:
+            app.logger.warning('CACHE_REDIS_URL is set but the redis package is not installed')
+        else:
+            return RedisBackend(config['CACHE_REDIS_URL'])
+    if config.get('CACHE_DIR'):
+        return FileBackend(config['CACHE_DIR'])
+    return None
+
+
+cache = Cache(LocalCache(app.config.get('CACHE_MAX_ENTRIES', MAX_ENTRIES)),
+              shared=_shared_backend(app.config),
+              default_ttl=app.config.get('CACHE_DEFAULT_TTL', DEFAULT_TTL),
+              enabled=app.config.get('CACHE_ENABLED', True))
+
+
+# =============== INVALIDATION ===============
+
+@event.listens_for(Session, 'after_flush')
+def _collect_tags(session, flush_context):
+    tables = {obj.__table__.name for obj in chain(session.new, session.dirty, session.deleted)
+              if hasattr(obj, '__table__')}
+    session.info.setdefault('cache_tags', set()).update(tables)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed(session):
+    tags = session.info.pop('cache_tags', None)
+    if tags:
+        cache.invalidate(*tags)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_rolled_back(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop('cache_tags', None)
@@ -0,0 +1,101 @@
+"""Compact, versioned catalogues for the sale and purchase forms.
+
+``/api/catalogue/<name>`` (products, customers, suppliers) returns
+
+    {"name": "products", "version": "2026-05-04T10:31:07.120394", "count": 51234,
+     "columns": ["id", "code", ...], "rows": [[1, "P0000001", ...], ...],
+     "removed": [], "delta": false}
+
+The version is the newest ``updated_at`` of the table, which moves on every
+change (a sale changes ``stock_quantity`` and so ``updated_at``). It is also
+the response's ETag, so an unchanged catalogue costs the browser a 304.
+``static/js/catalogue.js`` keeps the last copy and asks for
+``?since=<version>``. It then receives only the rows updated since, plus the
+ids that were deactivated, under ``"delta": true``. The delta reaches back
+``OVERLAP`` further than ``since``, so rows from a transaction that committed
+after its timestamp was taken are not missed. Rows that were deleted outright
+leave no trace. The client therefore compares its row count with ``count``
+and reloads everything when they differ.
+
+The version and count come from the application cache, which is invalidated
+by every write to the table.
+"""
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import func, select
+
+from app import db
+from cache import cache
+from models import Category, Customer, Product, Supplier
+
+OVERLAP = timedelta(minutes=5)
+
+
+class Catalogue:
+    def __init__(self, name, model, columns, joins=()):
+        self.name = name
+        self.model = model
+        self.columns = columns
+        self.joins = joins
+        self.meta = cache.cached(f'catalogue_meta_{name}', tags=(model.__tablename__,))(self._meta)
+
+    def _meta(self):
+        """(version, number of active rows)"""
+        model = self.model
+        newest, count = db.session.execute(select(
+            func.max(model.updated_at),
+            func.count().filter(model.is_active == True),  # noqa: E712
+        )).one()
+        return (newest.isoformat() if newest else ''), count
+
+    def etag(self, version, count, since=None):
+        return f"{self.name}-{version}-{count}" + (f"-since-{since}" if since else '')
+
+    def snapshot(self, since=None):
+        """Every active row, or the changes since ``since`` (a version string)"""
+        version, count = self.meta()
+        try:
+            changed_after = datetime.fromisoformat(since) - OVERLAP if since else None
+        except ValueError:
+            changed_after = None
+
+        model = self.model
+        stmt = select(model.is_active, *self.columns)
+        for target, onclause in self.joins:
+            stmt = stmt.outerjoin(target, onclause)
+        if changed_after is None:
+            stmt = stmt.where(model.is_active == True)  # noqa: E712
+        else:
+            stmt = stmt.where(model.updated_at > changed_after)
+
+        rows, removed = [], []
+        for active, *values in db.session.execute(stmt.order_by(model.id)):
+            if active:
+                rows.append([float(value) if isinstance(value, Decimal) else value for value in values])
+            else:
+                removed.append(values[0])
+
+        return {
+            'name': self.name,
+            'version': version,
+            'count': count,
+            'columns': [column.key for column in self.columns],
+            'rows': rows,
+            'removed': removed,
+            'delta': changed_after is not None,
+        }
+
+
+CATALOGUES = {
+    'products': Catalogue('products', Product, (
+        Product.id, Product.code, Product.name, Product.unit, Product.sale_price, Product.purchase_price,
+        Product.tax_rate, Product.stock_quantity, Product.min_stock, Category.name.label('category_name'),
+    ), joins=((Category, Product.category_id == Category.id),)),
+    'customers': Catalogue('customers', Customer, (
+        Customer.id, Customer.name, Customer.tax_number, Customer.email, Customer.phone, Customer.city,
+    )),
+    'suppliers': Catalogue('suppliers', Supplier, (
+        Supplier.id, Supplier.name, Supplier.tax_number, Supplier.email, Supplier.phone, Supplier.city,
+    )),
+}
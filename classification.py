@@ -0,0 +1,129 @@
+"""ABC/XYZ classification of the products.
+
+``classify()`` looks at the sales of the last ``WINDOW_DAYS`` days and gives
+every active product two classes.
+
+ABC (revenue):
+  the products are ranked by net revenue and the running share of the
+  total is accumulated. Class A covers the first ``A_SHARE`` of the revenue,
+  class B the next part up to ``B_SHARE``, and class C the rest, including
+  products that did not sell. A product belongs to the part its revenue
+  starts in, so the top seller is A even when it alone passes ``A_SHARE``.
+
+XYZ (demand variability):
+  the coefficient of variation (standard deviation / mean) of the demand.
+  Class X is steady (up to ``X_CV``), class Y varies (up to ``Y_CV``), and
+  class Z is erratic or did not sell. The daily mean and deviation come from
+  ``replenishment.demand_stats``. They are scaled to a week by dividing by
+  sqrt(7), which treats the days as independent. Daily demand of a slow
+  mover is mostly zeros and would put nearly everything in Z.
+
+Two grouped aggregates over ``sale_items`` feed a single pass that ranks
+and classifies the catalogue. The results are bulk-inserted into
+``product_classifications``. The table is rebuilt nightly by
+``flask classify-products`` from cron, or by the ``classify_products`` job.
+
+The classes filter the products list and its exports. The class A list is
+the one to count most often. Replenishment sets its service level by class
+(``replenishment.SERVICE_LEVEL_Z``).
+"""
+import math
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy import delete, func, insert, select
+
+from app import app, db
+from models import Product, ProductClassification, Sale, SaleItem
+
+WINDOW_DAYS = 180
+A_SHARE = 0.80
+B_SHARE = 0.95
+X_CV = 0.5
+Y_CV = 1.0
+CLASSES = {'abc': ('A', 'B', 'C'), 'xyz': ('X', 'Y', 'Z')}
+BATCH_SIZE = 5000
+
+
+def revenue_by_product(start):
+    """{product_id: net revenue} of the non-cancelled sales since ``start``"""
+    return dict(db.session.execute(
+        select(SaleItem.product_id, func.sum(SaleItem.quantity * SaleItem.unit_price))
+        .join(Sale, Sale.id == SaleItem.sale_id)
+        .where(Sale.sale_date >= start, Sale.status != 'cancelado')
+        .group_by(SaleItem.product_id)
+    ).all())
+
+
+def abc_class(share_above):
+    """Class of a product whose higher-ranked products make ``share_above`` of the revenue"""
+    if share_above < A_SHARE:
+        return 'A'
+    return 'B' if share_above < B_SHARE else 'C'
+
+
+def xyz_class(cv):
+    if cv is None:
+        return 'Z'
+    if cv <= X_CV:
+        return 'X'
+    return 'Y' if cv <= Y_CV else 'Z'
+
+
+def classify(now=None):
+    """Rebuild ``product_classifications``; returns {class pair: product count}. The caller commits."""
+    from replenishment import demand_stats
+
+    now = now or datetime.now()
+    start = now - timedelta(days=WINDOW_DAYS)
+    revenue = revenue_by_product(start)
+    demand = demand_stats(start, WINDOW_DAYS)
+
+    product_ids = db.session.execute(
+        select(Product.id).where(Product.is_active == True)  # noqa: E712
+    ).scalars().all()
+    # Highest revenue first. A product is classed by the share ranked above it,
+    # so the top seller is always A, however much of the revenue it makes.
+    product_ids.sort(key=lambda product_id: (-float(revenue.get(product_id) or 0), product_id))
+    total = float(sum(revenue.get(product_id) or 0 for product_id in product_ids))
+
+    db.session.execute(delete(ProductClassification))
+    counts, batch, running = {}, [], 0.0
+    for product_id in product_ids:
+        amount = float(revenue.get(product_id) or 0)
+        if amount > 0:
+            share_above = running / total
+            running += amount
+            share = running / total
+        else:
+            share_above = share = 1.0
+        mean, std = demand.get(product_id, (0, 0))
+        cv = std / mean / math.sqrt(7) if mean > 0 else None
+
+        row = {'product_id': product_id, 'revenue': round(amount, 2), 'cumulative_share': round(share, 4),
+               'abc_class': abc_class(share_above) if amount > 0 else 'C',
+               'demand_cv': round(cv, 4) if cv is not None else None, 'xyz_class': xyz_class(cv),
+               'computed_at': now}
+        pair = row['abc_class'] + row['xyz_class']
+        counts[pair] = counts.get(pair, 0) + 1
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            db.session.execute(insert(ProductClassification.__table__), batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(ProductClassification.__table__), batch)
+    return counts
+
+
+def abc_classes():
+    """{product_id: ABC class} of the classified products"""
+    return dict(db.session.execute(select(ProductClassification.product_id, ProductClassification.abc_class)).all())
+
+
+@app.cli.command('classify-products')
+def classify_products_command():
+    """Recompute the ABC/XYZ classes of the products (run nightly)"""
+    counts = classify()
+    db.session.commit()
+    summary = ', '.join(f'{pair}: {counts[pair]}' for pair in sorted(counts))
+    click.echo(f'{sum(counts.values())} produtos classificados ({summary}).')
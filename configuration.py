@@ -0,0 +1,115 @@
+"""Company data and system settings, stored in ``configurations``.
+
+Each setting is declared in ``SETTINGS`` with its ``data_type``, default and
+description. The table keeps the value as text and ``values()`` returns the
+typed value (``int``, ``bool``, ``Decimal`` or ``str``), or the default when
+there is no row yet.
+
+All settings are read in one query and kept in the application cache under
+the ``configurations`` tag. ``update()`` writes through the ORM, so the commit
+bumps that tag, and with a shared cache backend (the default ``CACHE_DIR``
+or Redis, see cache.py) every worker reloads on its next read. Nothing is
+kept in the session cookie.
+"""
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import select
+
+from app import db
+from cache import cache
+from models import Configuration
+from utils import validate_tax_number
+
+# key: (data_type, default, description)
+COMPANY = {
+    'company_name': ('string', 'GestVendas', 'Nome da empresa'),
+    'tax_number': ('string', '999999990', 'NIF da empresa'),
+    'address': ('string', '', 'Morada'),
+    'city': ('string', 'Lisboa', 'Localidade'),
+    'postal_code': ('string', '1000-000', 'Código postal'),
+    'country': ('string', 'PT', 'País (ISO 3166-1)'),
+    'phone': ('string', '', 'Telefone'),
+    'email': ('string', '', 'Email'),
+    'website': ('string', '', 'Website'),
+}
+SYSTEM = {
+    'currency': ('string', 'EUR', 'Moeda'),
+    'date_format': ('string', 'dd/mm/yyyy', 'Formato de data'),
+    'decimal_places': ('integer', 2, 'Casas decimais'),
+    'thousand_separator': ('string', ',', 'Separador de milhares'),
+    'decimal_separator': ('string', '.', 'Separador decimal'),
+    'auto_backup': ('boolean', True, 'Cópia de segurança automática'),
+    'email_notifications': ('boolean', True, 'Notificações por email'),
+    'low_stock_threshold': ('integer', 10, 'Limite de stock baixo'),
+}
+SETTINGS = {**COMPANY, **SYSTEM}
+
+TRUE = ('1', 'true', 'on', 'yes', 'sim')
+
+
+def parse(text, data_type):
+    """Typed value of the stored ``text``"""
+    if data_type == 'integer':
+        return int(text)
+    if data_type == 'boolean':
+        return str(text).strip().lower() in TRUE
+    if data_type == 'decimal':
+        try:
+            return Decimal(str(text).replace(',', '.'))
+        except InvalidOperation:
+            raise ValueError(f'Valor decimal inválido: {text}')
+    return text
+
+
+def serialize(value, data_type):
+    if data_type == 'boolean':
+        return 'true' if value else 'false'
+    return str(value)
+
+
+@cache.cached('settings', tags=('configurations',))
+def values():
+    """{key: typed value} of every declared setting"""
+    stored = dict(db.session.execute(
+        select(Configuration.key, Configuration.value).where(Configuration.key.in_(SETTINGS))
+    ).all())
+    result = {}
+    for key, (data_type, default, _) in SETTINGS.items():
+        try:
+            result[key] = parse(stored[key], data_type) if stored.get(key) is not None else default
+        except ValueError:
+            result[key] = default
+    return result
+
+
+def get(key):
+    return values()[key]
+
+
+def company():
+    current = values()
+    return {key: current[key] for key in COMPANY}
+
+
+def system():
+    current = values()
+    return {key: current[key] for key in SYSTEM}
+
+
+def update(changes):
+    """Validate and store ``{key: value}`` (raises ``ValueError``); the caller commits"""
+    typed = {}
+    for key, value in changes.items():
+        data_type = SETTINGS[key][0]
+        typed[key] = value if data_type == 'boolean' else parse(value, data_type)
+    if 'tax_number' in typed and not validate_tax_number(typed['tax_number'], typed.get('country', 'PT')):
+        raise ValueError('NIF inválido.')
+
+    rows = {row.key: row for row in Configuration.query.filter(Configuration.key.in_(typed))}
+    for key, value in typed.items():
+        row = rows.get(key)
+        if row is None:
+            data_type, _, description = SETTINGS[key]
+            row = Configuration(key=key, data_type=data_type, description=description)
+            db.session.add(row)
+        row.value = serialize(value, row.data_type or SETTINGS[key][0])
@@ -0,0 +1,193 @@
+"""Weighted-average cost of the products and cost of goods sold.
+
+Every product carries ``average_cost``. A receipt of ``q`` units at cost
+``c`` moves it to ``(on_hand x average + q x c) / (on_hand + q)``, with
+negative stock counted as zero. A purchase receives at the line's net unit
+price, and other stock entries (opening stock, manual ``entrada``) receive at
+the current average. The goods of a cancelled sale come back at the cost
+they left at. A sale leaves the average unchanged. Each sale line is
+costed at it and stores ``unit_cost`` and ``cost_amount`` (the COGS). Margin
+figures are therefore plain sums over ``sale_items`` (``cost_of_sales``).
+
+stock.py calls ``receive``/``issue`` while it holds the product row lock, so
+the average is maintained incrementally and concurrent postings cannot
+interleave. A weighted average is used rather than FIFO layers. It is one
+column per product, it needs no layer bookkeeping on every sale, and it is
+a costing method the Portuguese accounting standard (SNC) accepts.
+
+``rebuild_costs`` recomputes everything by replaying ``inventory_movements``
+in order, product by product, as a single streamed pass. It runs as the
+``rebuild_costs`` job or with ``flask rebuild-costs``, and is needed after
+backfills, for databases that predate the engine, or after a purchase price
+was corrected. On those databases ``flask upgrade-schema`` (indexes.py) adds
+the cost columns first.
+"""
+from decimal import ROUND_HALF_UP, Decimal
+
+import click
+from sqlalchemy import and_, bindparam, func, select, update
+
+from app import app, db
+from models import InventoryMovement, Product, PurchaseItem, Sale, SaleItem
+
+COST_PLACES = Decimal('0.0001')
+CENT = Decimal('0.01')
+ZERO = Decimal('0')
+BATCH_SIZE = 5000
+
+
+def _decimal(value):
+    return Decimal(str(value)) if value is not None else ZERO
+
+
+def weighted_average(on_hand, average, quantity, cost):
+    """Average cost after receiving ``quantity`` units at ``cost``"""
+    on_hand = max(on_hand or 0, 0)
+    if on_hand + quantity <= 0:
+        return _decimal(cost).quantize(COST_PLACES, rounding=ROUND_HALF_UP)
+    total = on_hand * _decimal(average) + quantity * _decimal(cost)
+    return (total / (on_hand + quantity)).quantize(COST_PLACES, rounding=ROUND_HALF_UP)
+
+
+def current_cost(product):
+    """What one more unit of ``product`` costs: its average, or its purchase price"""
+    average = _decimal(product.average_cost)
+    return average if average > 0 else _decimal(product.purchase_price)
+
+
+# =============== INCREMENTAL ===============
+
+def receive(product, quantity, cost=None):
+    """Take ``quantity`` units at ``cost`` (default: the current cost) into the average
+
+    Call with the product row locked and before its stock is increased.
+    """
+    cost = current_cost(product) if cost is None else _decimal(cost)
+    product.average_cost = weighted_average(product.stock_quantity, current_cost(product), quantity, cost)
+
+
+def issue(product, item):
+    """Cost a sale line at the product's current average (COGS)"""
+    unit_cost = current_cost(product)
+    item.unit_cost = unit_cost
+    item.cost_amount = (unit_cost * int(item.quantity)).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+# =============== READS ===============
+
+def cost_of_sales(start=None, end=None, product_ids=None):
+    """(net revenue, cost of goods sold) of the non-cancelled sales in the period"""
+    stmt = select(
+        func.coalesce(func.sum(SaleItem.quantity * SaleItem.unit_price), 0),
+        func.coalesce(func.sum(SaleItem.cost_amount), 0),
+    ).join(Sale, Sale.id == SaleItem.sale_id).where(Sale.status != 'cancelado')
+    if start:
+        stmt = stmt.where(Sale.sale_date >= start)
+    if end:
+        stmt = stmt.where(Sale.sale_date < end)
+    if product_ids is not None:
+        stmt = stmt.where(SaleItem.product_id.in_(product_ids))
+    revenue, cost = db.session.execute(stmt).one()
+    return _decimal(revenue), _decimal(cost)
+
+
+# =============== REBUILD ===============
+
+def _receipt_costs():
+    """Net unit cost per (purchase, product), averaged over the purchase's lines"""
+    return select(
+        PurchaseItem.purchase_id, PurchaseItem.product_id,
+        (func.sum(PurchaseItem.quantity * PurchaseItem.unit_price) / func.sum(PurchaseItem.quantity)).label('cost'),
+    ).group_by(PurchaseItem.purchase_id, PurchaseItem.product_id).subquery()
+
+
+def _return_costs():
+    """Unit cost per (sale, product) that the goods of a cancelled sale come back at"""
+    return select(
+        SaleItem.sale_id, SaleItem.product_id,
+        (func.sum(SaleItem.quantity * SaleItem.unit_cost) / func.sum(SaleItem.quantity)).label('cost'),
+    ).group_by(SaleItem.sale_id, SaleItem.product_id).subquery()
+
+
+def rebuild_costs(report=None):
+    """Recompute every product's average cost and every sale line's COGS
+
+    Returns the number of movements replayed. ``report(done, total)`` is
+    called after every batch. The caller commits.
+    """
+    receipts, returns = _receipt_costs(), _return_costs()
+    total = db.session.execute(select(func.count(InventoryMovement.id))).scalar() or 0
+    rows = db.session.execute(
+        select(InventoryMovement.product_id, InventoryMovement.quantity, InventoryMovement.reference_type,
+               InventoryMovement.reference_id, func.coalesce(receipts.c.cost, returns.c.cost),
+               Product.purchase_price)
+        .join(Product, Product.id == InventoryMovement.product_id)
+        .outerjoin(receipts, and_(InventoryMovement.reference_type == 'compra',
+                                  receipts.c.purchase_id == InventoryMovement.reference_id,
+                                  receipts.c.product_id == InventoryMovement.product_id))
+        .outerjoin(returns, and_(InventoryMovement.reference_type == 'venda', InventoryMovement.quantity > 0,
+                                 returns.c.sale_id == InventoryMovement.reference_id,
+                                 returns.c.product_id == InventoryMovement.product_id))
+        .order_by(InventoryMovement.product_id, InventoryMovement.created_at, InventoryMovement.id)
+        .execution_options(yield_per=BATCH_SIZE)
+    )
+
+    averages, sale_costs = {}, []
+    product_id = on_hand = average = None
+    issued = {}  # sale id -> cost this replay gave the product's sale lines
+    done = 0
+    for movement_product, quantity, reference_type, reference_id, receipt_cost, purchase_price in rows:
+        if movement_product != product_id:
+            if product_id is not None:
+                averages[product_id] = average
+            product_id, on_hand, average = movement_product, 0, ZERO
+            issued = {}
+
+        cost = average if average > 0 else _decimal(purchase_price)
+        if quantity > 0:
+            # A cancelled sale's goods come back at the cost they left at, as in stock.return_sale
+            if reference_type == 'venda':
+                receipt_cost = issued.get(reference_id, receipt_cost)
+            average = weighted_average(on_hand, cost, quantity, receipt_cost if receipt_cost is not None else cost)
+        elif reference_type == 'venda' and reference_id is not None:
+            issued[reference_id] = cost
+            sale_costs.append({'sale': reference_id, 'product': product_id, 'cost': cost})
+        on_hand += quantity
+
+        done += 1
+        if len(sale_costs) >= BATCH_SIZE:
+            _write_sale_costs(sale_costs)
+            sale_costs = []
+        if report and done % BATCH_SIZE == 0:
+            report(done, total)
+    if product_id is not None:
+        averages[product_id] = average
+    _write_sale_costs(sale_costs)
+
+    # Products that never moved keep no average
+    db.session.execute(update(Product).values(average_cost=0))
+    if averages:
+        table = Product.__table__
+        db.session.execute(
+            update(table).where(table.c.id == bindparam('product')).values(average_cost=bindparam('cost')),
+            [{'product': key, 'cost': value} for key, value in averages.items()])
+    return done
+
+
+def _write_sale_costs(rows):
+    if not rows:
+        return
+    table = SaleItem.__table__
+    cost = bindparam('cost')
+    db.session.execute(
+        update(table).where(table.c.sale_id == bindparam('sale'), table.c.product_id == bindparam('product'))
+        .values(unit_cost=cost, cost_amount=func.round(table.c.quantity * cost, 2)),
+        rows)
+
+
+@app.cli.command('rebuild-costs')
+def rebuild_costs_command():
+    """Recompute average costs and sale line COGS from the movement history"""
+    moved = rebuild_costs()
+    db.session.commit()
+    click.echo(f'Custos recalculados a partir de {moved} movimentos.')
@@ -0,0 +1,273 @@
+"""Streaming CSV/XLSX exports of the list pages (``/export/<name>.<format>``).
+
+An export takes the same query-string filters and sort as its list page, via
+the ``Listing`` from listing.py, but has no pagination. The rows come from a
+server-side cursor (``yield_per``, so ``stream_results`` on PostgreSQL) as
+plain column tuples. They are encoded in batches and sent as a chunked
+response, so memory use does not grow with the number of rows: a 5M-row
+movement export holds one batch at a time.
+
+The XLSX file is produced the same way. ``zipfile`` writes to an unseekable
+sink, the worksheet is deflated row by row, and the sink is drained after
+every batch. Strings are inline, so no shared-strings table has to be kept
+in memory. Dates become Excel date-time cells.
+"""
+import csv
+import io
+import re
+import zipfile
+from datetime import date, datetime
+from decimal import Decimal
+from xml.sax.saxutils import escape
+
+from sqlalchemy import select
+from sqlalchemy.orm import aliased
+
+from app import db
+from listing import CUSTOMERS, INVENTORY, PRODUCTS, PURCHASES, SALES, SUPPLIERS
+from models import (Category, Customer, InventoryMovement, Product, ProductClassification, Purchase,
+                    PurchaseItem, Sale, SaleItem, Supplier, User)
+
+YIELD_PER = 2000
+CHUNK_SIZE = 64 * 1024
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+class Export:
+    """Columns of an export and the listing whose filters and sort it follows
+
+    ``columns`` is a list of ``(header, expression)``; ``joins`` are
+    ``(target, onclause)`` pairs outer-joined to the listing's model, in order.
+    ``lines`` orders the joined detail rows of one document.
+    """
+
+    def __init__(self, name, listing, columns, joins=(), lines=()):
+        self.name = name
+        self.listing = listing
+        self.columns = columns
+        self.joins = joins
+        self.lines = lines
+
+    @property
+    def headers(self):
+        return [header for header, _ in self.columns]
+
+    def statement(self, args):
+        model = self.listing.model
+        stmt = select(*[expression for _, expression in self.columns]).select_from(model)
+        for target, onclause in self.joins:
+            stmt = stmt.outerjoin(target, onclause)
+        criteria = self.listing.criteria(args)
+        if criteria:
+            stmt = stmt.where(*criteria)
+        _, column, descending = self.listing._sort(args)
+        order = (column.desc(), model.id.desc()) if descending else (column.asc(), model.id.asc())
+        return stmt.order_by(*order, *self.lines)
+
+    def rows(self, args):
+        """Stream the rows for ``args`` from a server-side cursor"""
+        result = db.session.execute(self.statement(args).execution_options(yield_per=YIELD_PER))
+        for partition in result.partitions():
+            yield from partition
+
+    def filename(self, format):
+        return f"{self.name}_{date.today().isoformat()}.{format}"
+
+    def generate(self, format, args):
+        writer = write_xlsx if format == 'xlsx' else write_csv
+        return writer(self.headers, self.rows(args))
+
+
+# =============== WRITERS ===============
+
+def write_csv(headers, rows):
+    """CSV (UTF-8 with BOM, so Excel detects the encoding) as byte chunks"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('﻿')
+    writer.writerow(headers)
+    for row in rows:
+        writer.writerow(['' if value is None else _csv_value(value) for value in row])
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def _csv_value(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+
+class _Sink:
+    """Write-only, unseekable file that collects what ``zipfile`` writes"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '</Types>'),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>'),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Dados" sheetId="1" r:id="rId1"/></sheets></workbook>'),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '<Relationship Id="rId2" Target="styles.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles"/>'
+        '</Relationships>'),
+    # Style 1: date-time (dd/mm/yyyy hh:mm), style 2: bold header
+    'xl/styles.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<numFmts count="1"><numFmt numFmtId="164" formatCode="dd/mm/yyyy hh:mm"/></numFmts>'
+        '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+        '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+        '<fill><patternFill patternType="gray125"/></fill></fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="3"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+        '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/></cellXfs>'
+        '</styleSheet>'),
+}
+
+EXCEL_EPOCH = datetime(1899, 12, 30)
+XML_ILLEGAL = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def _cell(value, style=0):
+    if value is None:
+        return '<c/>'
+    if isinstance(value, bool):
+        return f'<c t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float, Decimal)):
+        return f'<c><v>{value}</v></c>'
+    if isinstance(value, (datetime, date)):
+        moment = value if isinstance(value, datetime) else datetime.combine(value, datetime.min.time())
+        serial = (moment - EXCEL_EPOCH).total_seconds() / 86400
+        return f'<c s="1"><v>{serial:.6f}</v></c>'
+    text = escape(XML_ILLEGAL.sub('', str(value)))
+    style_attr = f' s="{style}"' if style else ''
+    return f'<c t="inlineStr"{style_attr}><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def write_xlsx(headers, rows):
+    """Single-sheet XLSX workbook as byte chunks"""
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in XLSX_PARTS.items():
+            archive.writestr(name, content)
+        yield sink.drain()
+
+        with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                        b'<sheetData>')
+            sheet.write(('<row>' + ''.join(_cell(header, 2) for header in headers) + '</row>').encode())
+            batch = []
+            for row in rows:
+                batch.append('<row>' + ''.join(_cell(value) for value in row) + '</row>')
+                if len(batch) >= YIELD_PER:
+                    sheet.write(''.join(batch).encode('utf-8'))
+                    batch = []
+                    if len(sink.buffer) >= CHUNK_SIZE:
+                        yield sink.drain()
+            sheet.write(''.join(batch).encode('utf-8'))
+            sheet.write(b'</sheetData></worksheet>')
+    yield sink.drain()
+
+
+# =============== EXPORTS ===============
+
+MovementUser = aliased(User)
+
+EXPORTS = {export.name: export for export in (
+    Export('produtos', PRODUCTS, [
+        ('Código', Product.code), ('Nome', Product.name), ('Categoria', Category.name),
+        ('Fornecedor', Supplier.name), ('Unidade', Product.unit), ('Preço de compra', Product.purchase_price),
+        ('Preço de venda', Product.sale_price), ('IVA %', Product.tax_rate), ('Stock', Product.stock_quantity),
+        ('Stock mínimo', Product.min_stock), ('Stock máximo', Product.max_stock),
+        ('Classe ABC', ProductClassification.abc_class), ('Classe XYZ', ProductClassification.xyz_class),
+    ], joins=((Category, Product.category_id == Category.id), (Supplier, Product.supplier_id == Supplier.id),
+              (ProductClassification, ProductClassification.product_id == Product.id))),
+    Export('clientes', CUSTOMERS, [
+        ('Nome', Customer.name), ('NIF', Customer.tax_number), ('Tipo', Customer.customer_type),
+        ('Email', Customer.email), ('Telefone', Customer.phone), ('Morada', Customer.address),
+        ('Localidade', Customer.city), ('Código postal', Customer.postal_code), ('País', Customer.country),
+        ('Criado em', Customer.created_at),
+    ]),
+    Export('fornecedores', SUPPLIERS, [
+        ('Nome', Supplier.name), ('NIF', Supplier.tax_number), ('Contacto', Supplier.contact_person),
+        ('Email', Supplier.email), ('Telefone', Supplier.phone), ('Morada', Supplier.address),
+        ('Localidade', Supplier.city), ('Código postal', Supplier.postal_code), ('País', Supplier.country),
+        ('Criado em', Supplier.created_at),
+    ]),
+    # One row per line, with the document header repeated
+    Export('vendas', SALES, [
+        ('Fatura', Sale.invoice_number), ('Data', Sale.sale_date), ('Cliente', Customer.name),
+        ('NIF cliente', Customer.tax_number), ('Estado', Sale.status), ('Pagamento', Sale.payment_method),
+        ('Código produto', Product.code), ('Produto', Product.name), ('Quantidade', SaleItem.quantity),
+        ('Preço unitário', SaleItem.unit_price), ('IVA %', SaleItem.tax_rate), ('Total linha', SaleItem.total_price),
+        ('Subtotal documento', Sale.subtotal), ('IVA documento', Sale.tax_amount),
+        ('Total documento', Sale.total_amount),
+    ], joins=((Customer, Sale.customer_id == Customer.id), (SaleItem, SaleItem.sale_id == Sale.id),
+              (Product, SaleItem.product_id == Product.id)), lines=(SaleItem.id,)),
+    Export('compras', PURCHASES, [
+        ('Fatura', Purchase.invoice_number), ('Data', Purchase.purchase_date), ('Fornecedor', Supplier.name),
+        ('NIF fornecedor', Supplier.tax_number), ('Estado', Purchase.status),
+        ('Código produto', Product.code), ('Produto', Product.name), ('Quantidade', PurchaseItem.quantity),
+        ('Preço unitário', PurchaseItem.unit_price), ('IVA %', PurchaseItem.tax_rate),
+        ('Total linha', PurchaseItem.total_price), ('Subtotal documento', Purchase.subtotal),
+        ('IVA documento', Purchase.tax_amount), ('Total documento', Purchase.total_amount),
+    ], joins=((Supplier, Purchase.supplier_id == Supplier.id), (PurchaseItem, PurchaseItem.purchase_id == Purchase.id),
+              (Product, PurchaseItem.product_id == Product.id)), lines=(PurchaseItem.id,)),
+    Export('movimentos', INVENTORY, [
+        ('Data', InventoryMovement.created_at), ('Código produto', Product.code), ('Produto', Product.name),
+        ('Tipo', InventoryMovement.movement_type), ('Quantidade', InventoryMovement.quantity),
+        ('Saldo', InventoryMovement.balance), ('Referência', InventoryMovement.reference_type),
+        ('Documento', InventoryMovement.reference_id), ('Notas', InventoryMovement.notes),
+        ('Utilizador', MovementUser.username),
+    ], joins=((Product, InventoryMovement.product_id == Product.id),
+              (MovementUser, InventoryMovement.user_id == MovementUser.id))),
+)}
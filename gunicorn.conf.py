@@ -0,0 +1,22 @@
+"""Gunicorn settings, read automatically from the working directory.
+
+With ``PROMETHEUS_MULTIPROC_DIR`` set (see metrics.py), the directory is
+emptied when the server starts and a worker's live gauges are dropped when
+it exits, so ``/metrics`` only adds up the processes that are running.
+"""
+import glob
+import os
+
+
+def on_starting(server):
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, '*.db')):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
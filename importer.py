@@ -0,0 +1,405 @@
+"""Bulk CSV import of products, customers and suppliers (``/import/<name>``).
+
+The uploaded file is handled by the job worker (``import`` jobs), not by the
+request. The pipeline has four steps:
+
+1. The CSV is read in batches of ``BATCH_SIZE`` rows. Either delimiter is
+   accepted, ``;`` (Excel in Portuguese) or ``,``. The header names are
+   those of the exports (``exports.py``), so an exported file can be edited
+   and imported back. The column names (``code``, ``sale_price``, ...) work
+   too. Files are read as UTF-8, or as Windows-1252 (what Excel saves as
+   plain "CSV") when they are not valid UTF-8.
+2. Each batch is validated without a query per row. NIFs go through
+   ``utils.validate_tax_number``, and categories and suppliers are looked
+   up by name in dictionaries loaded once. A code (products) or NIF
+   (customers, suppliers) that is repeated in the file is rejected after
+   its first occurrence.
+3. Valid rows go into a temporary staging table. On PostgreSQL this is one
+   ``COPY ... FROM STDIN`` per batch, elsewhere an executemany.
+4. Two set-based statements move the staged rows into the table. An
+   ``UPDATE ... FROM`` matches existing rows on the code (products) or the
+   NIF (customers, suppliers) and ``INSERT ... SELECT`` adds the rest. An
+   update only writes the columns the file has, and a blank cell keeps the
+   stored value, so a file with just code, name and price does not reset
+   the other fields to their defaults.
+
+Invalid rows do not stop the import. They are written to an error report
+(line, message and the original values), which is the job's download. The
+whole import is a single transaction. It bypasses the ORM, so the job
+invalidates the table's cache entries itself once it has committed.
+
+The import does not change the stock of existing products. Stock moves
+through inventory movements, so the stock column only sets the opening
+stock of new products, which is recorded as an ``ajuste`` movement.
+"""
+import csv
+import io
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import Column, MetaData, Table, exists, func, insert, literal, select, update
+
+from app import db
+from models import Category, Customer, InventoryMovement, Product, Supplier
+from utils import validate_tax_number
+
+BATCH_SIZE = 5000
+ENCODINGS = ('utf-8-sig', 'cp1252')  # tried in order; see _encoding
+
+
+class RowError(ValueError):
+    """Invalid value in one row; the message is shown in the error report"""
+
+
+# =============== PARSERS ===============
+
+def text(max_length):
+    def parse(value):
+        if len(value) > max_length:
+            raise RowError(f'máximo de {max_length} caracteres')
+        return value
+    return parse
+
+
+def decimal(value, minimum=0, maximum=None):
+    if not value:
+        return None
+    try:
+        number = Decimal(value.replace(' ', '').replace(',', '.'))
+    except InvalidOperation:
+        raise RowError(f"'{value}' não é um número")
+    if number < minimum or (maximum is not None and number > maximum):
+        raise RowError(f"'{value}' fora do intervalo permitido")
+    return number
+
+
+def rate(value):
+    return decimal(value, maximum=100)
+
+
+def integer(value):
+    if not value:
+        return None
+    number = decimal(value)
+    if number != number.to_integral_value():
+        raise RowError(f"'{value}' não é um número inteiro")
+    return int(number)
+
+
+def tax_number(value):
+    value = value.replace(' ', '')
+    if not validate_tax_number(value):
+        raise RowError(f"NIF '{value}' inválido")
+    return value
+
+
+def customer_type(value):
+    value = value.lower() or 'particular'
+    if value not in ('particular', 'empresa'):
+        raise RowError("tipo deve ser 'particular' ou 'empresa'")
+    return value
+
+
+# =============== IMPORTS ===============
+
+class Field:
+    """One importable column: header, parser, whether it is required and the default of new rows
+
+    ``key`` is a column of the table, or the name of a lookup (see ``Import``).
+    Without a parser the value is text, limited to the column's length.
+    """
+
+    def __init__(self, key, header, parse=None, required=False, default=None):
+        self.key = key
+        self.header = header
+        self.parse = parse
+        self.required = required
+        self.default = default
+
+
+class Import:
+    """How rows of one kind are validated and merged into their table
+
+    ``key`` is the column that identifies an existing row (the unique code,
+    or the NIF). ``lookups`` resolve a name to a foreign key:
+    ``{field key: (model, foreign key column)}``. ``keep`` lists the columns
+    that an update leaves alone.
+    """
+
+    def __init__(self, name, model, fields, key, lookups=None, keep=()):
+        self.name = name
+        self.model = model
+        self.fields = fields
+        self.key = key
+        self.lookups = lookups or {}
+        self.keep = keep
+        for field in fields:
+            if field.parse is None:
+                column = self.lookups[field.key][0].name if field.key in self.lookups else self.table.c[field.key]
+                field.parse = text(column.type.length or 100000)
+
+    @property
+    def table(self):
+        return self.model.__table__
+
+    def headers(self, fieldnames):
+        """``{field key: header used in the file}``, matching headers or column names"""
+        present = {(name or '').strip().lower(): name for name in fieldnames}
+        found = {}
+        for field in self.fields:
+            for candidate in (field.header.lower(), field.key.lower()):
+                if candidate in present:
+                    found[field.key] = present[candidate]
+                    break
+        return found
+
+    def columns(self):
+        """Columns written to the staging table, in order"""
+        names = [field.key for field in self.fields if field.key not in self.lookups]
+        names += [column.key for _, column in self.lookups.values()]
+        return names + ['is_active', 'created_at', 'updated_at']
+
+    def staging_table(self):
+        columns = [Column(name, self.table.c[name].type) for name in self.columns()]
+        return Table(f'import_{self.table.name}', MetaData(), *columns, prefixes=['TEMPORARY'])
+
+    def load_lookups(self):
+        """``{field key: {lowercase name: id}}`` for the lookup fields"""
+        tables = {}
+        for key, (model, _) in self.lookups.items():
+            rows = db.session.execute(select(model.name, model.id).where(model.is_active == True)  # noqa: E712
+                                      .order_by(model.id.desc()))
+            tables[key] = {name.strip().lower(): row_id for name, row_id in rows}
+        return tables
+
+    def validate(self, raw, headers, lookups, seen, line, now):
+        """Staging row for ``raw`` (a csv.DictReader row), or raise ``RowError``"""
+        values, errors = {}, []
+        for field in self.fields:
+            value = (raw.get(headers.get(field.key)) or '').strip()
+            try:
+                if not value and field.required:
+                    raise RowError('obrigatório')
+                values[field.key] = field.parse(value) if value else None
+            except RowError as e:
+                errors.append(f'{field.header}: {e}')
+
+        for key, (model, column) in self.lookups.items():
+            label = values.pop(key, None)
+            values[column.key] = lookups[key].get(label.lower()) if label else None
+            if label and values[column.key] is None:
+                errors.append(f"{self._header(key)}: '{label}' não existe")
+            elif not label and not self.table.c[column.key].nullable:
+                errors.append(f'{self._header(key)}: obrigatório')
+
+        key = values.get(self.key.key)
+        if not errors and key:
+            if key in seen:
+                errors.append(f"{self._header(self.key.key)} '{key}' repetido (linha {seen[key]})")
+            else:
+                seen[key] = line
+        if errors:
+            raise RowError('; '.join(errors))
+
+        values.update(is_active=True, created_at=now, updated_at=now)
+        return values
+
+    def _header(self, key):
+        return next(field.header for field in self.fields if field.key == key)
+
+    def merge(self, staging, headers):
+        """Move the staged rows into the table; returns ``(inserted, updated)``
+
+        ``headers`` (from ``headers()``) says which columns the file has. An
+        existing row only takes those, and a blank cell (NULL in the staging
+        table) keeps the stored value. New rows get the field's default.
+        """
+        table, key = self.table, self.table.c[self.key.key]
+        columns = self.columns()
+        staged = staging.c[self.key.key]
+        matching = (key == staged) & (staged != '')
+        updated = db.session.execute(select(func.count()).select_from(staging).where(
+            exists().where(matching))).scalar()
+
+        present = ['is_active', 'updated_at']
+        defaults = {}
+        for field in self.fields:
+            name = self.lookups[field.key][1].key if field.key in self.lookups else field.key
+            if field.key in headers and name not in self.keep:
+                present.append(name)
+            if field.default is not None:
+                defaults[name] = literal(field.default, table.c[name].type)
+
+        db.session.execute(update(table).where(matching).values(
+            {name: func.coalesce(staging.c[name], table.c[name]) for name in present}))
+        db.session.execute(insert(table).from_select(columns, select(*[
+            func.coalesce(staging.c[name], defaults[name]) if name in defaults else staging.c[name]
+            for name in columns
+        ]).where(~exists().where(matching))))
+
+        total = db.session.execute(select(func.count()).select_from(staging)).scalar()
+        return total - updated, updated
+
+IMPORTS = {entity.name: entity for entity in (
+    Import('produtos', Product, [
+        Field('code', 'Código', required=True),
+        Field('name', 'Nome', required=True),
+        Field('category', 'Categoria'),
+        Field('supplier', 'Fornecedor'),
+        Field('description', 'Descrição', default=''),
+        Field('unit', 'Unidade', default='unidade'),
+        Field('purchase_price', 'Preço de compra', decimal, default=Decimal('0.00')),
+        Field('sale_price', 'Preço de venda', decimal, required=True),
+        Field('tax_rate', 'IVA %', rate, default=Decimal('23.00')),
+        Field('stock_quantity', 'Stock', integer, default=0),
+        Field('min_stock', 'Stock mínimo', integer, default=5),
+        Field('max_stock', 'Stock máximo', integer, default=100),
+    ], key=Product.code, keep=('stock_quantity', 'created_at'),
+        lookups={'category': (Category, Product.category_id), 'supplier': (Supplier, Product.supplier_id)}),
+    Import('clientes', Customer, [
+        Field('name', 'Nome', required=True),
+        Field('tax_number', 'NIF', tax_number, default=''),
+        Field('customer_type', 'Tipo', customer_type, default='particular'),
+        Field('email', 'Email', default=''),
+        Field('phone', 'Telefone', default=''),
+        Field('address', 'Morada', default=''),
+        Field('city', 'Localidade', default=''),
+        Field('postal_code', 'Código postal', default=''),
+        Field('country', 'País', default='Portugal'),
+    ], key=Customer.tax_number, keep=('created_at',)),
+    Import('fornecedores', Supplier, [
+        Field('name', 'Nome', required=True),
+        Field('tax_number', 'NIF', tax_number, default=''),
+        Field('contact_person', 'Contacto', default=''),
+        Field('email', 'Email', default=''),
+        Field('phone', 'Telefone', default=''),
+        Field('address', 'Morada', default=''),
+        Field('city', 'Localidade', default=''),
+        Field('postal_code', 'Código postal', default=''),
+        Field('country', 'País', default='Portugal'),
+    ], key=Supplier.tax_number, keep=('created_at',)),
+)}
+
+
+# =============== PIPELINE ===============
+
+def _encoding(path):
+    """The first of ``ENCODINGS`` that decodes the whole file at ``path``"""
+    for encoding in ENCODINGS:
+        try:
+            with open(path, encoding=encoding) as stream:
+                while stream.read(1 << 20):
+                    pass
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    raise RowError('O ficheiro não está em UTF-8 nem em Windows-1252. Guarde-o como "CSV UTF-8".')
+
+
+def _dialect(stream):
+    """Sniff the delimiter (``;``, ``,`` or tab) from the start of ``stream``"""
+    sample = stream.read(16384)
+    stream.seek(0)
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=';,\t')
+    except csv.Error:
+        return csv.excel
+
+
+def _load(staging, rows):
+    """Append ``rows`` to the staging table: COPY on PostgreSQL, executemany elsewhere"""
+    connection = db.session.connection()
+    if connection.dialect.name != 'postgresql':
+        connection.execute(staging.insert(), rows)
+        return
+
+    names = [column.name for column in staging.c]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[name] for name in names])
+    buffer.seek(0)
+    # In CSV format an empty field is NULL, which is what a blank cell is staged as
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {staging.name} ({', '.join(names)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    finally:
+        cursor.close()
+
+
+def run_import(entity, path, report=None, user_id=None):
+    """Import the CSV file at ``path``; returns ``(inserted, updated, errors)``
+
+    ``errors`` lists ``(line, message, values)`` for the rejected rows, with
+    the values in the order of ``entity.fields``. ``report(done, total)`` is
+    called after every batch. New products get their opening stock as a
+    movement of ``user_id`` (see ``open_stock``). The caller commits, then invalidates the cache
+    (the staged writes bypass the session hook).
+    """
+    with open(path, newline='', encoding=_encoding(path)) as stream:
+        total = max(sum(1 for _ in stream) - 1, 0)
+        stream.seek(0)
+        reader = csv.DictReader(stream, dialect=_dialect(stream))
+
+        headers = entity.headers(reader.fieldnames or [])
+        missing = [field.header for field in entity.fields if field.required and field.key not in headers]
+        if missing:
+            raise RowError(f"Colunas obrigatórias em falta: {', '.join(missing)}")
+
+        connection = db.session.connection()
+        staging = entity.staging_table()
+        staging.drop(connection, checkfirst=True)
+        staging.create(connection)
+
+        lookups = entity.load_lookups()
+        seen, errors, batch = {}, [], []
+        now = datetime.utcnow()
+        for done, raw in enumerate(reader, start=1):
+            try:
+                batch.append(entity.validate(raw, headers, lookups, seen, done + 1, now))
+            except RowError as e:
+                errors.append((done + 1, str(e), [raw.get(headers.get(field.key)) or '' for field in entity.fields]))
+            if done % BATCH_SIZE == 0:
+                if batch:
+                    _load(staging, batch)
+                    batch = []
+                if report:
+                    report(done, total)
+        if batch:
+            _load(staging, batch)
+        if report:
+            report(total, total)
+
+        inserted, updated = entity.merge(staging, headers)
+        if entity.model is Product and user_id:
+            open_stock(staging, user_id, now)
+        staging.drop(connection)
+    return inserted, updated, errors
+
+
+def open_stock(staging, user_id, now):
+    """Opening movements for the imported products that have none yet
+
+    Set-based counterpart of ``stock.open_stock``, so the stock of new
+    products enters the stock ledger (ledger.py). Existing products keep
+    their stock, so this only picks up ones never moved before.
+    """
+    movements = InventoryMovement.__table__
+    db.session.execute(insert(movements).from_select(
+        ['product_id', 'movement_type', 'quantity', 'balance', 'reference_type', 'notes', 'user_id', 'created_at'],
+        select(Product.id, literal('ajuste'), Product.stock_quantity, Product.stock_quantity, literal('inicial'),
+               literal('Stock inicial (importação)'), literal(user_id), literal(now))
+        .join(staging, staging.c.code == Product.code)
+        .where(Product.stock_quantity != 0, ~exists().where(movements.c.product_id == Product.id))
+    ))
+
+
+def write_errors(out, entity, errors):
+    """Error report (``;``-separated, for Excel) of the rejected rows"""
+    buffer = io.TextIOWrapper(out, encoding='utf-8-sig', newline='')
+    writer = csv.writer(buffer, delimiter=';')
+    writer.writerow(['Linha', 'Erro'] + [field.header for field in entity.fields])
+    for line, message, values in errors:
+        writer.writerow([line, message] + values)
+    buffer.flush()
+    buffer.detach()
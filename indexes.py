@@ -0,0 +1,265 @@
+"""Schema and index plan upkeep and check.
+
+The indexes themselves are declared next to the models (end of models.py),
+so ``db.create_all()`` builds them on a new database. ``create_all`` skips
+tables that already exist, though, so existing databases are brought up to
+date with ``flask create-indexes``. It creates only the declared indexes that
+are missing, using ``CREATE INDEX CONCURRENTLY`` on PostgreSQL so the tables
+stay writable meanwhile.
+
+``flask upgrade-schema`` is the deploy step for a new release. It creates
+the new tables, adds the columns listed in ``ADDED_COLUMNS`` to the existing
+ones, widens the ``WIDENED_COLUMNS``, makes the listing sort keys NOT NULL (``require_columns``) and then
+creates the missing indexes. It only changes the schema; the backfills
+(``flask rebuild-stock-ledger`` and the like) run afterwards.
+
+``flask check-indexes`` runs ``EXPLAIN`` on the hot query of each route and
+fails when one of them is planned as a full table scan, except for the
+scans listed in ``SEQUENTIAL_SCANS``. The planner only
+prefers an index when the table is large, so run it against a database
+filled to production size (e.g. a million sales).
+"""
+import json
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy import func, inspect, select, update
+
+from app import app, db
+from models import (Customer, InventoryMovement, Product, Purchase, PurchaseItem, ReplenishmentSuggestion,
+                    Sale, SaleItem, StockSnapshot, Supplier)
+
+# Nullable columns added to existing tables since their first release, which
+# ``create_all`` does not add. ``flask upgrade-schema`` adds the missing ones.
+ADDED_COLUMNS = [
+    (InventoryMovement.__table__, ('balance',)),
+    (Product.__table__, ('average_cost',)),
+    (SaleItem.__table__, ('unit_cost', 'cost_amount')),
+    (ReplenishmentSuggestion.__table__, ('order_up_to',)),
+]
+
+# Numeric columns widened since their first release. ``flask upgrade-schema``
+# alters their type on PostgreSQL; SQLite does not enforce a precision.
+WIDENED_COLUMNS = [
+    StockSnapshot.unit_cost,
+]
+
+
+def _required_columns(now):
+    """Listing sort keys declared NOT NULL after their first release, with the value for existing NULLs"""
+    return [
+        (Product.created_at, now),
+        (Customer.created_at, now),
+        (Supplier.created_at, now),
+        (Sale.sale_date, func.coalesce(Sale.created_at, now)),
+        (Sale.total_amount, 0),
+        (Purchase.purchase_date, func.coalesce(Purchase.created_at, now)),
+        (Purchase.total_amount, 0),
+        (InventoryMovement.created_at, now),
+    ]
+
+
+# =============== CREATE ===============
+
+def _applies(index, dialect):
+    """False for indexes declared with ``ddl_if(dialect=...)`` for another database"""
+    condition = getattr(index, '_ddl_if', None)
+    return condition is None or condition.dialect in (None, dialect)
+
+
+def missing_indexes():
+    """Declared indexes that the database does not have yet"""
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        present = {index['name'] for index in inspector.get_indexes(table.name)}
+        missing.extend(index for index in sorted(table.indexes, key=lambda i: i.name)
+                       if index.name not in present and _applies(index, db.engine.dialect.name))
+    return missing
+
+
+def add_missing_columns(table, *names):
+    """``ALTER TABLE ... ADD COLUMN`` for declared columns the database lacks
+
+    For nullable columns added after the table was created; ``create_all``
+    does not touch existing tables.
+    """
+    present = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+    with db.engine.begin() as connection:
+        for name in names:
+            if name not in present:
+                column_type = table.c[name].type.compile(dialect=connection.dialect)
+                connection.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {name} {column_type}')
+
+
+def require_columns(now=None):
+    """Fill the NULLs of the listing sort keys and make the columns NOT NULL
+
+    The keyset pagination (listing.py) needs them NOT NULL. SQLite cannot
+    alter a column, so there only the NULLs are filled.
+    """
+    inspector = inspect(db.engine)
+    with db.engine.begin() as connection:
+        for column, fallback in _required_columns(now or datetime.utcnow()):
+            table = column.table
+            nullable = {c['name']: c['nullable'] for c in inspector.get_columns(table.name)}
+            if not nullable.get(column.name):
+                continue
+            connection.execute(update(table).where(column.is_(None)).values({column.name: fallback}))
+            if connection.dialect.name == 'postgresql':
+                connection.exec_driver_sql(f'ALTER TABLE {table.name} ALTER COLUMN {column.name} SET NOT NULL')
+
+
+def widen_columns():
+    """``ALTER COLUMN ... TYPE`` for the ``WIDENED_COLUMNS`` still at their old precision"""
+    if db.engine.dialect.name != 'postgresql':
+        return
+    inspector = inspect(db.engine)
+    with db.engine.begin() as connection:
+        for column in WIDENED_COLUMNS:
+            table = column.table
+            current = {c['name']: c['type'] for c in inspector.get_columns(table.name)}[column.name]
+            if (current.precision, current.scale) != (column.type.precision, column.type.scale):
+                column_type = column.type.compile(dialect=connection.dialect)
+                connection.exec_driver_sql(f'ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE {column_type}')
+
+
+def create_indexes(echo=print):
+    """Create the missing indexes, one autocommitted statement each"""
+    created = []
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        concurrently = connection.dialect.name == 'postgresql'
+        if concurrently:
+            connection.exec_driver_sql('CREATE EXTENSION IF NOT EXISTS pg_trgm')  # for ix_products_name_trgm
+        for index in missing_indexes():
+            echo(f"A criar {index.name} em {index.table.name}...")
+            options = index.dialect_options['postgresql']
+            options['concurrently'] = concurrently
+            try:
+                index.create(connection)
+            finally:
+                options['concurrently'] = False
+            created.append(index.name)
+    return created
+
+
+@app.cli.command('create-indexes')
+def create_indexes_command():
+    """Create the declared indexes that are missing from the database"""
+    created = create_indexes(echo=click.echo)
+    click.echo(f'{len(created)} índices criados.' if created else 'Todos os índices já existem.')
+
+
+def upgrade_schema(echo=print):
+    """Bring an existing database up to the declared schema: tables, columns, indexes"""
+    db.create_all()
+    for table, names in ADDED_COLUMNS:
+        add_missing_columns(table, *names)
+    widen_columns()
+    require_columns()
+    return create_indexes(echo)
+
+
+@app.cli.command('upgrade-schema')
+def upgrade_schema_command():
+    """Create the missing tables, columns and indexes (run on every deploy)"""
+    created = upgrade_schema(echo=click.echo)
+    click.echo(f'Esquema atualizado ({len(created)} índices criados).')
+
+
+# =============== CHECK ===============
+
+# Hot queries that read a whole table by design: {query name: table}.
+# The low-stock list (dashboard alerts, replenishment) compares two columns
+# of the row, the stock against the reorder point, which no index can
+# answer. It reads the catalogue, not the document history, so it grows
+# with the products and not with the sales.
+SEQUENTIAL_SCANS = {'products.low_stock': 'products'}
+
+def hot_queries():
+    """{name: statement} for the queries the index plan is meant to serve
+
+    The route queries are built by the same objects the routes use (the
+    ``Listing`` of each list page, ``search_statement``, ...), so the check
+    plans what the routes actually run. The item and movement lookups are
+    the statements of the relationship loads.
+    """
+    from listing import CUSTOMERS, INVENTORY, PRODUCTS, PURCHASES, SALES
+    from replenishment import restock_query
+    from search import search_statement
+    from simple_routes import recent_sales_query
+
+    week_ago = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
+    queries = {
+        'sales.listing': SALES.statement({}),
+        'sales.period': SALES.statement({'date_from': week_ago}),
+        'sales.customer': SALES.statement({'customer': '1'}),
+        'dashboard.recent_sales': recent_sales_query().statement,
+        'sale_items.by_sale': select(SaleItem.id).where(SaleItem.sale_id == 1),
+        'sale_items.by_product': select(SaleItem.id).where(SaleItem.product_id == 1),
+        'purchases.listing': PURCHASES.statement({}),
+        'purchases.period': PURCHASES.statement({'date_from': week_ago}),
+        'purchase_items.by_purchase': select(PurchaseItem.id).where(PurchaseItem.purchase_id == 1),
+        'purchase_items.by_product': select(PurchaseItem.id).where(PurchaseItem.product_id == 1),
+        'inventory.listing': INVENTORY.statement({}),
+        'inventory.product': INVENTORY.statement({'product': '1'}),
+        'products.listing': PRODUCTS.statement({}),
+        'products.low_stock': restock_query().statement,
+        'customers.listing': CUSTOMERS.statement({}),
+    }
+    if db.engine.dialect.name == 'postgresql':  # elsewhere the search is a plain LIKE scan (search.py)
+        queries['products.search'] = search_statement('caneta')
+    return queries
+
+
+def _plan_scans(connection, statement):
+    """[(node type, relation)] of the scans in the plan of ``statement``"""
+    compiled = statement.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True})
+    if connection.dialect.name == 'postgresql':
+        plan = connection.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {compiled}').scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        scans, nodes = [], [plan[0]['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if 'Relation Name' in node:
+                scans.append((node['Node Type'], node['Relation Name']))
+            nodes.extend(node.get('Plans', []))
+        return scans
+
+    # SQLite: "SCAN sales" is a full scan, "SEARCH ..."/"... USING INDEX" are not
+    rows = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}').all()
+    scans = []
+    for row in rows:
+        detail = row[-1]
+        words = detail.split()
+        if words[0] in ('SCAN', 'SEARCH'):
+            full = words[0] == 'SCAN' and 'INDEX' not in detail
+            scans.append(('Seq Scan' if full else 'Index Scan', words[1]))
+    return scans
+
+
+def check_indexes():
+    """{name: (uses an index, scans)} for every hot query"""
+    results = {}
+    with db.engine.connect() as connection:
+        for name, statement in hot_queries().items():
+            scans = _plan_scans(connection, statement)
+            expected = SEQUENTIAL_SCANS.get(name)
+            results[name] = (bool(scans) and all(kind != 'Seq Scan' or relation == expected
+                                                 for kind, relation in scans), scans)
+    return results
+
+
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    """EXPLAIN the hot route queries and fail if any does a full table scan"""
+    results = check_indexes()
+    for name, (ok, scans) in results.items():
+        plan = ', '.join(f'{kind} on {relation}' for kind, relation in scans)
+        click.echo(f"{'OK  ' if ok else 'FAIL'} {name}: {plan}")
+    if not all(ok for ok, _ in results.values()):
+        raise SystemExit(1)
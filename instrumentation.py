@@ -0,0 +1,120 @@
+"""Per-request SQL instrumentation and slow-query log.
+
+Engine events time every statement. For each request the app then knows
+the number of queries (``query_budget.query_count``), the total database
+time and the slowest statement. This is reported in two ways:
+
+* a ``Server-Timing`` response header (``db``, ``db-slowest`` and ``app``
+  entries, visible in the browser's network panel);
+* one JSON log line per request on the ``gestvendas.requests`` logger.
+
+A statement that takes longer than ``SLOW_QUERY_MS`` (default 500) is logged
+on ``gestvendas.sql`` together with its ``EXPLAIN`` plan. This also applies
+outside requests, e.g. in the job worker. The plan is read on a separate
+DBAPI cursor, so the slow statement's pending rows are not disturbed and the
+EXPLAIN is neither counted nor timed. That cursor shares the caller's
+transaction, so on PostgreSQL the EXPLAIN runs inside a savepoint: if it
+fails, only the savepoint is rolled back and the transaction stays usable.
+"""
+import json
+import logging
+import time
+
+from flask import g, has_request_context, request, session
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app
+from query_budget import query_count
+
+SLOW_QUERY_MS = 500
+STATEMENT_LOG_LENGTH = 500
+EXPLAINABLE = ('select', 'with', 'insert', 'update', 'delete')
+
+request_log = logging.getLogger('gestvendas.requests')
+sql_log = logging.getLogger('gestvendas.sql')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _stop_timer(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if not started:
+        return
+    elapsed_ms = (time.perf_counter() - started.pop()) * 1000
+
+    if has_request_context():
+        g.db_time_ms = g.get('db_time_ms', 0.0) + elapsed_ms
+        if elapsed_ms > g.get('slowest_ms', 0.0):
+            g.slowest_ms = elapsed_ms
+            g.slowest_statement = statement
+
+    if elapsed_ms >= app.config.get('SLOW_QUERY_MS', SLOW_QUERY_MS) and not executemany:
+        _log_slow_query(conn, statement, parameters, elapsed_ms)
+
+
+def _log_slow_query(conn, statement, parameters, elapsed_ms):
+    plan = None
+    if statement.lstrip().lower().startswith(EXPLAINABLE):
+        prefix = 'EXPLAIN ' if conn.dialect.name == 'postgresql' else 'EXPLAIN QUERY PLAN '
+        dbapi_connection = conn.connection.dbapi_connection
+        # A failed statement aborts the whole PostgreSQL transaction; SQLite's does not
+        savepoint = conn.dialect.name == 'postgresql' and not getattr(dbapi_connection, 'autocommit', False)
+        cursor = dbapi_connection.cursor()
+        try:
+            if savepoint:
+                cursor.execute('SAVEPOINT slow_query_explain')
+            cursor.execute(prefix + statement, parameters)
+            plan = '\n'.join(str(row[-1]) for row in cursor.fetchall())
+        except Exception as e:
+            plan = f'(EXPLAIN failed: {e})'
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+        finally:
+            if savepoint:
+                cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+            cursor.close()
+
+    sql_log.warning('Slow query (%.1f ms)%s: %s\n%s', elapsed_ms,
+                    f' in {request.method} {request.path}' if has_request_context() else '',
+                    statement[:STATEMENT_LOG_LENGTH], plan or '')
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def _report_request(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+
+    total_ms = (time.perf_counter() - started) * 1000
+    queries = query_count()
+    db_ms = g.get('db_time_ms', 0.0)
+    slowest_ms = g.get('slowest_ms', 0.0)
+
+    if app.config.get('SERVER_TIMING_HEADER', True):
+        response.headers['Server-Timing'] = (f'db;dur={db_ms:.1f};desc="{queries} queries", '
+                                             f'db-slowest;dur={slowest_ms:.1f}, app;dur={total_ms:.1f}')
+
+    request_log.info(json.dumps({
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'duration_ms': round(total_ms, 1),
+        'queries': queries,
+        'db_ms': round(db_ms, 1),
+        'slowest_ms': round(slowest_ms, 1),
+        'slowest_sql': (g.get('slowest_statement') or '')[:STATEMENT_LOG_LENGTH] or None,
+        'user_id': session.get('user_id'),
+    }, ensure_ascii=False))
+    return response
+
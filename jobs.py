@@ -0,0 +1,345 @@
+"""Background jobs: a queue table and a local worker process.
+
+Heavy work (SAF-T files, long report periods, rollup rebuilds) is not done
+inside the web request. The route calls ``enqueue(kind, params, user_id)``,
+which stores a row in ``jobs`` and returns at once; the user is sent to the
+job status page. ``flask run-jobs`` runs the worker next to the web server:
+it claims pending rows with ``SELECT ... FOR UPDATE SKIP LOCKED`` (so several
+workers can share the queue), runs the handler registered for the job kind
+and stores its output file under ``JOBS_ARTIFACT_DIR`` for download.
+
+Handlers receive a ``JobContext`` with the job parameters, ``report()`` for
+progress updates and ``open_artifact()`` for the result file.
+"""
+import json
+import os
+import time
+import traceback
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy import func, update
+from werkzeug.utils import secure_filename
+
+from app import app, db
+from models import Job
+
+PENDING = 'pendente'
+RUNNING = 'em_curso'
+DONE = 'concluido'
+FAILED = 'erro'
+
+POLL_SECONDS = 2
+# A running job that has not reported progress for this long is assumed to
+# belong to a dead worker and is queued again (up to MAX_ATTEMPTS runs).
+STALE_MINUTES = 30
+MAX_ATTEMPTS = 3
+
+HANDLERS = {}
+
+
+def job_handler(kind):
+    """Register the decorated function as the handler of ``kind`` jobs"""
+    def decorator(func):
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+def enqueue(kind, params=None, user_id=None):
+    """Queue a job and return it (committed, so the worker can see it)"""
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind '{kind}'")
+    job = Job(kind=kind, params=json.dumps(params or {}), user_id=user_id,
+              status=PENDING, progress=0, message='Em fila de espera')
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def artifacts_dir():
+    path = app.config.get('JOBS_ARTIFACT_DIR') or os.path.join(app.instance_path, 'jobs')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class JobContext:
+    """What a handler gets: parameters, progress reporting and its output file"""
+
+    def __init__(self, job):
+        self.job_id = job.id
+        self.user_id = job.user_id
+        self.params = json.loads(job.params or '{}')
+        self.artifact = None
+
+    def report(self, progress, message=None):
+        """Record progress (0-100) on a connection of its own.
+
+        The handler's session may be in the middle of a server-side cursor,
+        so progress is never committed through it.
+        """
+        values = {'progress': max(0, min(int(progress), 100)), 'updated_at': datetime.utcnow()}
+        if message:
+            values['message'] = message[:255]
+        with db.engine.begin() as connection:
+            connection.execute(update(Job.__table__).where(Job.__table__.c.id == self.job_id).values(**values))
+
+    def open_artifact(self, filename, mimetype):
+        """Open the job's result file for binary writing"""
+        path = os.path.join(artifacts_dir(), f"{self.job_id}_{secure_filename(filename)}")
+        self.artifact = (path, filename, mimetype)
+        return open(path, 'wb')
+
+
+# =============== WORKER ===============
+
+def claim_next():
+    """Mark the oldest pending job as running and return it, or ``None``"""
+    while True:
+        candidate = db.session.query(Job.id).filter(Job.status == PENDING).order_by(Job.id).with_for_update(
+            skip_locked=True
+        ).first()
+        if candidate is None:
+            db.session.rollback()
+            return None
+
+        # Conditional update, so backends without SKIP LOCKED cannot hand the
+        # same job to two workers either
+        claimed = db.session.execute(
+            update(Job).where(Job.id == candidate.id, Job.status == PENDING).values(
+                status=RUNNING, started_at=datetime.utcnow(), updated_at=datetime.utcnow(),
+                attempts=Job.attempts + 1, message='Em curso'
+            )
+        ).rowcount
+        db.session.commit()
+        if claimed:
+            return db.session.get(Job, candidate.id)
+
+
+def run_job(job):
+    """Run one claimed job to completion, recording the outcome"""
+    context = JobContext(job)
+    job_id, kind = job.id, job.kind
+
+    try:
+        handler = HANDLERS.get(kind)
+        if handler is None:
+            raise ValueError(f"Unknown job kind '{kind}'")
+        message = handler(context)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        app.logger.exception("Job %s (%s) failed", job_id, kind)
+        _finish(job_id, status=FAILED, message='Ocorreu um erro', error=traceback.format_exc())
+        return False
+
+    values = {'status': DONE, 'progress': 100, 'message': (message or 'Concluído')[:255]}
+    if context.artifact:
+        values['artifact_path'], values['artifact_name'], values['artifact_mimetype'] = context.artifact
+    _finish(job_id, **values)
+    return True
+
+
+def _finish(job_id, **values):
+    now = datetime.utcnow()
+    db.session.execute(update(Job).where(Job.id == job_id).values(finished_at=now, updated_at=now, **values))
+    db.session.commit()
+
+
+def requeue_stale(minutes=STALE_MINUTES):
+    """Put back (or fail) running jobs whose worker stopped reporting"""
+    cutoff = datetime.utcnow() - timedelta(minutes=minutes)
+    stale = (Job.status == RUNNING) & (func.coalesce(Job.updated_at, Job.started_at) < cutoff)
+    db.session.execute(update(Job).where(stale, Job.attempts < MAX_ATTEMPTS).values(
+        status=PENDING, message='Em fila de espera'
+    ))
+    db.session.execute(update(Job).where(stale).values(
+        status=FAILED, message='Ocorreu um erro', error='Worker stopped while running the job',
+        finished_at=datetime.utcnow()
+    ))
+    db.session.commit()
+
+
+def work(once=False, poll=POLL_SECONDS):
+    """Process jobs until stopped (or until the queue is empty with ``once``)"""
+    requeue_stale()
+    while True:
+        job = claim_next()
+        if job is not None:
+            run_job(job)
+            continue
+        if once:
+            return
+        time.sleep(poll)
+
+
+@app.cli.command('run-jobs')
+@click.option('--once', is_flag=True, help='Sair quando a fila estiver vazia')
+@click.option('--poll', default=POLL_SECONDS, show_default=True, help='Segundos entre consultas à fila')
+def run_jobs_command(once, poll):
+    """Run the background job worker"""
+    click.echo('Worker de tarefas iniciado.')
+    work(once=once, poll=poll)
+
+
+# =============== HANDLERS ===============
+
+def _parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d') if value else None
+
+
+@job_handler('saft')
+def saft_job(context):
+    from models import Sale
+    from metrics import SAFT_DURATION
+    from saft import _period, generate_saft_xml
+
+    start_date = context.params['start_date']
+    end_date = context.params['end_date']
+    start_dt, end_dt = _parse_date(start_date), _parse_date(end_date)
+
+    total = db.session.query(func.count(Sale.id)).filter(*_period(Sale.sale_date, start_dt, end_dt)).scalar() or 0
+    context.report(5, 'A exportar ficheiros mestre')
+
+    def progress(done):
+        context.report(10 + 85 * done // max(total, 1), f'{done} de {total} documentos')
+
+    with SAFT_DURATION.time(), \
+            context.open_artifact(f"SAF-T_PT_{start_date}_{end_date}.xml", 'application/xml') as out:
+        for chunk in generate_saft_xml(start_dt, end_dt, progress):
+            out.write(chunk)
+
+    return f'Ficheiro SAF-T gerado ({total} documentos) para o período {start_date} a {end_date}.'
+
+
+@job_handler('report')
+def report_job(context):
+    from flask import render_template, session
+    from models import User
+    from simple_routes import report_context
+
+    period_days = int(context.params['period'])
+    context.report(10, 'A calcular o relatório')
+
+    # Rendered as the requesting user, so base.html shows the full layout
+    user = db.session.get(User, context.user_id) if context.user_id else None
+    with app.test_request_context('/reports', query_string={'period': period_days}):
+        if user is not None:
+            session.update(user_id=user.id, username=user.username,
+                           user_role=user.role, full_name=user.full_name)
+        html = render_template('reports.html', **report_context(period_days))
+
+    with context.open_artifact(f"relatorio_{period_days}_dias.html", 'text/html') as out:
+        out.write(html.encode('utf-8'))
+
+    return f'Relatório dos últimos {period_days} dias pronto.'
+
+
+@job_handler('rebuild_rollups')
+def rebuild_rollups_job(context):
+    from rollups import rebuild_all
+
+    context.report(10, 'A reconstruir resumos diários')
+    start, end = _parse_date(context.params.get('start')), _parse_date(context.params.get('end'))
+    rebuild_all(start.date() if start else None, end.date() if end else None)
+
+    return 'Resumos diários reconstruídos.'
+
+
+@job_handler('rebuild_costs')
+def rebuild_costs_job(context):
+    from costing import rebuild_costs
+
+    context.report(5, 'A recalcular custos médios')
+
+    def progress(done, total):
+        context.report(5 + 90 * done // max(total, 1), f'{done} de {total} movimentos')
+
+    moved = rebuild_costs(progress)
+    db.session.commit()
+
+    return f'Custos médios e custo das vendas recalculados ({moved} movimentos).'
+
+
+@job_handler('replenishment')
+def replenishment_job(context):
+    from replenishment import compute
+
+    context.report(5, 'A calcular a procura e os prazos de entrega')
+
+    def progress(done, total):
+        context.report(5 + 90 * done // max(total, 1), f'{done} de {total} produtos')
+
+    planned, to_order = compute(report=progress)
+    db.session.commit()
+
+    return f'{planned} produtos planeados, {to_order} a encomendar.'
+
+
+@job_handler('classify_products')
+def classify_products_job(context):
+    from classification import classify
+
+    context.report(10, 'A classificar os produtos')
+    counts = classify()
+    db.session.commit()
+
+    return f'{sum(counts.values())} produtos classificados (ABC/XYZ).'
+
+
+@job_handler('import')
+def import_job(context):
+    from cache import cache
+    from importer import IMPORTS, RowError, run_import, write_errors
+
+    path = context.params['path']
+    try:
+        entity = IMPORTS[context.params['name']]
+        context.report(5, 'A validar o ficheiro')
+
+        def progress(done, total):
+            context.report(5 + 80 * done // max(total, 1), f'{done} de {total} linhas validadas')
+
+        inserted, updated, errors = run_import(entity, path, progress, context.user_id)
+        db.session.commit()
+        cache.invalidate(entity.table.name)
+
+        if errors:
+            with context.open_artifact(f"erros_importacao_{entity.name}.csv", 'text/csv') as out:
+                write_errors(out, entity, errors)
+    except RowError as e:
+        db.session.rollback()
+        return str(e)
+    finally:
+        # The upload is removed whatever happens, a failed job included
+        if os.path.exists(path):
+            os.remove(path)
+
+    return (f'{inserted + updated} {entity.name} importados ({inserted} novos, {updated} atualizados), '
+            f'{len(errors)} linhas com erros.')
+
+
+@job_handler('reconcile_stock')
+def reconcile_stock_job(context):
+    import csv
+    import io
+    from ledger import reconcile
+
+    fix = bool(context.params.get('fix'))
+    context.report(10, 'A comparar o stock com o registo de movimentos')
+    drift = reconcile(fix=fix, user_id=context.user_id)
+    db.session.commit()
+
+    if drift:
+        with context.open_artifact('reconciliacao_stock.csv', 'text/csv') as out:
+            buffer = io.TextIOWrapper(out, encoding='utf-8-sig', newline='')
+            writer = csv.writer(buffer, delimiter=';')
+            writer.writerow(['Código', 'Produto', 'Stock', 'Registo', 'Último saldo', 'Diferença'])
+            for row in drift:
+                writer.writerow([row['code'], row['name'], row['stock'], row['ledger'], row['balance'], row['drift']])
+            buffer.flush()
+            buffer.detach()
+
+    if not drift:
+        return 'Stock e registo de movimentos coincidem.'
+    return f"{len(drift)} produtos com diferenças{' (acertados)' if fix else ''}."
@@ -0,0 +1,250 @@
+"""Stock ledger: point-in-time stock and valuation, snapshots and reconciliation.
+
+``inventory_movements`` is the ledger. Every stock change is a movement with
+a signed quantity, and ``balance`` is the product's stock right after it.
+stock.py writes both with the product row locked.
+
+``stock_snapshots`` holds the stock of each product at the end of a day.
+``flask stock-snapshot`` takes one, normally nightly from cron, from the
+previous snapshot plus that day's movements. Daily snapshots are kept for
+``DAILY_RETENTION_DAYS``, and after that only the month-end ones.
+
+``stock_at(at)`` answers "stock on date D" for one product or for all of
+them. It reads the latest snapshot before ``at`` and adds the movements
+since, which is at most a day of movements (a month for older dates).
+``valuation(at)`` values that stock at the unit cost recorded in the
+snapshot. Products without a snapshot row use their current unit cost (the
+weighted average of costing.py, or the purchase price before any receipt).
+
+A snapshot records the unit cost of the moment it is taken. The nightly
+snapshot therefore holds the cost at the end of the day, but the month-end
+snapshots that ``rebuild_ledger`` backfills are all valued at today's cost.
+The average is not kept per day, so past valuations of a rebuilt ledger
+show the stock quantities of the time at the current cost.
+
+``reconcile()`` compares each product's ``stock_quantity`` with the ledger
+(the running sum of its movements) and with the balance of its last
+movement. The ``reconcile_stock`` job and ``flask reconcile-stock`` use it.
+Drift comes from writes that bypassed stock.py, such as stock typed in
+before the ledger existed or fixes made in SQL. The drifting products are
+listed. With ``fix``, each one gets an ``ajuste`` movement that brings the
+ledger in line with ``stock_quantity``.
+
+On existing databases, ``flask upgrade-schema`` adds the ``balance`` column
+(see indexes.py), then ``flask rebuild-stock-ledger`` fills it with the
+running sums and takes the month-end snapshots.
+"""
+from datetime import date, datetime, time, timedelta
+
+import click
+from sqlalchemy import Date, and_, delete, func, insert, literal, select, union_all, update
+
+from app import app, db
+from models import Category, InventoryMovement, Product, StockSnapshot
+
+DAILY_RETENTION_DAYS = 35
+
+
+def _unit_cost():
+    return func.coalesce(func.nullif(Product.average_cost, 0), Product.purchase_price, 0)
+
+
+def _end_of(day):
+    """First moment after ``day``"""
+    return datetime.combine(day + timedelta(days=1), time())
+
+
+def latest_snapshot(at):
+    """Day of the newest snapshot that ends at or before ``at``, or ``None``"""
+    return db.session.execute(
+        select(func.max(StockSnapshot.day)).where(StockSnapshot.day < at.date())
+    ).scalar()
+
+
+def _stock(at, product_ids=None):
+    """(snapshot day, subquery of ``product_id, quantity`` at ``at``, nonzero only)"""
+    base = latest_snapshot(at)
+    movements = select(InventoryMovement.product_id, InventoryMovement.quantity).where(
+        InventoryMovement.created_at < at)
+    parts = []
+    if base is not None:
+        movements = movements.where(InventoryMovement.created_at >= _end_of(base))
+        parts.append(select(StockSnapshot.product_id, StockSnapshot.quantity).where(StockSnapshot.day == base))
+    parts.append(movements)
+    if product_ids is not None:
+        parts = [part.where(part.selected_columns.product_id.in_(product_ids)) for part in parts]
+
+    rows = union_all(*parts).subquery()
+    stock = select(rows.c.product_id, func.sum(rows.c.quantity).label('quantity')).group_by(
+        rows.c.product_id).having(func.sum(rows.c.quantity) != 0)
+    return base, stock.subquery()
+
+
+def stock_at(at=None, product_ids=None):
+    """{product_id: quantity} at ``at`` (default now); products without stock are left out"""
+    _, stock = _stock(at or datetime.now(), product_ids)
+    return dict(db.session.execute(select(stock.c.product_id, stock.c.quantity)).all())
+
+
+def valuation(at=None, product_ids=None):
+    """Stock at ``at`` by product, with unit cost and value, ordered by code"""
+    at = at or datetime.now()
+    base, stock = _stock(at, product_ids)
+    unit_cost = func.coalesce(StockSnapshot.unit_cost, _unit_cost())
+    return db.session.execute(
+        select(Product.id, Product.code, Product.name, Category.name.label('category'),
+               stock.c.quantity, unit_cost.label('unit_cost'), (stock.c.quantity * unit_cost).label('value'))
+        .join(stock, stock.c.product_id == Product.id)
+        .outerjoin(Category, Product.category_id == Category.id)
+        .outerjoin(StockSnapshot, and_(StockSnapshot.product_id == Product.id, StockSnapshot.day == base))
+        .order_by(Product.code)
+    ).all()
+
+
+def valuation_by_category(at=None):
+    """[(category, products, units, value)] at ``at``, largest value first"""
+    at = at or datetime.now()
+    base, stock = _stock(at)
+    unit_cost = func.coalesce(StockSnapshot.unit_cost, _unit_cost())
+    value = func.sum(stock.c.quantity * unit_cost)
+    return db.session.execute(
+        select(func.coalesce(Category.name, ''), func.count(), func.sum(stock.c.quantity), value)
+        .select_from(stock)
+        .join(Product, stock.c.product_id == Product.id)
+        .outerjoin(Category, Product.category_id == Category.id)
+        .outerjoin(StockSnapshot, and_(StockSnapshot.product_id == Product.id, StockSnapshot.day == base))
+        .group_by(Category.name)
+        .order_by(value.desc())
+    ).all()
+
+
+# =============== SNAPSHOTS ===============
+
+def take_snapshot(day):
+    """(Re)build the snapshot of the end of ``day``; returns its number of rows
+
+    The unit cost is the product's current one, whatever ``day`` is.
+    """
+    db.session.execute(delete(StockSnapshot).where(StockSnapshot.day == day))
+    _, stock = _stock(_end_of(day))
+    db.session.execute(insert(StockSnapshot).from_select(
+        ['day', 'product_id', 'quantity', 'unit_cost', 'created_at'],
+        select(literal(day, Date), stock.c.product_id, stock.c.quantity,
+               _unit_cost(), literal(datetime.utcnow()))
+        .join(Product, Product.id == stock.c.product_id)
+    ))
+    return db.session.execute(select(func.count()).where(StockSnapshot.day == day)).scalar()
+
+
+def prune_snapshots(today=None):
+    """Drop daily snapshots older than the retention, except month-ends"""
+    cutoff = (today or date.today()) - timedelta(days=DAILY_RETENTION_DAYS)
+    days = db.session.execute(select(StockSnapshot.day).where(StockSnapshot.day < cutoff).distinct()).scalars()
+    stale = [day for day in days if (day + timedelta(days=1)).day != 1]
+    if stale:
+        db.session.execute(delete(StockSnapshot).where(StockSnapshot.day.in_(stale)))
+    return len(stale)
+
+
+@app.cli.command('stock-snapshot')
+@click.option('--day', type=click.DateTime(formats=['%Y-%m-%d']), help='Dia (YYYY-MM-DD); por omissão, ontem')
+def stock_snapshot_command(day):
+    """Take the end-of-day stock snapshot (run nightly)"""
+    day = day.date() if day else date.today() - timedelta(days=1)
+    rows = take_snapshot(day)
+    pruned = prune_snapshots()
+    db.session.commit()
+    click.echo(f'Snapshot de {day}: {rows} produtos com stock ({pruned} snapshots antigos removidos).')
+
+
+def rebuild_ledger():
+    """Recompute every movement's balance and the month-end snapshots (valued at the current cost)"""
+    movements = InventoryMovement.__table__
+    running = select(movements.c.id, func.sum(movements.c.quantity).over(
+        partition_by=movements.c.product_id, order_by=(movements.c.created_at, movements.c.id)
+    ).label('balance')).subquery()
+    db.session.execute(update(movements).where(movements.c.id == running.c.id).values(balance=running.c.balance))
+
+    db.session.execute(delete(StockSnapshot))
+    first = db.session.execute(select(func.min(InventoryMovement.created_at))).scalar()
+    if first is not None:
+        yesterday = date.today() - timedelta(days=1)
+        month = first.date().replace(day=1)
+        while True:
+            month = (month + timedelta(days=32)).replace(day=1)
+            month_end = month - timedelta(days=1)
+            if month_end >= yesterday:
+                break
+            take_snapshot(month_end)
+        take_snapshot(yesterday)
+    db.session.commit()
+
+
+@app.cli.command('rebuild-stock-ledger')
+def rebuild_stock_ledger_command():
+    """Backfill movement balances and stock snapshots"""
+    rebuild_ledger()
+    click.echo('Saldos dos movimentos e snapshots de stock reconstruídos.')
+
+
+# =============== RECONCILIATION ===============
+
+def reconcile(fix=False, user_id=None):
+    """Products whose stock, ledger sum and last balance disagree
+
+    Returns dicts with ``id``, ``code``, ``name``, ``stock``, ``ledger``,
+    ``balance`` and ``drift`` (stock minus ledger). With ``fix`` an
+    ``ajuste`` movement of ``drift`` units is posted for each of them. The
+    caller commits.
+    """
+    from stock import lock_products
+
+    ledger = stock_at(datetime.now() + timedelta(seconds=1))
+    last = select(func.max(InventoryMovement.id).label('id')).group_by(InventoryMovement.product_id).subquery()
+    balances = dict(db.session.execute(
+        select(InventoryMovement.product_id, InventoryMovement.balance).join(last, last.c.id == InventoryMovement.id)
+    ).all())
+
+    drift = []
+    rows = db.session.execute(select(Product.id, Product.code, Product.name, Product.stock_quantity)
+                              .order_by(Product.code))
+    for product_id, code, name, stock in rows:
+        stock = stock or 0
+        in_ledger = ledger.get(product_id, 0)
+        balance = balances.get(product_id)
+        if stock != in_ledger or (balance is not None and balance != stock):
+            drift.append({'id': product_id, 'code': code, 'name': name, 'stock': stock,
+                          'ledger': in_ledger, 'balance': balance, 'drift': stock - in_ledger})
+
+    if fix and drift:
+        # Lock, then compare again: a sale may have posted in between
+        products = lock_products([row['id'] for row in drift])
+        ledger = stock_at(datetime.now() + timedelta(seconds=1), list(products))
+        now = datetime.now()
+        adjustments = []
+        for product_id, product in products.items():
+            stock = product.stock_quantity or 0
+            difference = stock - ledger.get(product_id, 0)
+            # A zero adjustment still resets a wrong running balance
+            if difference or balances.get(product_id) not in (None, stock):
+                adjustments.append(InventoryMovement(
+                    product_id=product_id, movement_type='ajuste', quantity=difference, balance=stock,
+                    reference_type='reconciliacao', notes='Acerto da reconciliação de stock',
+                    user_id=user_id, created_at=now))
+        db.session.add_all(adjustments)
+    return drift
+
+
+@app.cli.command('reconcile-stock')
+@click.option('--fix', is_flag=True, help='Acertar o registo de movimentos pelo stock dos produtos')
+@click.option('--user-id', type=int, help='Utilizador dos movimentos de acerto (com --fix)')
+def reconcile_stock_command(fix, user_id):
+    """Flag products whose stock drifted from the stock ledger"""
+    if fix and not user_id:
+        raise click.UsageError('--fix requer --user-id')
+    drift = reconcile(fix=fix, user_id=user_id)
+    for row in drift:
+        click.echo(f"{row['code']}: stock {row['stock']}, registo {row['ledger']}, "
+                   f"último saldo {row['balance']}, diferença {row['drift']}")
+    db.session.commit()
+    click.echo(f"{len(drift)} produtos com diferenças{' (acertados)' if fix and drift else ''}.")
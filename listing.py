@@ -0,0 +1,390 @@
+"""Shared listing engine for the list pages (products, customers, sales, ...).
+
+Every list page is described by a ``Listing``: the model, the columns it may be
+sorted by, the filters it accepts from the query string and the rows it always
+hides. ``Listing.page(request.args)`` then runs the filtering, sorting and
+keyset (seek) pagination in SQL and returns a ``ListingPage`` that the
+templates render and that ``utils.pagination_info`` understands.
+"""
+import base64
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from flask import current_app
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.orm import configure_mappers, joinedload
+
+from app import db
+from classification import CLASSES
+from models import Customer, InventoryMovement, Product, ProductClassification, Purchase, Sale, Supplier
+from utils import pagination_info, safe_int
+
+DEFAULT_PER_PAGE = 50
+MAX_PER_PAGE = 200
+
+# Above this many (estimated) rows the footer shows the planner estimate
+# instead of running a full COUNT(*). Overridable via app.config.
+EXACT_COUNT_LIMIT = 10000
+
+
+# =============== FILTERS ===============
+
+def equals(column, convert=safe_int):
+    """Filter ``column == value`` (value converted with ``convert``)"""
+    def build(value):
+        value = convert(value)
+        return column == value if value not in (None, '') else None
+    return build
+
+
+def date_from(column):
+    """Filter ``column >= value`` for a YYYY-MM-DD value"""
+    def build(value):
+        parsed = _parse_date(value)
+        return column >= parsed if parsed else None
+    return build
+
+
+def date_to(column):
+    """Filter ``column < value + 1 day`` for a YYYY-MM-DD value (inclusive end)"""
+    def build(value):
+        parsed = _parse_date(value)
+        if not parsed:
+            return None
+        return column < datetime.fromordinal(parsed.toordinal() + 1)
+    return build
+
+
+def in_class(id_column, key_column, class_column, classes):
+    """Filter ``id_column IN (SELECT key_column WHERE class_column = value)`` for one of ``classes``"""
+    def build(value):
+        value = value.strip().upper()
+        if value not in classes:
+            return None
+        return id_column.in_(select(key_column).where(class_column == value))
+    return build
+
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+
+# =============== CURSORS ===============
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    if isinstance(value, date):
+        return {'d': value.isoformat()}
+    if isinstance(value, Decimal):
+        return {'dec': str(value)}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        if 'dt' in value:
+            return datetime.fromisoformat(value['dt'])
+        if 'd' in value:
+            return date.fromisoformat(value['d'])
+        if 'dec' in value:
+            return Decimal(value['dec'])
+    return value
+
+
+def encode_cursor(sort_value, row_id):
+    """Encode the (sort value, id) of a boundary row as an URL-safe token"""
+    payload = json.dumps([_encode_value(sort_value), row_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Decode a cursor token, returning ``None`` if it was tampered with"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return _decode_value(sort_value), int(row_id)
+    except (ValueError, TypeError):
+        return None
+
+
+# =============== LISTING ===============
+
+class ListingPage:
+    """One page of a listing, shaped like a Flask-SQLAlchemy pagination"""
+
+    def __init__(self, data, total, total_is_estimate, page, per_page,
+                 next_cursor, prev_cursor, sort, args):
+        self.data = data
+        self.total = total
+        self.total_is_estimate = total_is_estimate
+        self.page = page
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.sort = sort
+        self._args = args
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    @property
+    def next_args(self):
+        """Query-string arguments for the next page link"""
+        return self._link_args(after=self.next_cursor, page=self.page + 1)
+
+    @property
+    def prev_args(self):
+        """Query-string arguments for the previous page link"""
+        if self.page <= 2:
+            return self._link_args(page=1)
+        return self._link_args(before=self.prev_cursor, page=self.page - 1)
+
+    @property
+    def info(self):
+        return pagination_info(self)
+
+    def _link_args(self, **extra):
+        args = {k: v for k, v in self._args.items() if k not in ('after', 'before', 'page')}
+        args.update({k: v for k, v in extra.items() if v is not None})
+        return args
+
+
+class Listing:
+    """Declarative description of a list page.
+
+    ``sort_keys`` maps the public sort names to columns; those columns must be
+    NOT NULL so that ``(column, id)`` is a strict total order for the keyset
+    seek (older databases get the constraint from ``flask upgrade-schema``). ``filters`` maps query-string parameters to criterion builders (see
+    ``equals``/``date_from``/``date_to``). ``search_columns`` are matched with
+    ILIKE against the ``search`` parameter. ``options`` is the relationship
+    loading plan (``joinedload``/``selectinload``) for whatever the template
+    walks per row, so rendering a page never triggers lazy loads.
+    """
+
+    def __init__(self, model, sort_keys, default_sort, filters=None,
+                 search_columns=(), base_filters=(), options=(),
+                 per_page=DEFAULT_PER_PAGE):
+        self.model = model
+        self.sort_keys = sort_keys
+        self.default_sort = default_sort
+        self.filters = filters or {}
+        self.search_columns = search_columns
+        self.base_filters = base_filters
+        self.options = options
+        self.per_page = per_page
+
+    def criteria(self, args):
+        """SQL criteria for the given query-string arguments"""
+        criteria = list(self.base_filters)
+
+        search = (args.get('search') or '').strip()
+        if search and self.search_columns:
+            pattern = f"%{search}%"
+            criteria.append(or_(*[column.ilike(pattern) for column in self.search_columns]))
+
+        for name, build in self.filters.items():
+            value = args.get(name)
+            if value not in (None, ''):
+                criterion = build(value)
+                if criterion is not None:
+                    criteria.append(criterion)
+
+        return criteria
+
+    def _sort(self, args):
+        requested = args.get('sort') or self.default_sort
+        descending = requested.startswith('-')
+        name = requested.lstrip('-')
+        if name not in self.sort_keys:
+            requested = self.default_sort
+            descending = requested.startswith('-')
+            name = requested.lstrip('-')
+        return requested, self.sort_keys[name], descending
+
+    def _query(self, args, per_page):
+        """(query, criteria, sort, column, boundary, backwards) of the page ``args`` asks for"""
+        sort, column, descending = self._sort(args)
+        id_column = self.model.id
+        criteria = self.criteria(args)
+
+        after = decode_cursor(args['after']) if args.get('after') else None
+        before = decode_cursor(args['before']) if args.get('before') else None
+
+        # Walking backwards is a forward seek over the reversed order
+        backwards = before is not None and after is None
+        seek_desc = descending != backwards
+
+        query = self.model.query
+        if self.options:
+            query = query.options(*self.options)
+        if criteria:
+            query = query.filter(*criteria)
+
+        boundary = before if backwards else after
+        if boundary is not None:
+            value, row_id = boundary
+            if seek_desc:
+                query = query.filter(or_(column < value, and_(column == value, id_column < row_id)))
+            else:
+                query = query.filter(or_(column > value, and_(column == value, id_column > row_id)))
+
+        if seek_desc:
+            query = query.order_by(column.desc(), id_column.desc())
+        else:
+            query = query.order_by(column.asc(), id_column.asc())
+        return query.limit(per_page + 1), criteria, sort, column, boundary, backwards
+
+    def statement(self, args, per_page=None):
+        """The SELECT that ``page(args)`` runs for its rows (``flask check-indexes`` plans it)"""
+        return self._query(args, per_page or self.per_page)[0].statement
+
+    def page(self, args, per_page=None):
+        """Run the listing for ``args`` (usually ``request.args``)"""
+        per_page = min(max(safe_int(args.get('per_page'), per_page or self.per_page), 1), MAX_PER_PAGE)
+        page = max(safe_int(args.get('page'), 1), 1)
+        query, criteria, sort, column, boundary, backwards = self._query(args, per_page)
+        if boundary is None:
+            page = 1
+
+        rows = query.all()
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+        if backwards:
+            rows.reverse()
+
+        sort_attr = column.key
+        next_cursor = prev_cursor = None
+        if rows:
+            first, last = rows[0], rows[-1]
+            if has_more or backwards:
+                next_cursor = encode_cursor(getattr(last, sort_attr), last.id)
+            if boundary is not None and (has_more or not backwards):
+                prev_cursor = encode_cursor(getattr(first, sort_attr), first.id)
+
+        total, estimated = self.count(criteria)
+        return ListingPage(rows, total, estimated, page, per_page,
+                           next_cursor, prev_cursor, sort, args)
+
+    def count(self, criteria):
+        """Return ``(total, is_estimate)`` for the filtered listing.
+
+        On PostgreSQL the planner's row estimate is read first; only when it
+        is below ``EXACT_COUNT_LIMIT`` is a real COUNT(*) executed.
+        """
+        stmt = select(func.count()).select_from(self.model)
+        if criteria:
+            stmt = stmt.where(*criteria)
+
+        limit = current_app.config.get('LISTING_EXACT_COUNT_LIMIT', EXACT_COUNT_LIMIT)
+        estimate = _planner_estimate(select(self.model.id).where(*criteria))
+        if estimate is not None and estimate >= limit:
+            return estimate, True
+
+        return db.session.execute(stmt).scalar() or 0, False
+
+
+def _planner_estimate(stmt):
+    """Row estimate from ``EXPLAIN`` (PostgreSQL only, else ``None``)"""
+    bind = db.session.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return None
+    try:
+        compiled = stmt.compile(dialect=bind.dialect)
+        connection = db.session.connection()
+        plan = connection.exec_driver_sql(
+            'EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params
+        ).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    except Exception as e:
+        current_app.logger.warning(f"Listing count estimate failed: {e}")
+        return None
+
+
+# =============== LIST PAGES ===============
+
+# The loading plans below name backref attributes (``Product.category``),
+# which only exist once the mappers are configured. Normally a first query
+# does that, but this module may be imported before any query ran.
+configure_mappers()
+
+PRODUCTS = Listing(
+    Product,
+    sort_keys={'name': Product.name, 'code': Product.code,
+               'price': Product.sale_price, 'created': Product.created_at},
+    default_sort='name',
+    filters={'category': equals(Product.category_id),
+             'supplier': equals(Product.supplier_id),
+             'abc': in_class(Product.id, ProductClassification.product_id,
+                             ProductClassification.abc_class, CLASSES['abc']),
+             'xyz': in_class(Product.id, ProductClassification.product_id,
+                             ProductClassification.xyz_class, CLASSES['xyz'])},
+    search_columns=(Product.name, Product.code),
+    base_filters=(Product.is_active == True,),  # noqa: E712
+    options=(joinedload(Product.category), joinedload(Product.classification)),
+)
+
+CUSTOMERS = Listing(
+    Customer,
+    sort_keys={'name': Customer.name, 'created': Customer.created_at},
+    default_sort='name',
+    filters={'type': equals(Customer.customer_type, str)},
+    search_columns=(Customer.name, Customer.email, Customer.tax_number),
+    base_filters=(Customer.is_active == True,),  # noqa: E712
+)
+
+SUPPLIERS = Listing(
+    Supplier,
+    sort_keys={'name': Supplier.name, 'created': Supplier.created_at},
+    default_sort='name',
+    search_columns=(Supplier.name, Supplier.email, Supplier.tax_number),
+    base_filters=(Supplier.is_active == True,),  # noqa: E712
+)
+
+SALES = Listing(
+    Sale,
+    sort_keys={'date': Sale.sale_date, 'invoice': Sale.invoice_number,
+               'total': Sale.total_amount},
+    default_sort='-date',
+    filters={'customer': equals(Sale.customer_id),
+             'status': equals(Sale.status, str),
+             'date_from': date_from(Sale.sale_date),
+             'date_to': date_to(Sale.sale_date)},
+    search_columns=(Sale.invoice_number,),
+    options=(joinedload(Sale.customer),),
+)
+
+PURCHASES = Listing(
+    Purchase,
+    sort_keys={'date': Purchase.purchase_date, 'invoice': Purchase.invoice_number,
+               'total': Purchase.total_amount},
+    default_sort='-date',
+    filters={'supplier': equals(Purchase.supplier_id),
+             'status': equals(Purchase.status, str),
+             'date_from': date_from(Purchase.purchase_date),
+             'date_to': date_to(Purchase.purchase_date)},
+    search_columns=(Purchase.invoice_number,),
+    options=(joinedload(Purchase.supplier),),
+)
+
+INVENTORY = Listing(
+    InventoryMovement,
+    sort_keys={'date': InventoryMovement.created_at},
+    default_sort='-date',
+    filters={'product': equals(InventoryMovement.product_id),
+             'type': equals(InventoryMovement.movement_type, str),
+             'date_from': date_from(InventoryMovement.created_at),
+             'date_to': date_to(InventoryMovement.created_at)},
+    options=(joinedload(InventoryMovement.product), joinedload(InventoryMovement.user)),
+)
@@ -0,0 +1,128 @@
+"""Prometheus metrics at ``/metrics``.
+
+Exposed series:
+
+* ``gestvendas_http_request_duration_seconds{endpoint,method}`` histogram
+  and ``gestvendas_http_requests_total{endpoint,method,status}``;
+* ``gestvendas_http_requests_in_progress``;
+* ``gestvendas_db_pool_checked_out`` / ``gestvendas_db_pool_overflow`` for
+  the engine's connection pool;
+* ``gestvendas_cache_requests_total{cache,result}`` (hit ratio =
+  hits / all);
+* ``gestvendas_sales_posted_total`` and ``gestvendas_sales_amount_total``
+  (``rate()`` gives sales per second);
+* ``gestvendas_saft_generation_seconds`` histogram.
+
+Under gunicorn every worker has its own memory. Set
+``PROMETHEUS_MULTIPROC_DIR`` to an empty directory shared by all workers and
+the job worker. Each process then writes its samples to files there, and
+``/metrics`` adds them up, whichever worker answers the scrape. The cleanup
+hooks are in ``gunicorn.conf.py``. Without the variable the metrics are those
+of the answering process only, which is fine for ``flask run``.
+
+Set ``METRICS_TOKEN`` to require ``Authorization: Bearer <token>`` on the
+endpoint.
+"""
+import os
+import time
+
+from flask import Response, abort, g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge,
+                               Histogram, generate_latest, multiprocess)
+from sqlalchemy import event
+
+from app import app, db
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SAFT_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+REQUEST_LATENCY = Histogram('gestvendas_http_request_duration_seconds', 'Request latency by endpoint',
+                            ['endpoint', 'method'], buckets=LATENCY_BUCKETS)
+REQUESTS = Counter('gestvendas_http_requests_total', 'Requests by endpoint and status',
+                   ['endpoint', 'method', 'status'])
+IN_PROGRESS = Gauge('gestvendas_http_requests_in_progress', 'Requests being served',
+                    multiprocess_mode='livesum')
+POOL_CHECKED_OUT = Gauge('gestvendas_db_pool_checked_out', 'Database connections in use',
+                         multiprocess_mode='livesum')
+POOL_OVERFLOW = Gauge('gestvendas_db_pool_overflow', 'Database connections open beyond pool_size',
+                      multiprocess_mode='livesum')
+CACHE_REQUESTS = Counter('gestvendas_cache_requests_total', 'Cache lookups by result (hit/miss)',
+                         ['cache', 'result'])
+SALES_POSTED = Counter('gestvendas_sales_posted', 'Sales posted')
+SALES_AMOUNT = Counter('gestvendas_sales_amount', 'Total amount of posted sales (EUR)')
+SAFT_DURATION = Histogram('gestvendas_saft_generation_seconds', 'SAF-T file generation time',
+                          buckets=SAFT_BUCKETS)
+
+
+# =============== REQUESTS ===============
+
+def _endpoint():
+    return request.endpoint or ('not_found' if request.url_rule is None else 'unknown')
+
+
+@app.before_request
+def _track_request():
+    if request.endpoint in ('metrics', 'static'):
+        return
+    g.metrics_started = time.perf_counter()
+    IN_PROGRESS.inc()
+
+
+@app.after_request
+def _record_request(response):
+    started = g.get('metrics_started')
+    if started is not None:
+        endpoint = _endpoint()
+        REQUEST_LATENCY.labels(endpoint, request.method).observe(time.perf_counter() - started)
+        REQUESTS.labels(endpoint, request.method, str(response.status_code)).inc()
+    return response
+
+
+@app.teardown_request
+def _untrack_request(exc=None):
+    if g.pop('metrics_started', None) is not None:
+        IN_PROGRESS.dec()
+
+
+# =============== DATABASE POOL ===============
+
+with app.app_context():
+    _engine = db.engine
+
+
+def _pool_usage(*args):
+    pool = _engine.pool
+    if hasattr(pool, 'checkedout'):
+        POOL_CHECKED_OUT.set(pool.checkedout())
+        POOL_OVERFLOW.set(max(pool.overflow(), 0))
+
+
+event.listen(_engine.pool, 'checkout', _pool_usage)
+event.listen(_engine.pool, 'checkin', _pool_usage)
+
+
+# =============== BUSINESS ===============
+
+def sale_posted(sale):
+    SALES_POSTED.inc()
+    SALES_AMOUNT.inc(float(sale.total_amount or 0))
+
+
+def cache_lookup(cache, hit):
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+# =============== ENDPOINT ===============
+
+@app.route('/metrics')
+def metrics():
+    token = app.config.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(401)
+
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
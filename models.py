@@ -1,7 +1,7 @@
 from datetime import datetime
 from app import db
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import func
+from sqlalchemy import DDL, event, func
 
 class User(db.Model):
     __tablename__ = 'users'
@@ -50,7 +50,7 @@ class Supplier(db.Model):
     country = db.Column(db.String(100), default='Portugal')
     tax_number = db.Column(db.String(50))
     is_active = db.Column(db.Boolean, default=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relationships
@@ -71,7 +71,7 @@ class Customer(db.Model):
     tax_number = db.Column(db.String(50))
     customer_type = db.Column(db.String(50), default='particular')  # particular, empresa
     is_active = db.Column(db.Boolean, default=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relationships
@@ -93,8 +93,9 @@ class Product(db.Model):
     min_stock = db.Column(db.Integer, default=5)
     max_stock = db.Column(db.Integer, default=100)
     tax_rate = db.Column(db.Numeric(5, 2), default=23.00)  # IVA em Portugal
+    average_cost = db.Column(db.Numeric(12, 4), default=0)  # weighted-average unit cost (see costing.py)
     is_active = db.Column(db.Boolean, default=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relationships
@@ -102,10 +103,16 @@ class Product(db.Model):
     purchase_items = db.relationship('PurchaseItem', backref='product', lazy=True)
     inventory_movements = db.relationship('InventoryMovement', backref='product', lazy=True)
 
+    @property
+    def unit_cost(self):
+        """Average cost, or the purchase price until the product is first received"""
+        return self.average_cost if self.average_cost and self.average_cost > 0 else self.purchase_price
+
     @property
     def profit_margin(self):
-        if self.purchase_price and self.purchase_price > 0:
-            return ((self.sale_price - self.purchase_price) / self.purchase_price) * 100
+        cost = self.unit_cost
+        if cost and cost > 0:
+            return ((self.sale_price - cost) / cost) * 100
         return 0
 
     @property
@@ -123,11 +130,11 @@ class Sale(db.Model):
     invoice_number = db.Column(db.String(50), unique=True, nullable=False)
     customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    sale_date = db.Column(db.DateTime, default=datetime.utcnow)
+    sale_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     due_date = db.Column(db.DateTime)
     subtotal = db.Column(db.Numeric(10, 2), default=0.00)
     tax_amount = db.Column(db.Numeric(10, 2), default=0.00)
-    total_amount = db.Column(db.Numeric(10, 2), default=0.00)
+    total_amount = db.Column(db.Numeric(10, 2), nullable=False, default=0.00)
     discount = db.Column(db.Numeric(10, 2), default=0.00)
     status = db.Column(db.String(50), default='pendente')  # pendente, pago, cancelado
     payment_method = db.Column(db.String(50))  # dinheiro, cartao, transferencia
@@ -149,6 +156,8 @@ class SaleItem(db.Model):
     unit_price = db.Column(db.Numeric(10, 2), nullable=False)
     tax_rate = db.Column(db.Numeric(5, 2), default=23.00)
     total_price = db.Column(db.Numeric(10, 2), nullable=False)
+    unit_cost = db.Column(db.Numeric(12, 4))  # product's average cost when sold
+    cost_amount = db.Column(db.Numeric(10, 2))  # cost of goods sold (quantity x unit_cost)
 
 class Purchase(db.Model):
     __tablename__ = 'purchases'
@@ -157,12 +166,12 @@ class Purchase(db.Model):
     invoice_number = db.Column(db.String(50), unique=True, nullable=False)
     supplier_id = db.Column(db.Integer, db.ForeignKey('suppliers.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    purchase_date = db.Column(db.DateTime, default=datetime.utcnow)
+    purchase_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     due_date = db.Column(db.DateTime)
     subtotal = db.Column(db.Numeric(10, 2), default=0.00)
     tax_amount = db.Column(db.Numeric(10, 2), default=0.00)
-    total_amount = db.Column(db.Numeric(10, 2), default=0.00)
-    status = db.Column(db.String(50), default='pendente')  # pendente, recebido, cancelado
+    total_amount = db.Column(db.Numeric(10, 2), nullable=False, default=0.00)
+    status = db.Column(db.String(50), default='pendente')  # rascunho (draft order, not in stock yet), pendente, recebido, cancelado
     payment_method = db.Column(db.String(50))
     notes = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -193,8 +202,9 @@ class InventoryMovement(db.Model):
     reference_type = db.Column(db.String(50))  # venda, compra, ajuste
     reference_id = db.Column(db.Integer)
     notes = db.Column(db.Text)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    balance = db.Column(db.Integer)  # product stock after this movement (see ledger.py)
     
     # Relationships
     user = db.relationship('User', backref='inventory_movements')
@@ -209,3 +219,168 @@ class Configuration(db.Model):
     data_type = db.Column(db.String(50), default='string')  # string, integer, boolean, decimal
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class DailySalesSummary(db.Model):
+    __tablename__ = 'daily_sales_summary'
+    
+    # category_id 0 holds the document totals of the day (one count per sale);
+    # other rows hold the line totals of that category.
+    day = db.Column(db.Date, primary_key=True)
+    category_id = db.Column(db.Integer, primary_key=True, default=0)
+    payment_method = db.Column(db.String(50), primary_key=True, default='')
+    user_id = db.Column(db.Integer, primary_key=True)
+    document_count = db.Column(db.Integer, nullable=False, default=0)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    subtotal = db.Column(db.Numeric(14, 2), nullable=False, default=0.00)
+    tax_amount = db.Column(db.Numeric(14, 2), nullable=False, default=0.00)
+    total_amount = db.Column(db.Numeric(14, 2), nullable=False, default=0.00)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class DailyPurchaseSummary(db.Model):
+    __tablename__ = 'daily_purchase_summary'
+    
+    # Same layout as DailySalesSummary, fed by purchases
+    day = db.Column(db.Date, primary_key=True)
+    category_id = db.Column(db.Integer, primary_key=True, default=0)
+    payment_method = db.Column(db.String(50), primary_key=True, default='')
+    user_id = db.Column(db.Integer, primary_key=True)
+    document_count = db.Column(db.Integer, nullable=False, default=0)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    subtotal = db.Column(db.Numeric(14, 2), nullable=False, default=0.00)
+    tax_amount = db.Column(db.Numeric(14, 2), nullable=False, default=0.00)
+    total_amount = db.Column(db.Numeric(14, 2), nullable=False, default=0.00)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    
+    # Background work queue, processed by `flask run-jobs` (see jobs.py)
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pendente', index=True)  # pendente, em_curso, concluido, erro
+    params = db.Column(db.Text)  # JSON
+    progress = db.Column(db.Integer, nullable=False, default=0)  # 0-100
+    message = db.Column(db.String(255))
+    error = db.Column(db.Text)
+    artifact_path = db.Column(db.String(500))
+    artifact_name = db.Column(db.String(255))
+    artifact_mimetype = db.Column(db.String(100))
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # Relationships
+    user = db.relationship('User', backref='jobs')
+
+class DocumentSeries(db.Model):
+    __tablename__ = 'document_series'
+    __table_args__ = (db.UniqueConstraint('doc_type', 'series', 'year', name='uq_document_series'),)
+    
+    # One counter per document type, series and year (see numbering.py)
+    id = db.Column(db.Integer, primary_key=True)
+    doc_type = db.Column(db.String(5), nullable=False)  # FT (venda), CP (compra)
+    series = db.Column(db.String(20), nullable=False)  # GV, or the terminal code
+    year = db.Column(db.Integer, nullable=False)
+    next_number = db.Column(db.Integer, nullable=False, default=1)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class DocumentSeriesBlock(db.Model):
+    __tablename__ = 'document_series_blocks'
+    
+    # Number ranges handed to offline terminals
+    id = db.Column(db.Integer, primary_key=True)
+    series_id = db.Column(db.Integer, db.ForeignKey('document_series.id'), nullable=False)
+    first_number = db.Column(db.Integer, nullable=False)
+    last_number = db.Column(db.Integer, nullable=False)
+    terminal = db.Column(db.String(20))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    reserved_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    document_series = db.relationship('DocumentSeries', backref='blocks')
+
+class StockSnapshot(db.Model):
+    __tablename__ = 'stock_snapshots'
+    
+    # Stock of each product at the end of a day (see ledger.py); products
+    # without a row had no stock that day
+    day = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    unit_cost = db.Column(db.Numeric(12, 4), nullable=False, default=0)  # same precision as average_cost
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ReplenishmentSuggestion(db.Model):
+    __tablename__ = 'replenishment_suggestions'
+    
+    # Reorder point and suggested order of each active product, recomputed
+    # nightly from the sales and purchase history (see replenishment.py)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), primary_key=True)
+    supplier_id = db.Column(db.Integer, db.ForeignKey('suppliers.id'))
+    daily_demand = db.Column(db.Numeric(12, 4), nullable=False, default=0)
+    demand_std = db.Column(db.Numeric(12, 4), nullable=False, default=0)
+    lead_time_days = db.Column(db.Numeric(6, 2), nullable=False)
+    safety_stock = db.Column(db.Integer, nullable=False, default=0)
+    reorder_point = db.Column(db.Integer, nullable=False)
+    order_up_to = db.Column(db.Integer)  # stock level an order brings the product back to
+    stock_quantity = db.Column(db.Integer, nullable=False, default=0)  # when computed
+    suggested_quantity = db.Column(db.Integer, nullable=False, default=0)
+    computed_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    product = db.relationship('Product', backref=db.backref('replenishment', uselist=False))
+    supplier = db.relationship('Supplier')
+
+class ProductClassification(db.Model):
+    __tablename__ = 'product_classifications'
+    
+    # ABC (revenue) and XYZ (demand variability) class of each active
+    # product, recomputed nightly from the sales (see classification.py)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), primary_key=True)
+    revenue = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    cumulative_share = db.Column(db.Numeric(7, 4), nullable=False, default=0)  # of the revenue, up to this product
+    abc_class = db.Column(db.String(1), nullable=False)
+    demand_cv = db.Column(db.Numeric(10, 4))  # weekly coefficient of variation; NULL without sales
+    xyz_class = db.Column(db.String(1), nullable=False)
+    computed_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    product = db.relationship('Product', backref=db.backref('classification', uselist=False))
+
+# Indexes for the hot query paths: period filters and keyset listings on the
+# document dates, foreign keys walked by items/movements, and a partial index
+# for the low-stock checks. Existing databases get them with
+# `flask create-indexes` (see indexes.py).
+LOW_STOCK = Product.stock_quantity <= Product.min_stock
+
+db.Index('ix_products_name', Product.name, Product.id)
+db.Index('ix_products_category_id', Product.category_id)
+db.Index('ix_products_supplier_id', Product.supplier_id)
+db.Index('ix_products_low_stock', Product.stock_quantity,
+         postgresql_where=LOW_STOCK, sqlite_where=LOW_STOCK)
+# Product search (search.py): trigram index for ILIKE '%q%' and similarity
+# ranking. PostgreSQL only; it needs the pg_trgm extension.
+db.Index('ix_products_name_trgm', Product.name, postgresql_using='gin',
+         postgresql_ops={'name': 'gin_trgm_ops'}).ddl_if(dialect='postgresql')
+event.listen(Product.__table__, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+db.Index('ix_customers_name', Customer.name, Customer.id)
+db.Index('ix_suppliers_name', Supplier.name, Supplier.id)
+db.Index('ix_product_classifications_classes', ProductClassification.abc_class, ProductClassification.xyz_class)
+db.Index('ix_replenishment_supplier', ReplenishmentSuggestion.supplier_id, ReplenishmentSuggestion.suggested_quantity)
+db.Index('ix_sales_sale_date', Sale.sale_date, Sale.id)
+db.Index('ix_sales_created_at', Sale.created_at)
+db.Index('ix_sales_customer_date', Sale.customer_id, Sale.sale_date)
+db.Index('ix_sale_items_sale_id', SaleItem.sale_id)
+db.Index('ix_sale_items_product_id', SaleItem.product_id)
+db.Index('ix_purchases_purchase_date', Purchase.purchase_date, Purchase.id)
+db.Index('ix_purchases_supplier_date', Purchase.supplier_id, Purchase.purchase_date)
+db.Index('ix_purchase_items_purchase_id', PurchaseItem.purchase_id)
+db.Index('ix_purchase_items_product_id', PurchaseItem.product_id)
+db.Index('ix_inventory_movements_created_at', InventoryMovement.created_at, InventoryMovement.id)
+db.Index('ix_inventory_movements_product', InventoryMovement.product_id, InventoryMovement.created_at)
+db.Index('ix_inventory_movements_reference', InventoryMovement.reference_type, InventoryMovement.reference_id)
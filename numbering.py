@@ -0,0 +1,224 @@
+"""Gap-free document numbers.
+
+Sales are numbered ``FT 2026GV/123``, purchases ``CP 2026GV/45`` and draft
+purchase orders ``NE 2026GV/7`` (nota de encomenda). That is
+the SAF-T '<type> <series>/<sequence>' form, where the series is the year
+plus a series code. The counters live in ``document_series``, with one row
+per document type, series and year.
+
+A number is taken with ``UPDATE ... SET next_number = next_number + 1
+RETURNING`` inside the transaction that posts the document. If the posting
+rolls back, the number is handed out again, so a series has no gaps. That
+is why this uses counter rows and not PostgreSQL sequences: ``nextval`` is
+never rolled back.
+
+The counter row stays locked until the posting commits. Each terminal
+therefore gets its own series, so tills only wait for postings made at the
+same till. The tills are configured, not chosen by whoever logs in:
+``TERMINALS`` maps each series code to the address of its till
+(``CX1=10.0.0.21,CX2=10.0.0.22``), and ``current_terminal()`` looks up the
+address of the request. Other clients use ``DEFAULT_SERIES``. Offline
+terminals can take a whole range up front with ``reserve_block`` (``flask
+reserve-numbers``).
+
+``flask check-numbering`` allocates from one scratch series in many
+concurrent transactions, rolling some back, and fails unless the committed
+numbers are exactly 1..N. Run it against each database backend in use.
+"""
+import re
+import threading
+import time
+from datetime import datetime
+
+import click
+from flask import request
+from sqlalchemy import func, update
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from models import DocumentSeries, DocumentSeriesBlock
+
+SALE = 'FT'
+PURCHASE = 'CP'
+ORDER = 'NE'
+DEFAULT_SERIES = 'GV'
+
+NOT_ALLOWED = re.compile(r'[^A-Za-z0-9]')
+
+
+def series_code(terminal=None):
+    """Series code for a terminal (``DEFAULT_SERIES`` when there is none)"""
+    code = NOT_ALLOWED.sub('', terminal or '').upper()[:16]
+    return code or DEFAULT_SERIES
+
+
+def terminals():
+    """{client address: series code} of the tills configured in ``TERMINALS``"""
+    pairs = (item.split('=', 1) for item in app.config.get('TERMINALS', '').split(',') if '=' in item)
+    return {address.strip(): series_code(code) for code, address in pairs}
+
+
+def current_terminal():
+    """Series code of the till the current request comes from, or ``None``"""
+    return terminals().get(request.remote_addr)
+
+
+def format_number(doc_type, series, year, number):
+    return f"{doc_type} {year}{series}/{number}"
+
+
+def _key(doc_type, series, year):
+    table = DocumentSeries.__table__
+    return (table.c.doc_type == doc_type, table.c.series == series, table.c.year == year)
+
+
+def _advance(doc_type, series, year, count):
+    table = DocumentSeries.__table__
+    stmt = update(table).where(*_key(doc_type, series, year)).values(
+        next_number=table.c.next_number + count, updated_at=func.now()
+    ).returning(table.c.id, table.c.next_number)
+    return db.session.execute(stmt).first()
+
+
+def _create_series(doc_type, series, year):
+    """Insert the counter row unless a concurrent posting already did"""
+    table = DocumentSeries.__table__
+    values = dict(doc_type=doc_type, series=series, year=year, next_number=1,
+                  created_at=datetime.utcnow(), updated_at=datetime.utcnow())
+
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as upsert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as upsert
+        db.session.execute(upsert(table).values(**values).on_conflict_do_nothing(
+            index_elements=['doc_type', 'series', 'year']
+        ))
+        return
+
+    try:
+        with db.session.begin_nested():
+            db.session.execute(table.insert().values(**values))
+    except IntegrityError:
+        pass
+
+
+def allocate(doc_type, terminal=None, when=None, count=1):
+    """Take ``count`` consecutive numbers, returning ``(series_id, series, year, first)``"""
+    series = series_code(terminal)
+    year = (when or datetime.now()).year
+
+    row = _advance(doc_type, series, year, count)
+    if row is None:
+        _create_series(doc_type, series, year)
+        row = _advance(doc_type, series, year, count)
+
+    series_id, next_number = row
+    return series_id, series, year, next_number - count
+
+
+def next_number(doc_type, terminal=None, when=None):
+    """Allocate the next document number in the caller's transaction"""
+    _, series, year, number = allocate(doc_type, terminal, when)
+    return format_number(doc_type, series, year, number)
+
+
+def reserve_block(doc_type, size, terminal=None, user_id=None, when=None):
+    """Reserve ``size`` numbers for an offline terminal (recorded in ``document_series_blocks``)"""
+    if size < 1:
+        raise ValueError('O bloco tem de ter pelo menos um número')
+    series_id, series, year, first = allocate(doc_type, terminal, when, size)
+    block = DocumentSeriesBlock(series_id=series_id, first_number=first, last_number=first + size - 1,
+                                terminal=series, user_id=user_id)
+    db.session.add(block)
+    block.first_label = format_number(doc_type, series, year, first)
+    block.last_label = format_number(doc_type, series, year, first + size - 1)
+    return block
+
+
+@app.cli.command('reserve-numbers')
+@click.option('--type', 'doc_type', default=SALE, show_default=True, help='Tipo de documento (FT, CP, NE)')
+@click.option('--terminal', help='Código do terminal (série)')
+@click.option('--size', default=100, show_default=True, help='Quantidade de números a reservar')
+def reserve_numbers_command(doc_type, terminal, size):
+    """Reserve a block of document numbers for an offline terminal"""
+    block = reserve_block(doc_type.upper(), size, terminal)
+    db.session.commit()
+    click.echo(f'Reservados {block.first_label} a {block.last_label}.')
+
+
+
+# =============== CHECK ===============
+
+CHECK_SERIES = 'CHECK'
+
+
+def _check_worker(documents, rollback_every, committed, errors, lock):
+    with app.app_context():
+        for i in range(documents):
+            try:
+                _, _, _, number = allocate(SALE, CHECK_SERIES)
+                if rollback_every and i % rollback_every == rollback_every - 1:
+                    db.session.rollback()
+                    continue
+                db.session.commit()
+                with lock:
+                    committed.append(number)
+            except Exception as e:
+                db.session.rollback()
+                with lock:
+                    errors.append(str(e))
+        db.session.remove()
+
+
+def check_allocation(workers=16, documents=200, rollback_every=7):
+    """Allocate from ``CHECK_SERIES`` in concurrent transactions and look for duplicates or gaps
+
+    Each of ``workers`` threads takes ``documents`` numbers, one transaction
+    each, and rolls back every ``rollback_every``-th one. The scratch series
+    is removed before and after.
+    """
+    def reset():
+        DocumentSeries.query.filter_by(doc_type=SALE, series=CHECK_SERIES).delete()
+        db.session.commit()
+
+    reset()
+    committed, errors, lock = [], [], threading.Lock()
+    threads = [threading.Thread(target=_check_worker, args=(documents, rollback_every, committed, errors, lock))
+               for _ in range(workers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    reset()
+
+    numbers = sorted(committed)
+    duplicates = len(numbers) - len(set(numbers))
+    gaps = sorted(set(range(1, len(numbers) + 1)) - set(numbers))
+    return {
+        'committed': len(numbers),
+        'duplicates': duplicates,
+        'gaps': gaps,
+        'errors': errors,
+        'numbers_per_s': round(len(numbers) / elapsed, 1),
+        'ok': not duplicates and not gaps and not errors,
+    }
+
+
+@app.cli.command('check-numbering')
+@click.option('--workers', default=16, show_default=True, help='Threads em paralelo')
+@click.option('--documents', default=200, show_default=True, help='Documentos por thread')
+@click.option('--rollback-every', default=7, show_default=True, help='Anular um em cada N documentos')
+def check_numbering_command(workers, documents, rollback_every):
+    """Allocate numbers concurrently and fail on duplicate or missing numbers"""
+    result = check_allocation(workers, documents, rollback_every)
+    click.echo(f"{result['committed']} números em {workers} threads "
+               f"({result['numbers_per_s']}/s): {result['duplicates']} duplicados, "
+               f"{len(result['gaps'])} em falta, {len(result['errors'])} erros.")
+    if result['errors']:
+        click.echo(result['errors'][0], err=True)
+    if not result['ok']:
+        raise SystemExit(1)
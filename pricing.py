@@ -0,0 +1,119 @@
+"""Decimal pricing and tax engine for sales and purchases.
+
+Every amount that ends up on a document is computed here, with ``Decimal``
+and ROUND_HALF_UP to the cent, so that the stored sale/purchase totals, the
+daily rollups and the SAF-T export all agree to the cent:
+
+* line net = round(quantity x unit price)
+* line tax = round(line net x rate / 100)
+* document subtotal / tax / total = sums of the line values, also broken
+  down per tax rate (``DocumentTotals.by_rate``), in a single pass.
+
+Amounts posted by the browser are never trusted; ``lines_from_form`` reads
+only product, quantity, unit price and rate, and ``price_document`` derives
+the rest.
+"""
+import re
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+CENT = Decimal('0.01')
+ZERO = Decimal('0.00')
+HUNDRED = Decimal('100')
+
+LINE_FIELD = re.compile(r'^products\[(\d+)\]\[(\w+)\]$')
+LINE_FIELDS = ('id', 'price', 'quantity', 'tax_rate')
+
+
+def to_decimal(value, default=None):
+    """``Decimal`` from a number, Decimal or string (comma decimals accepted)"""
+    if value is None or value == '':
+        if default is None:
+            raise ValueError('Valor em falta')
+        value = default
+    if isinstance(value, Decimal):
+        return value
+    if isinstance(value, float):
+        value = repr(value)
+    try:
+        return Decimal(str(value).strip().replace(',', '.'))
+    except InvalidOperation:
+        raise ValueError(f"Valor inválido: {value}")
+
+
+def round_money(value):
+    return to_decimal(value).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def line_amounts(quantity, unit_price, tax_rate):
+    """(net, tax) of one line, each rounded to the cent"""
+    net = (to_decimal(unit_price) * quantity).quantize(CENT, rounding=ROUND_HALF_UP)
+    tax = (net * to_decimal(tax_rate) / HUNDRED).quantize(CENT, rounding=ROUND_HALF_UP)
+    return net, tax
+
+
+class Line:
+    """One priced document line"""
+
+    __slots__ = ('product_id', 'quantity', 'unit_price', 'tax_rate', 'net', 'tax', 'total')
+
+    def __init__(self, product_id, quantity, unit_price, tax_rate):
+        self.product_id = int(product_id)
+        amount = to_decimal(quantity)
+        # Stock is counted in whole units; a fraction is refused rather than truncated
+        if not amount.is_finite() or amount <= 0 or amount != amount.to_integral_value():
+            raise ValueError(f"Quantidade inválida: {quantity}")
+        self.quantity = int(amount)
+        self.unit_price = round_money(unit_price)
+        self.tax_rate = to_decimal(tax_rate).quantize(CENT)
+        if self.unit_price < 0 or self.tax_rate < 0:
+            raise ValueError('Preço ou taxa de IVA negativos')
+
+        self.net, self.tax = line_amounts(self.quantity, self.unit_price, self.tax_rate)
+        self.total = self.net + self.tax
+
+
+class DocumentTotals:
+    """Line, per-rate and document totals of a priced document"""
+
+    def __init__(self, lines, by_rate, subtotal, tax_amount):
+        self.lines = lines
+        self.by_rate = by_rate
+        self.subtotal = subtotal
+        self.tax_amount = tax_amount
+        self.total_amount = subtotal + tax_amount
+
+
+def price_document(lines):
+    """Price ``lines`` (``Line`` objects or (product, qty, price, rate) tuples)"""
+    priced = []
+    by_rate = {}
+    subtotal = ZERO
+    tax_amount = ZERO
+    for line in lines:
+        if not isinstance(line, Line):
+            line = Line(*line)
+        priced.append(line)
+        subtotal += line.net
+        tax_amount += line.tax
+        rate = by_rate.setdefault(line.tax_rate, {'net': ZERO, 'tax': ZERO})
+        rate['net'] += line.net
+        rate['tax'] += line.tax
+    return DocumentTotals(priced, by_rate, subtotal, tax_amount)
+
+
+def lines_from_form(form):
+    """``Line`` objects from the ``products[i][field]`` inputs of a sale/purchase form"""
+    rows = {}
+    for key, value in form.items():
+        match = LINE_FIELD.match(key)
+        if match:
+            index, field = match.groups()
+            rows.setdefault(int(index), {})[field] = value
+
+    lines = []
+    for index in sorted(rows):
+        row = rows[index]
+        if not all(row.get(field) not in (None, '') for field in LINE_FIELDS):
+            continue
+        lines.append(Line(row['id'], row['quantity'], row['price'], row['tax_rate']))
+    return lines
@@ -0,0 +1,189 @@
+"""Draft purchase orders from the replenishment needs.
+
+``needs()`` is the order each product calls for right now. It considers
+active products with a supplier whose live stock is at or below the
+reorder point (``replenishment_suggestions``, or ``min_stock`` for products
+not planned yet). The quantity brings the stock back to the order-up-to
+level (``max_stock`` as a fallback), minus what is already on open draft
+orders. Clicking twice therefore does not order twice.
+
+``create_drafts`` turns the needs into one draft ``Purchase`` per supplier,
+with status ``rascunho`` and an ``NE`` number (see numbering.py). Each
+supplier is its own transaction:
+
+* lock the supplier row, so two users generating orders at the same time
+  do not both order the same needs,
+* take the next ``NE`` number and insert the purchase,
+* insert all its lines with one ``INSERT ... SELECT`` from the needs query,
+  priced at the product's purchase price and VAT rate,
+* set the document totals from the inserted lines, then commit.
+
+A failing supplier is rolled back and reported without stopping the others.
+
+Drafts do not touch the stock, the cost or the rollups. ``receive`` posts
+one when the goods arrive: it takes the stock in (stock.py), records the
+rollups and marks it ``concluida``.
+"""
+from datetime import datetime
+
+from sqlalchemy import func, insert, literal, select, update
+
+from app import app, db
+from models import Product, Purchase, PurchaseItem, ReplenishmentSuggestion, Supplier
+from numbering import ORDER, next_number
+from pricing import ZERO, line_amounts, round_money
+
+DRAFT = 'rascunho'
+RECEIVED = 'concluida'
+
+
+def _on_order():
+    """Units per product on open draft orders"""
+    return select(
+        PurchaseItem.product_id, func.sum(PurchaseItem.quantity).label('quantity')
+    ).join(Purchase, Purchase.id == PurchaseItem.purchase_id).where(
+        Purchase.status == DRAFT
+    ).group_by(PurchaseItem.product_id).subquery()
+
+
+def needs(supplier_ids=None):
+    """Select of ``product_id, supplier_id, quantity, unit_price, tax_rate`` of the products to order"""
+    on_order = _on_order()
+    stock = func.coalesce(Product.stock_quantity, 0)
+    reorder_point = func.coalesce(ReplenishmentSuggestion.reorder_point, Product.min_stock, 0)
+    order_up_to = func.coalesce(ReplenishmentSuggestion.order_up_to, Product.max_stock, 0)
+    quantity = order_up_to - stock - func.coalesce(on_order.c.quantity, 0)
+
+    stmt = select(
+        Product.id.label('product_id'), Product.supplier_id, quantity.label('quantity'),
+        func.coalesce(Product.purchase_price, 0).label('unit_price'),
+        func.coalesce(Product.tax_rate, 0).label('tax_rate'),
+    ).outerjoin(
+        ReplenishmentSuggestion, ReplenishmentSuggestion.product_id == Product.id
+    ).outerjoin(
+        on_order, on_order.c.product_id == Product.id
+    ).where(
+        Product.is_active == True,  # noqa: E712
+        Product.supplier_id.isnot(None),
+        stock <= reorder_point,
+        quantity > 0,
+    )
+    if supplier_ids is not None:
+        stmt = stmt.where(Product.supplier_id.in_(supplier_ids))
+    return stmt
+
+
+def preview():
+    """[(supplier, lines, totals)] of the drafts ``create_drafts`` would make, by supplier name
+
+    Each line is a dict with the product and the priced quantities; totals
+    has ``subtotal``, ``tax_amount`` and ``total_amount``.
+    """
+    rows = needs().subquery()
+    result = db.session.execute(
+        select(Supplier, Product, rows.c.quantity, rows.c.unit_price, rows.c.tax_rate)
+        .join(rows, rows.c.supplier_id == Supplier.id)
+        .join(Product, Product.id == rows.c.product_id)
+        .order_by(Supplier.name, Supplier.id, Product.code)
+    )
+
+    groups = []
+    for supplier, product, quantity, unit_price, tax_rate in result:
+        if not groups or groups[-1][0] is not supplier:
+            groups.append((supplier, [], {'subtotal': ZERO, 'tax_amount': ZERO, 'total_amount': ZERO}))
+        net, tax = line_amounts(quantity, unit_price, tax_rate)
+        groups[-1][1].append({'product': product, 'quantity': quantity, 'unit_price': unit_price,
+                              'tax_rate': tax_rate, 'net': net, 'total': net + tax})
+        totals = groups[-1][2]
+        totals['subtotal'] += net
+        totals['tax_amount'] += tax
+        totals['total_amount'] += net + tax
+    return groups
+
+
+def _create_draft(supplier_id, user_id, terminal, now):
+    """Draft order for one supplier in the current transaction, or ``None`` if nothing is needed"""
+    db.session.execute(select(Supplier.id).where(Supplier.id == supplier_id).with_for_update())
+
+    purchase = Purchase(
+        invoice_number=next_number(ORDER, terminal, now),
+        supplier_id=supplier_id,
+        user_id=user_id,
+        purchase_date=now,
+        status=DRAFT,
+        notes='Encomenda gerada a partir das encomendas sugeridas',
+        created_at=now,
+        updated_at=now
+    )
+    db.session.add(purchase)
+    db.session.flush()
+
+    lines = needs([supplier_id]).subquery()
+    net = func.round(lines.c.quantity * lines.c.unit_price, 2)
+    tax = func.round(net * lines.c.tax_rate / 100, 2)
+    inserted = db.session.execute(insert(PurchaseItem.__table__).from_select(
+        ['purchase_id', 'product_id', 'quantity', 'unit_price', 'tax_rate', 'total_price'],
+        select(literal(purchase.id), lines.c.product_id, lines.c.quantity, lines.c.unit_price,
+               lines.c.tax_rate, net + tax)
+    )).rowcount
+    if not inserted:
+        return None
+
+    subtotal, total = db.session.execute(
+        select(func.sum(func.round(PurchaseItem.quantity * PurchaseItem.unit_price, 2)),
+               func.sum(PurchaseItem.total_price))
+        .where(PurchaseItem.purchase_id == purchase.id)
+    ).one()
+    subtotal, total = round_money(subtotal), round_money(total)
+    purchase.subtotal = subtotal
+    purchase.tax_amount = total - subtotal
+    purchase.total_amount = total
+    return purchase
+
+
+def create_drafts(supplier_ids, user_id, terminal=None):
+    """One draft order per supplier, each committed on its own
+
+    Returns ``(created, errors)``: the new purchases, and ``(supplier_id,
+    message)`` for the suppliers that failed.
+    """
+    created, errors = [], []
+    for supplier_id in supplier_ids:
+        try:
+            purchase = _create_draft(supplier_id, user_id, terminal, datetime.now())
+            if purchase is None:
+                db.session.rollback()
+                continue
+            db.session.commit()
+            created.append(purchase)
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception("Error creating draft order for supplier %s", supplier_id)
+            errors.append((supplier_id, str(e)))
+    return created, errors
+
+
+def receive(purchase, user_id):
+    """Post a draft order: stock in, rollups, status ``concluida``. The caller commits.
+
+    The status moves with a conditional ``UPDATE ... WHERE status =
+    'rascunho'``, which holds the purchase row until the commit. Of two users
+    receiving the same order, the second waits and then updates no row, so
+    the stock is only taken in once.
+    """
+    from rollups import record_purchase
+    from stock import post_purchase
+
+    now = datetime.now()
+    claimed = db.session.execute(
+        update(Purchase).where(Purchase.id == purchase.id, Purchase.status == DRAFT)
+        .values(status=RECEIVED, updated_at=now)
+    ).rowcount
+    if claimed != 1:
+        raise ValueError(f'A compra {purchase.invoice_number} não é um rascunho.')
+    items = list(purchase.items)
+    if not items:
+        raise ValueError('A encomenda não tem linhas.')
+
+    post_purchase(purchase, items, user_id)
+    record_purchase(purchase, items)
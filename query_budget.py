@@ -0,0 +1,111 @@
+"""Per-request SQL query counter and per-view query budgets.
+
+Every statement sent to the database during a request is counted in
+``g.query_count``. Views decorated with ``@query_budget(n)`` check that they
+(including the template they render) stayed within ``n`` queries; going over
+the budget is logged, and raises ``QueryBudgetExceeded`` when the app runs in
+testing mode or with ``QUERY_BUDGET_STRICT`` set, so an N+1 regression fails
+the test suite instead of slipping into production.
+
+``flask check-query-budgets`` renders every budgeted page that takes no URL
+arguments, in strict mode and with the application cache off, so each
+query runs as on a cold cache. It prints the queries used against the
+budget and fails if a page goes over it or does not render. Run it against
+a database with data in every table, or pages with empty lists will use
+fewer queries than in production.
+"""
+from functools import wraps
+
+import click
+from flask import current_app, g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app
+
+
+class QueryBudgetExceeded(RuntimeError):
+    """A view ran more SQL statements than its declared budget"""
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+
+def query_count():
+    """Number of SQL statements executed so far in the current request"""
+    if not has_request_context():
+        return 0
+    return g.get('query_count', 0)
+
+
+def query_budget(limit):
+    """Decorate a view so it may run at most ``limit`` SQL statements"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            start = query_count()
+            g.query_budget_used = None  # stays None if the view raises
+            response = view(*args, **kwargs)
+            used = query_count() - start
+            g.query_budget_used = used
+
+            if used > limit:
+                message = f"View '{view.__name__}' ran {used} queries (budget {limit})"
+                if current_app.config.get('QUERY_BUDGET_STRICT', current_app.testing):
+                    raise QueryBudgetExceeded(message)
+                current_app.logger.warning(message)
+
+            return response
+        wrapper.query_budget = limit
+        return wrapper
+    return decorator
+
+
+def check_budgets(user):
+    """{path: (status, queries used, budget)} of the budgeted pages, rendered as ``user``"""
+    from cache import cache
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session.update(user_id=user.id, username=user.username, user_role=user.role, full_name=user.full_name)
+
+    strict, cached = app.config.get('QUERY_BUDGET_STRICT'), cache.enabled
+    app.config['QUERY_BUDGET_STRICT'], cache.enabled = True, False
+    results = {}
+    try:
+        for rule in sorted(app.url_map.iter_rules(), key=lambda rule: rule.rule):
+            limit = getattr(app.view_functions[rule.endpoint], 'query_budget', None)
+            if limit is None or rule.arguments or 'GET' not in rule.methods:
+                continue
+            with client:
+                response = client.get(rule.rule)
+                results[rule.rule] = (response.status_code, g.get('query_budget_used'), limit)
+    finally:
+        app.config['QUERY_BUDGET_STRICT'], cache.enabled = strict, cached
+    return results
+
+
+@app.cli.command('check-query-budgets')
+@click.option('--user-id', type=int, help='Utilizador das páginas; por omissão, o primeiro administrador')
+def check_query_budgets_command(user_id):
+    """Render every budgeted page and fail if one goes over its query budget"""
+    from app import db
+    from models import User
+
+    user = db.session.get(User, user_id) if user_id else \
+        User.query.filter_by(role='admin').order_by(User.id).first()
+    if user is None:
+        raise click.UsageError('Utilizador não encontrado; indique --user-id')
+
+    results = check_budgets(user)
+    failed = False
+    for path, (status, used, limit) in results.items():
+        ok = status == 200 and used is not None and used <= limit
+        failed = failed or not ok
+        click.echo(f"{'OK  ' if ok else 'FAIL'} {path}: {used if used is not None else '?'}/{limit} consultas"
+                   f"{'' if status == 200 else f' (HTTP {status})'}")
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,207 @@
+"""Reorder points and suggested purchase quantities.
+
+For every active product, ``compute()`` derives from the last
+``DEMAND_DAYS`` days of sales:
+
+* the mean daily demand ``d`` and its standard deviation ``sd`` (days
+  without sales count as zero demand),
+* the supplier's lead time ``L`` (mean) and ``sL`` (standard deviation),
+  from its purchase history,
+
+and from those
+
+* safety stock ``SS = z x sqrt(L x sd^2 + d^2 x sL^2)``, where ``z`` is the
+  normal quantile of the service level of the product's ABC class
+  (``SERVICE_LEVEL_Z``; see classification.py), so the few products that
+  make most of the revenue are the last to run out,
+* reorder point ``ROP = d x L + SS``,
+* once the stock is at or below ``ROP``, an order that brings it up to
+  ``ROP + d x REVIEW_DAYS``, which lasts until the next review.
+
+Products without sales in the window keep the hand-entered rule: reorder at
+``min_stock``, up to ``max_stock``.
+
+The lead time of a purchase is the number of days from its ``purchase_date``
+(the order or supplier document date) to when its stock was received, which
+is the time of its ``entrada`` movements. Suppliers whose history shows no
+delay (or no history at all) use ``DEFAULT_LEAD_TIME_DAYS``.
+
+The database does the heavy lifting, with two grouped aggregates over
+``sale_items`` and ``purchases`` that return the sums and sums of squares.
+A single pass over the catalogue then applies the formulas and bulk-inserts
+the results into ``replenishment_suggestions``. The table is rebuilt nightly
+by ``flask replenishment`` from cron, or on demand with the ``replenishment``
+job.
+
+The dashboard alerts (``restock_query``) compare the live stock with the
+stored reorder point. A sale made during the day therefore raises an alert
+at once, without recomputing. Products added since the last run fall back
+to ``min_stock``.
+"""
+import math
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy import and_, delete, func, insert, select
+from sqlalchemy.orm import contains_eager, joinedload
+
+from app import app, db
+from models import InventoryMovement, Product, Purchase, ReplenishmentSuggestion, Sale, SaleItem, Supplier
+
+DEMAND_DAYS = 90
+LEAD_TIME_HISTORY_DAYS = 365
+DEFAULT_LEAD_TIME_DAYS = 7
+REVIEW_DAYS = 7
+# Share of the replenishment cycles without a stockout, by ABC class: 98%, 95%, 90%
+SERVICE_LEVEL_Z = {'A': 2.05, 'B': 1.65, 'C': 1.28}
+DEFAULT_SERVICE_LEVEL_Z = SERVICE_LEVEL_Z['B']  # products not classified yet
+BATCH_SIZE = 5000
+
+
+def _mean_std(count, total, squares):
+    """Mean and (population) standard deviation from n, sum(x) and sum(x^2)"""
+    mean = total / count
+    return mean, math.sqrt(max(squares / count - mean * mean, 0))
+
+
+def demand_stats(start, days):
+    """{product_id: (mean daily demand, standard deviation)} since ``start``"""
+    daily = select(
+        SaleItem.product_id, func.sum(SaleItem.quantity).label('quantity')
+    ).join(Sale, Sale.id == SaleItem.sale_id).where(
+        Sale.sale_date >= start, Sale.status != 'cancelado'
+    ).group_by(SaleItem.product_id, func.date(Sale.sale_date)).subquery()
+    rows = db.session.execute(
+        select(daily.c.product_id, func.sum(daily.c.quantity), func.sum(daily.c.quantity * daily.c.quantity))
+        .group_by(daily.c.product_id)
+    )
+    return {product_id: _mean_std(days, float(total), float(squares)) for product_id, total, squares in rows}
+
+
+def lead_times(start):
+    """{supplier_id: (mean lead time, standard deviation)} in days, from purchases since ``start``"""
+    stats = {}
+    rows = db.session.execute(
+        select(Purchase.supplier_id, Purchase.purchase_date, func.min(InventoryMovement.created_at))
+        .join(InventoryMovement, and_(InventoryMovement.reference_type == 'compra',
+                                      InventoryMovement.reference_id == Purchase.id))
+        .where(Purchase.purchase_date >= start, Purchase.status != 'cancelado')
+        .group_by(Purchase.id, Purchase.supplier_id, Purchase.purchase_date)
+        .execution_options(yield_per=BATCH_SIZE)
+    )
+    for supplier_id, dated, received in rows:
+        if dated is None or received is None:
+            continue
+        days = max((received.date() - dated.date()).days, 0)
+        count, total, squares = stats.get(supplier_id, (0, 0, 0))
+        stats[supplier_id] = (count + 1, total + days, squares + days * days)
+
+    result = {}
+    for supplier_id, (count, total, squares) in stats.items():
+        mean, std = _mean_std(count, total, squares)
+        if mean >= 1:
+            result[supplier_id] = (mean, std)
+    return result
+
+
+def plan(stock, min_stock, max_stock, demand, lead_time, z=DEFAULT_SERVICE_LEVEL_Z):
+    """(safety stock, reorder point, order-up-to level, suggested quantity) of one product"""
+    stock = stock or 0
+    if demand is None:
+        safety, reorder_point = 0, min_stock or 0
+        order_up_to = max(max_stock or 0, reorder_point)
+    else:
+        (mean, std), (lead, lead_std) = demand, lead_time
+        safety = math.ceil(z * math.sqrt(lead * std * std + mean * mean * lead_std * lead_std))
+        reorder_point = math.ceil(mean * lead) + safety
+        order_up_to = math.ceil(reorder_point + mean * REVIEW_DAYS)
+    quantity = max(order_up_to - stock, 0) if stock <= reorder_point else 0
+    return safety, reorder_point, order_up_to, quantity
+
+
+def compute(now=None, report=None):
+    """Rebuild ``replenishment_suggestions`` for the whole catalogue
+
+    Returns (products planned, products to order). ``report(done, total)`` is
+    called after every batch. The caller commits.
+    """
+    from classification import abc_classes
+
+    now = now or datetime.now()
+    demand = demand_stats(now - timedelta(days=DEMAND_DAYS), DEMAND_DAYS)
+    suppliers = lead_times(now - timedelta(days=LEAD_TIME_HISTORY_DAYS))
+    default_lead = (float(DEFAULT_LEAD_TIME_DAYS), 0.0)
+    classes = abc_classes()
+
+    db.session.execute(delete(ReplenishmentSuggestion))
+    total = db.session.execute(select(func.count(Product.id)).where(Product.is_active == True)).scalar()  # noqa: E712
+    rows = db.session.execute(
+        select(Product.id, Product.supplier_id, Product.stock_quantity, Product.min_stock, Product.max_stock)
+        .where(Product.is_active == True)  # noqa: E712
+        .execution_options(yield_per=BATCH_SIZE)
+    )
+
+    batch, done, to_order = [], 0, 0
+    for product_id, supplier_id, stock, min_stock, max_stock in rows:
+        stats = demand.get(product_id)
+        lead_time = suppliers.get(supplier_id, default_lead)
+        z = SERVICE_LEVEL_Z.get(classes.get(product_id), DEFAULT_SERVICE_LEVEL_Z)
+        safety, reorder_point, order_up_to, quantity = plan(stock, min_stock, max_stock, stats, lead_time, z)
+        mean, std = stats or (0, 0)
+        batch.append({
+            'product_id': product_id, 'supplier_id': supplier_id,
+            'daily_demand': round(mean, 4), 'demand_std': round(std, 4),
+            'lead_time_days': round(lead_time[0], 2), 'safety_stock': safety,
+            'reorder_point': reorder_point, 'order_up_to': order_up_to, 'stock_quantity': stock or 0,
+            'suggested_quantity': quantity, 'computed_at': now,
+        })
+        to_order += quantity > 0
+        done += 1
+        if len(batch) >= BATCH_SIZE:
+            db.session.execute(insert(ReplenishmentSuggestion.__table__), batch)
+            batch = []
+            if report:
+                report(done, total)
+    if batch:
+        db.session.execute(insert(ReplenishmentSuggestion.__table__), batch)
+    return done, to_order
+
+
+# =============== READS ===============
+
+def restock_query():
+    """Active products at or below their reorder point (``min_stock`` if not computed yet)"""
+    reorder_point = func.coalesce(ReplenishmentSuggestion.reorder_point, Product.min_stock)
+    return Product.query.outerjoin(
+        ReplenishmentSuggestion, ReplenishmentSuggestion.product_id == Product.id
+    ).options(contains_eager(Product.replenishment)).filter(
+        Product.is_active == True,  # noqa: E712
+        Product.stock_quantity <= reorder_point
+    ).order_by(Product.stock_quantity - reorder_point, Product.id)
+
+
+def suggestions_by_supplier(supplier_id=None):
+    """[(supplier or None, [ReplenishmentSuggestion])] of the products to order, by supplier name"""
+    query = ReplenishmentSuggestion.query.options(
+        joinedload(ReplenishmentSuggestion.product).joinedload(Product.classification),
+        joinedload(ReplenishmentSuggestion.supplier)
+    ).outerjoin(Supplier, Supplier.id == ReplenishmentSuggestion.supplier_id).join(
+        Product, Product.id == ReplenishmentSuggestion.product_id
+    ).filter(ReplenishmentSuggestion.suggested_quantity > 0)
+    if supplier_id is not None:
+        query = query.filter(ReplenishmentSuggestion.supplier_id == supplier_id)
+
+    groups = []
+    for suggestion in query.order_by(Supplier.name, ReplenishmentSuggestion.supplier_id, Product.code):
+        if not groups or groups[-1][0] is not suggestion.supplier:
+            groups.append((suggestion.supplier, []))
+        groups[-1][1].append(suggestion)
+    return groups
+
+
+@app.cli.command('replenishment')
+def replenishment_command():
+    """Recompute reorder points and suggested orders (run nightly)"""
+    planned, to_order = compute()
+    db.session.commit()
+    click.echo(f'{planned} produtos planeados, {to_order} a encomendar.')
@@ -0,0 +1,271 @@
+"""Daily sales/purchase rollups.
+
+``daily_sales_summary`` and ``daily_purchase_summary`` hold one row per day,
+payment method and user with the document totals (``category_id`` 0), plus one
+row per category with the line totals of that category. The write routes keep
+them current with additive upserts (``record_sale``/``record_purchase``), and
+``flask rebuild-rollups`` rebuilds them from the raw tables for backfills.
+Dashboard, report and chart figures are read from here instead of summing
+``sales``/``purchases`` on every page view.
+"""
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+import click
+from sqlalchemy import and_, delete, distinct, func, insert, literal, select
+
+from app import app, db
+from cache import cache
+from pricing import to_decimal
+from models import (Category, DailyPurchaseSummary, DailySalesSummary, Product,
+                    Purchase, PurchaseItem, Sale, SaleItem)
+
+DOCUMENT_ROW = 0
+KEY_COLUMNS = ('day', 'category_id', 'payment_method', 'user_id')
+MEASURES = ('document_count', 'quantity', 'subtotal', 'tax_amount', 'total_amount')
+# Cancelled documents and draft purchase orders are left out of the totals
+EXCLUDED_STATUSES = ('cancelado', 'rascunho')
+
+
+class _Rollup:
+    def __init__(self, summary, document, item, item_fk, date_column):
+        self.summary = summary
+        self.document = document
+        self.item = item
+        self.item_fk = item_fk
+        self.date_column = date_column
+
+
+SALES = _Rollup(DailySalesSummary, Sale, SaleItem, SaleItem.sale_id, Sale.sale_date)
+PURCHASES = _Rollup(DailyPurchaseSummary, Purchase, PurchaseItem, PurchaseItem.purchase_id,
+                    Purchase.purchase_date)
+
+
+def _decimal(value):
+    return to_decimal(value, 0)
+
+
+def _day(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.now().date()
+
+
+# =============== INCREMENTAL MAINTENANCE ===============
+
+def record_sale(sale, items, sign=1):
+    """Add (``sign=1``) or remove (``sign=-1``) a sale from the rollup"""
+    _record(SALES, sale, sale.sale_date, items, sign)
+
+
+def record_purchase(purchase, items, sign=1):
+    """Add (``sign=1``) or remove (``sign=-1``) a purchase from the rollup"""
+    _record(PURCHASES, purchase, purchase.purchase_date, items, sign)
+
+
+def _record(rollup, document, document_date, items, sign):
+    if document.status in EXCLUDED_STATUSES:
+        return
+
+    day = _day(document_date)
+    payment_method = document.payment_method or ''
+    items = list(items)
+
+    product_ids = {item.product_id for item in items}
+    categories = dict(
+        db.session.query(Product.id, Product.category_id).filter(Product.id.in_(product_ids)).all()
+    ) if product_ids else {}
+
+    rows = {
+        DOCUMENT_ROW: {
+            'document_count': sign,
+            'quantity': sign * sum(int(item.quantity) for item in items),
+            'subtotal': sign * _decimal(document.subtotal),
+            'tax_amount': sign * _decimal(document.tax_amount),
+            'total_amount': sign * _decimal(document.total_amount),
+        }
+    }
+    for item in items:
+        category_id = categories.get(item.product_id)
+        if category_id is None:
+            continue
+        subtotal = _decimal(item.unit_price) * int(item.quantity)
+        total = _decimal(item.total_price)
+        row = rows.setdefault(category_id, {
+            'document_count': sign, 'quantity': 0,
+            'subtotal': Decimal('0'), 'tax_amount': Decimal('0'), 'total_amount': Decimal('0'),
+        })
+        row['quantity'] += sign * int(item.quantity)
+        row['subtotal'] += sign * subtotal
+        row['tax_amount'] += sign * (total - subtotal)
+        row['total_amount'] += sign * total
+
+    _apply(rollup.summary, [
+        dict(day=day, category_id=category_id, payment_method=payment_method,
+             user_id=document.user_id, **measures)
+        for category_id, measures in rows.items()
+    ])
+
+
+def _apply(summary, rows):
+    """Add ``rows`` onto the existing summary rows (insert when missing)"""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as upsert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as upsert
+    else:
+        return _apply_portable(summary, rows)
+
+    table = summary.__table__
+    stmt = upsert(table).values(rows)
+    updates = {name: table.c[name] + stmt.excluded[name] for name in MEASURES}
+    updates['updated_at'] = func.now()
+    db.session.execute(stmt.on_conflict_do_update(index_elements=list(KEY_COLUMNS), set_=updates))
+
+
+def _apply_portable(summary, rows):
+    table = summary.__table__
+    for row in rows:
+        key = and_(*[table.c[name] == row[name] for name in KEY_COLUMNS])
+        result = db.session.execute(table.update().where(key).values(
+            **{name: table.c[name] + row[name] for name in MEASURES}, updated_at=func.now()
+        ))
+        if result.rowcount == 0:
+            db.session.execute(table.insert().values(**row))
+
+
+# =============== REBUILD ===============
+
+def rebuild(rollup, start=None, end=None):
+    """Recompute the rollup for ``start``..``end`` (inclusive dates, or everything)"""
+    summary = rollup.summary.__table__
+    document = rollup.document
+    item = rollup.item
+
+    clear = delete(summary)
+    period = [func.coalesce(document.status, '').notin_(EXCLUDED_STATUSES)]
+    if start:
+        clear = clear.where(summary.c.day >= start)
+        period.append(rollup.date_column >= datetime.combine(start, datetime.min.time()))
+    if end:
+        clear = clear.where(summary.c.day <= end)
+        period.append(rollup.date_column < datetime.combine(end + timedelta(days=1), datetime.min.time()))
+    db.session.execute(clear)
+
+    day = func.date(rollup.date_column)
+    payment_method = func.coalesce(document.payment_method, '')
+    line_subtotal = func.coalesce(func.sum(item.quantity * item.unit_price), 0)
+    line_total = func.coalesce(func.sum(item.total_price), 0)
+    columns = list(KEY_COLUMNS) + list(MEASURES)
+
+    units = select(
+        rollup.item_fk.label('document_id'), func.sum(item.quantity).label('quantity')
+    ).group_by(rollup.item_fk).subquery()
+
+    documents = select(
+        day, literal(DOCUMENT_ROW), payment_method, document.user_id,
+        func.count(document.id),
+        func.coalesce(func.sum(units.c.quantity), 0),
+        func.coalesce(func.sum(document.subtotal), 0),
+        func.coalesce(func.sum(document.tax_amount), 0),
+        func.coalesce(func.sum(document.total_amount), 0),
+    ).select_from(document).outerjoin(units, units.c.document_id == document.id).where(
+        *period
+    ).group_by(day, payment_method, document.user_id)
+
+    lines = select(
+        day, Product.category_id, payment_method, document.user_id,
+        func.count(distinct(document.id)),
+        func.coalesce(func.sum(item.quantity), 0),
+        line_subtotal,
+        line_total - line_subtotal,
+        line_total,
+    ).select_from(item).join(document, rollup.item_fk == document.id).join(
+        Product, Product.id == item.product_id
+    ).where(*period).group_by(day, Product.category_id, payment_method, document.user_id)
+
+    db.session.execute(insert(summary).from_select(columns, documents))
+    db.session.execute(insert(summary).from_select(columns, lines))
+
+
+def rebuild_all(start=None, end=None):
+    rebuild(SALES, start, end)
+    rebuild(PURCHASES, start, end)
+    db.session.commit()
+    cache.invalidate('sales', 'purchases')  # the rebuild bypasses the ORM
+
+
+@app.cli.command('rebuild-rollups')
+@click.option('--from', 'start', type=click.DateTime(formats=['%Y-%m-%d']), help='Primeiro dia (YYYY-MM-DD)')
+@click.option('--to', 'end', type=click.DateTime(formats=['%Y-%m-%d']), help='Último dia (YYYY-MM-DD)')
+def rebuild_rollups_command(start, end):
+    """Rebuild the daily sales/purchase rollups from the raw tables"""
+    rebuild_all(start.date() if start else None, end.date() if end else None)
+    click.echo('Resumos diários reconstruídos.')
+
+
+# =============== READS ===============
+
+def totals(rollup, start=None, end=None):
+    """Document count, units and amounts for ``start``..``end`` (inclusive dates)"""
+    summary = rollup.summary
+    query = db.session.query(
+        func.coalesce(func.sum(summary.document_count), 0),
+        func.coalesce(func.sum(summary.quantity), 0),
+        func.coalesce(func.sum(summary.subtotal), 0),
+        func.coalesce(func.sum(summary.tax_amount), 0),
+        func.coalesce(func.sum(summary.total_amount), 0),
+    ).filter(summary.category_id == DOCUMENT_ROW)
+    if start:
+        query = query.filter(summary.day >= start)
+    if end:
+        query = query.filter(summary.day <= end)
+
+    count, quantity, subtotal, tax_amount, total_amount = query.one()
+    return {
+        'count': int(count),
+        'quantity': int(quantity),
+        'subtotal': Decimal(subtotal),
+        'tax_amount': Decimal(tax_amount),
+        'total_amount': Decimal(total_amount),
+    }
+
+
+def daily_totals(rollup, start, end=None):
+    """{'YYYY-MM-DD': total_amount} for the days with activity"""
+    summary = rollup.summary
+    query = db.session.query(summary.day, func.sum(summary.total_amount)).filter(
+        summary.category_id == DOCUMENT_ROW,
+        summary.day >= start
+    )
+    if end:
+        query = query.filter(summary.day <= end)
+    rows = query.group_by(summary.day).all()
+    return {str(day): float(total or 0) for day, total in rows}
+
+
+def monthly_totals(rollup, start):
+    """[(first day of month, total_amount)] since ``start``, oldest first"""
+    months = {}
+    for day, total in daily_totals(rollup, start).items():
+        month = datetime.strptime(day, '%Y-%m-%d').date().replace(day=1)
+        months[month] = months.get(month, 0.0) + total
+    return sorted(months.items())
+
+
+def category_totals(rollup, start=None, end=None):
+    """[(category name, total_amount)] by descending amount"""
+    summary = rollup.summary
+    revenue = func.sum(summary.total_amount).label('revenue')
+    query = db.session.query(Category.name, revenue).join(
+        Category, Category.id == summary.category_id
+    )
+    if start:
+        query = query.filter(summary.day >= start)
+    if end:
+        query = query.filter(summary.day <= end)
+    rows = query.group_by(Category.id, Category.name).order_by(revenue.desc()).all()
+    return [(name, float(total)) for name, total in rows if total]
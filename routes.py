@@ -380,17 +380,12 @@ def api_dashboard_charts():
     end_date = datetime.utcnow()
     start_date = end_date - timedelta(days=365)
     
-    monthly_sales = db.session.query(
-        func.date_trunc('month', Sale.sale_date).label('month'),
-        func.sum(Sale.total_amount).label('total')
-    ).filter(
-        Sale.sale_date >= start_date,
-        Sale.status != 'cancelado'
-    ).group_by('month').order_by('month').all()
+    from rollups import SALES, monthly_totals
+    monthly_sales = monthly_totals(SALES, start_date.date())
     
     sales_data = {
-        'labels': [sale.month.strftime('%b %Y') for sale in monthly_sales],
-        'data': [float(sale.total) for sale in monthly_sales]
+        'labels': [month.strftime('%b %Y') for month, total in monthly_sales],
+        'data': [total for month, total in monthly_sales]
     }
     
     # Get top products by sales
@@ -446,169 +441,9 @@ def analytics():
         return redirect(url_for('login'))
     
     try:
-        from models import Sale, Product, Purchase, Customer, SaleItem, PurchaseItem, Category
-        from datetime import datetime, timedelta
-        from sqlalchemy import func
-        
-        # Calculate analytics data
-        now = datetime.now()
-        last_30_days = now - timedelta(days=30)
-        last_60_days = now - timedelta(days=60)
-        
-        # Revenue growth calculation
-        current_revenue = db.session.query(func.sum(Sale.total_amount)).filter(
-            Sale.created_at >= last_30_days
-        ).scalar() or 0
-        
-        previous_revenue = db.session.query(func.sum(Sale.total_amount)).filter(
-            Sale.created_at >= last_60_days,
-            Sale.created_at < last_30_days
-        ).scalar() or 0
-        
-        revenue_growth = ((current_revenue - previous_revenue) / previous_revenue * 100) if previous_revenue > 0 else 0
-        
-        # Average order value
-        recent_sales = Sale.query.filter(Sale.created_at >= last_30_days).all()
-        avg_order_value = (sum(sale.total_amount for sale in recent_sales) / len(recent_sales)) if recent_sales else 0
-        
-        # Profit margin calculation
-        total_revenue = sum(sale.total_amount for sale in recent_sales)
-        total_purchase_costs = db.session.query(func.sum(Purchase.total_amount)).filter(
-            Purchase.created_at >= last_30_days
-        ).scalar() or 0
-        
-        profit_margin = ((total_revenue - total_purchase_costs) / total_revenue * 100) if total_revenue > 0 else 0
-        
-        # Inventory turnover (simplified)
-        total_products = Product.query.count()
-        sold_products = db.session.query(func.sum(SaleItem.quantity)).join(Sale).filter(
-            Sale.created_at >= last_30_days
-        ).scalar() or 0
-        inventory_turnover = (sold_products / total_products * 12) if total_products > 0 else 0
-        
-        # Revenue vs Purchase data for chart (last 7 days)
-        revenue_labels = []
-        revenue_data = []
-        purchase_data = []
-        
-        for i in range(7):
-            date = now - timedelta(days=6-i)
-            day_label = date.strftime('%d/%m')
-            revenue_labels.append(day_label)
-            
-            day_revenue = db.session.query(func.sum(Sale.total_amount)).filter(
-                func.date(Sale.created_at) == date.date()
-            ).scalar() or 0
-            revenue_data.append(float(day_revenue))
-            
-            day_purchases = db.session.query(func.sum(Purchase.total_amount)).filter(
-                func.date(Purchase.created_at) == date.date()
-            ).scalar() or 0
-            purchase_data.append(float(day_purchases))
-        
-        # Category sales distribution - simplified
-        try:
-            category_sales = []
-            categories = Category.query.all()
-            for category in categories:
-                total = db.session.query(func.sum(SaleItem.total_price)).select_from(
-                    SaleItem.__table__.join(Sale.__table__).join(Product.__table__)
-                ).filter(
-                    Product.category_id == category.id,
-                    Sale.created_at >= last_30_days
-                ).scalar() or 0
-                if total > 0:
-                    category_sales.append((category.name, total))
-            
-            category_labels = [item[0] for item in category_sales]
-            category_data = [float(item[1]) for item in category_sales]
-        except:
-            category_labels = []
-            category_data = []
-        
-        # Top products by sales - simplified
-        try:
-            top_products = []
-            products = Product.query.limit(20).all()  # Limit to avoid performance issues
-            for product in products:
-                total = db.session.query(func.sum(SaleItem.total_price)).select_from(
-                    SaleItem.__table__.join(Sale.__table__)
-                ).filter(
-                    SaleItem.product_id == product.id,
-                    Sale.created_at >= last_30_days
-                ).scalar() or 0
-                if total > 0:
-                    top_products.append((product.name, total))
-            
-            top_products = sorted(top_products, key=lambda x: x[1], reverse=True)[:5]
-            top_products_labels = [item[0] for item in top_products]
-            top_products_data = [float(item[1]) for item in top_products]
-        except:
-            top_products_labels = []
-            top_products_data = []
-        
-        # Margin analysis - simplified
-        margin_analysis = []
-        try:
-            for product in Product.query.limit(10).all():
-                volume = db.session.query(func.sum(SaleItem.quantity)).filter(
-                    SaleItem.product_id == product.id
-                ).scalar() or 0
-                if volume > 0:
-                    margin_analysis.append({'x': int(volume), 'y': float(product.profit_margin)})
-        except:
-            pass
-        
-        # Top customers - simplified
-        try:
-            top_customers = []
-            customers = Customer.query.limit(20).all()
-            for customer in customers:
-                sales_count = Sale.query.filter(
-                    Sale.customer_id == customer.id,
-                    Sale.created_at >= last_30_days
-                ).count()
-                total_amount = db.session.query(func.sum(Sale.total_amount)).filter(
-                    Sale.customer_id == customer.id,
-                    Sale.created_at >= last_30_days
-                ).scalar() or 0
-                if sales_count > 0:
-                    top_customers.append((customer.name, sales_count, total_amount))
-            
-            top_customers = sorted(top_customers, key=lambda x: x[2], reverse=True)[:5]
-        except:
-            top_customers = []
-        
-        # Stock alerts
-        stock_alerts = Product.query.filter(
-            Product.stock_quantity <= Product.min_stock
-        ).all()
-        
-        # Financial totals
-        total_costs = float(total_purchase_costs)
-        gross_profit = float(total_revenue - total_costs)
-        roi = (gross_profit / total_costs * 100) if total_costs > 0 else 0
+        from analytics_service import compute_analytics
         
-        analytics_data = {
-            'revenue_growth': round(revenue_growth, 1),
-            'profit_margin': round(profit_margin, 1),
-            'avg_order_value': float(avg_order_value),
-            'inventory_turnover': round(inventory_turnover, 1),
-            'revenue_labels': revenue_labels,
-            'revenue_data': revenue_data,
-            'purchase_data': purchase_data,
-            'category_labels': category_labels,
-            'category_data': category_data,
-            'top_products_labels': top_products_labels,
-            'top_products_data': top_products_data,
-            'margin_analysis': margin_analysis,
-            'top_customers': [{'name': c[0], 'sales_count': c[1], 'total_amount': float(c[2])} for c in top_customers],
-            'stock_alerts': stock_alerts,
-            'total_revenue': float(total_revenue),
-            'total_costs': total_costs,
-            'gross_profit': gross_profit,
-            'roi': round(roi, 1)
-        }
+        analytics_data = compute_analytics()
         
         return render_template('analytics.html', analytics=analytics_data)
         
@@ -0,0 +1,550 @@
+"""Streaming SAF-T PT (1.04_01) generator.
+
+The XML is written incrementally by ``XMLWriter`` and yielded in chunks, while
+the rows come from server-side cursors (``yield_per``), so a full fiscal year
+is exported in constant memory and without row limits.
+
+SAF-T puts ``NumberOfEntries``/``TotalDebit``/``TotalCredit`` before the
+documents they summarise. Sales invoices and payments are therefore produced
+in a single pass over the period's sales into spooled temporary files while
+the totals are accumulated; the totals are then written and the spools copied
+out behind them. Use it as the body of a streamed response:
+
+    Response(stream_with_context(generate_saft_xml(start, end)), ...)
+"""
+import re
+import tempfile
+from datetime import datetime, timedelta
+from decimal import Decimal
+from itertools import groupby
+from xml.sax.saxutils import escape, quoteattr
+
+from sqlalchemy import select
+
+from app import db
+from pricing import CENT, line_amounts, round_money, to_decimal
+from models import Category, Customer, Product, Purchase, Sale, SaleItem, Supplier, User
+
+NAMESPACE = 'urn:OECD:StandardAuditFile-Tax:PT_1.04_01'
+CHUNK_SIZE = 64 * 1024
+YIELD_PER = 1000
+SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+PROGRESS_EVERY = 500
+
+# Consumidor final, used when a customer has no NIF
+FINAL_CONSUMER_TAX_ID = '999999990'
+
+ACCOUNTS = [
+    ('11', 'Caixa'),
+    ('12', 'Depósitos à Ordem'),
+    ('21', 'Clientes'),
+    ('22', 'Fornecedores'),
+    ('31', 'Existências'),
+    ('71', 'Vendas'),
+    ('61', 'Compras')
+]
+
+TAX_TABLE = [
+    ('NOR', 'IVA Normal', '23.00'),
+    ('RED', 'IVA Reduzida', '6.00'),
+    ('INT', 'IVA Intermédia', '13.00'),
+]
+TAX_CODES = {Decimal(percentage): code for code, _, percentage in TAX_TABLE}
+
+# Sale.payment_method -> SAF-T PaymentMechanism
+PAYMENT_MECHANISMS = {
+    'dinheiro': 'NU',
+    'cartao': 'CC',
+    'multibanco': 'MB',
+    'transferencia': 'TB',
+    'cheque': 'CH',
+}
+PAID_STATUSES = ('pago', 'concluida')
+
+DOCUMENT_NUMBER = re.compile(r'^[^ ]+ [^/^ ]+/[0-9]+$')
+
+
+class XMLWriter:
+    """Minimal indented XML writer that hands out its buffer in chunks"""
+
+    def __init__(self, indent='  ', chunk_size=CHUNK_SIZE, depth=0):
+        self.indent = indent
+        self.chunk_size = chunk_size
+        self.depth = depth
+        self._stack = []
+        self._parts = []
+        self._size = 0
+
+    def _write(self, text):
+        self._parts.append(text)
+        self._size += len(text)
+
+    def _margin(self):
+        return self.indent * (self.depth + len(self._stack))
+
+    def declaration(self):
+        self._write('<?xml version="1.0" encoding="UTF-8"?>\n')
+
+    def start(self, tag, **attrs):
+        attributes = ''.join(f' {name}={quoteattr(str(value))}' for name, value in attrs.items())
+        self._write(f'{self._margin()}<{tag}{attributes}>\n')
+        self._stack.append(tag)
+
+    def end(self):
+        tag = self._stack.pop()
+        self._write(f'{self._margin()}</{tag}>\n')
+
+    def element(self, tag, text):
+        value = '' if text is None else escape(str(text))
+        self._write(f'{self._margin()}<{tag}>{value}</{tag}>\n')
+
+    def elements(self, pairs):
+        for tag, text in pairs:
+            self.element(tag, text)
+
+    def ready(self):
+        """True once enough output is buffered to be worth sending"""
+        return self._size >= self.chunk_size
+
+    def flush(self):
+        """Return the buffered output as UTF-8 bytes and clear the buffer"""
+        data = ''.join(self._parts).encode('utf-8')
+        self._parts = []
+        self._size = 0
+        return data
+
+
+def _stream(stmt):
+    """Execute ``stmt`` on a server-side cursor, yielding rows in batches"""
+    return db.session.execute(stmt.execution_options(yield_per=YIELD_PER))
+
+
+def _country_code(country):
+    if not country or country.strip().lower() in ('portugal', 'pt'):
+        return 'PT'
+    return country.strip()[:2].upper()
+
+
+def _period(column, start_date, end_date):
+    """Inclusive date range on a DateTime column"""
+    return (column >= start_date, column < end_date + timedelta(days=1))
+
+
+def generate_saft_xml(start_date, end_date, progress=None):
+    """Yield the SAF-T PT file for ``start_date``..``end_date`` as byte chunks.
+
+    ``progress``, if given, is called with the number of sales written so far
+    every ``PROGRESS_EVERY`` sales (used by the background job runner).
+    """
+    writer = XMLWriter()
+    writer.declaration()
+    writer.start('AuditFile', xmlns=NAMESPACE)
+
+    _write_header(writer, start_date, end_date)
+
+    writer.start('MasterFiles')
+    _write_accounts(writer)
+    yield writer.flush()
+
+    for section in (_write_customers, _write_suppliers, _write_products):
+        for chunk in section(writer, start_date, end_date):
+            yield chunk
+
+    _write_tax_table(writer)
+    writer.end()  # MasterFiles
+
+    yield writer.flush()
+
+    invoices, payments = _spool_documents(start_date, end_date, progress)
+    try:
+        writer.start('SourceDocuments')
+        for tag, spool in (('SalesInvoices', invoices), ('Payments', payments)):
+            writer.start(tag)
+            writer.elements([
+                ('NumberOfEntries', spool.entries),
+                ('TotalDebit', _money(spool.debit)),
+                ('TotalCredit', _money(spool.credit)),
+            ])
+            yield writer.flush()
+            for chunk in spool.read_chunks():
+                yield chunk
+            writer.end()
+    finally:
+        invoices.close()
+        payments.close()
+    writer.end()  # SourceDocuments
+
+    writer.end()  # AuditFile
+    yield writer.flush()
+
+
+def _write_header(writer, start_date, end_date):
+    import configuration
+    company = configuration.company()
+
+    writer.start('Header')
+    writer.elements([
+        ('AuditFileVersion', '1.04_01'),
+        ('CompanyID', company['tax_number']),
+        ('TaxRegistrationNumber', company['tax_number']),
+        ('TaxAccountingBasis', 'F'),
+        ('CompanyName', company['company_name']),
+    ])
+    writer.start('BusinessAddress')
+    writer.elements([
+        ('AddressDetail', company['address'] or 'Desconhecido'),
+        ('City', company['city'] or 'Desconhecido'),
+        ('PostalCode', company['postal_code'] or 'Desconhecido'),
+        ('Country', company['country'] or 'PT'),
+    ])
+    writer.end()
+    writer.elements([
+        ('FiscalYear', start_date.year),
+        ('StartDate', start_date.strftime('%Y-%m-%d')),
+        ('EndDate', end_date.strftime('%Y-%m-%d')),
+        ('CurrencyCode', 'EUR'),
+        ('DateCreated', datetime.now().strftime('%Y-%m-%d')),
+        ('TaxEntity', 'Global'),
+        ('ProductCompanyTaxID', '999999990'),
+        ('SoftwareCertificateNumber', '0'),
+        ('ProductID', 'GestVendas/2025'),
+        ('ProductVersion', '1.0'),
+    ])
+    # Optional contacts, in schema order
+    writer.elements([(tag, company[key]) for tag, key in
+                     (('Telephone', 'phone'), ('Email', 'email'), ('Website', 'website')) if company[key]])
+    writer.end()
+
+
+def _write_accounts(writer):
+    writer.start('GeneralLedgerAccounts')
+    for acc_id, acc_name in ACCOUNTS:
+        writer.start('Account')
+        writer.elements([
+            ('AccountID', acc_id),
+            ('AccountDescription', acc_name),
+            ('StandardAccountID', acc_id),
+            ('GroupingCategory', 'GR' if acc_id.startswith(('1', '2', '3')) else 'AR'),
+            ('GroupingCode', acc_id[0]),
+            ('TaxonomyCode', acc_id),
+        ])
+        writer.end()
+    writer.end()
+
+
+def _write_party(writer, tag, id_tag, tax_tag, account_id, row):
+    writer.start(tag)
+    writer.elements([
+        (id_tag, row.id),
+        ('AccountID', account_id),
+        (tax_tag, row.tax_number or FINAL_CONSUMER_TAX_ID),
+        ('CompanyName', row.name),
+    ])
+    writer.start('BillingAddress')
+    writer.elements([
+        ('AddressDetail', row.address or 'Desconhecido'),
+        ('City', row.city or 'Desconhecido'),
+        ('PostalCode', row.postal_code or 'Desconhecido'),
+        ('Country', _country_code(row.country)),
+    ])
+    writer.end()
+    writer.element('SelfBillingIndicator', '0')
+    writer.end()
+
+
+def _write_customers(writer, start_date, end_date):
+    """Every customer referenced by a sale in the period"""
+    referenced = select(Sale.customer_id).where(*_period(Sale.sale_date, start_date, end_date))
+    stmt = select(
+        Customer.id, Customer.name, Customer.tax_number, Customer.address,
+        Customer.city, Customer.postal_code, Customer.country
+    ).where(Customer.id.in_(referenced)).order_by(Customer.id)
+
+    for row in _stream(stmt):
+        _write_party(writer, 'Customer', 'CustomerID', 'CustomerTaxID', '21', row)
+        if writer.ready():
+            yield writer.flush()
+
+
+def _write_suppliers(writer, start_date, end_date):
+    """Every supplier referenced by a purchase in the period"""
+    referenced = select(Purchase.supplier_id).where(*_period(Purchase.purchase_date, start_date, end_date))
+    stmt = select(
+        Supplier.id, Supplier.name, Supplier.tax_number, Supplier.address,
+        Supplier.city, Supplier.postal_code, Supplier.country
+    ).where(Supplier.id.in_(referenced)).order_by(Supplier.id)
+
+    for row in _stream(stmt):
+        _write_party(writer, 'Supplier', 'SupplierID', 'SupplierTaxID', '22', row)
+        if writer.ready():
+            yield writer.flush()
+
+
+def _write_products(writer, start_date, end_date):
+    """Every product sold in the period"""
+    sold = select(SaleItem.product_id).join(Sale, Sale.id == SaleItem.sale_id).where(
+        *_period(Sale.sale_date, start_date, end_date)
+    )
+    stmt = select(
+        Product.id, Product.code, Product.name, Category.name.label('category_name')
+    ).outerjoin(Category, Category.id == Product.category_id).where(
+        Product.id.in_(sold)
+    ).order_by(Product.id)
+
+    for row in _stream(stmt):
+        writer.start('Product')
+        writer.elements([
+            ('ProductType', 'P'),
+            ('ProductCode', row.code or f'PROD{row.id:04d}'),
+            ('ProductGroup', row.category_name or 'Geral'),
+            ('ProductDescription', row.name),
+            ('ProductNumberCode', row.id),
+        ])
+        writer.end()
+        if writer.ready():
+            yield writer.flush()
+
+
+def _write_tax_table(writer):
+    writer.start('TaxTable')
+    for code, description, percentage in TAX_TABLE:
+        writer.start('TaxTableEntry')
+        writer.elements([
+            ('TaxType', 'IVA'),
+            ('TaxCountryRegion', 'PT'),
+            ('TaxCode', code),
+            ('Description', description),
+            ('TaxPercentage', percentage),
+        ])
+        writer.end()
+    writer.end()
+
+
+# =============== SOURCE DOCUMENTS ===============
+
+class _DocumentSpool:
+    """XML for one SourceDocuments section, buffered while its totals add up"""
+
+    def __init__(self, depth):
+        self.writer = XMLWriter(depth=depth)
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+        self.entries = 0
+        self.debit = Decimal('0')
+        self.credit = Decimal('0')
+
+    def commit(self):
+        if self.writer.ready():
+            self.file.write(self.writer.flush())
+
+    def read_chunks(self):
+        self.file.write(self.writer.flush())
+        self.file.seek(0)
+        while True:
+            chunk = self.file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+
+def _money(value):
+    return str(round_money(value))
+
+
+def _timestamp(value):
+    return (value or datetime.now()).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def _document_number(doc_type, number, document_id):
+    """SAF-T document numbers are '<type> <series>/<sequence>'
+
+    A numbered sale keeps its series and sequence under ``doc_type``, so
+    the receipt of 'FT 2026GV/372' is 'RG 2026GV/372'.
+    """
+    if number and DOCUMENT_NUMBER.match(number):
+        return f"{doc_type} {number.split(' ', 1)[1]}"
+    return f"{doc_type} {number or 'GV'}/{document_id}"
+
+
+def _tax_code(rate):
+    return TAX_CODES.get(Decimal(rate).quantize(CENT), 'OUT')
+
+
+def _spool_documents(start_date, end_date, progress=None):
+    """One pass over the period's sales, writing invoices and payments"""
+    invoices = _DocumentSpool(depth=3)
+    payments = _DocumentSpool(depth=3)
+
+    stmt = select(
+        Sale.id, Sale.invoice_number, Sale.sale_date, Sale.status, Sale.payment_method,
+        Sale.customer_id, Sale.created_at, Sale.updated_at, User.username,
+        SaleItem.quantity, SaleItem.unit_price, SaleItem.tax_rate,
+        Product.code.label('product_code'), Product.name.label('product_name'),
+        Product.unit.label('product_unit'),
+    ).select_from(Sale).join(User, User.id == Sale.user_id).outerjoin(
+        SaleItem, SaleItem.sale_id == Sale.id
+    ).outerjoin(Product, Product.id == SaleItem.product_id).where(
+        *_period(Sale.sale_date, start_date, end_date)
+    ).order_by(Sale.id, SaleItem.id)
+
+    for _, rows in groupby(_stream(stmt), key=lambda row: row.id):
+        rows = list(rows)
+        net_total, tax_payable = _write_invoice(invoices.writer, rows)
+        invoices.entries += 1
+        if progress and invoices.entries % PROGRESS_EVERY == 0:
+            progress(invoices.entries)
+
+        sale = rows[0]
+        if sale.status == 'cancelado':
+            invoices.commit()
+            continue
+        invoices.credit += net_total
+        invoices.commit()
+
+        if sale.status in PAID_STATUSES:
+            _write_payment(payments.writer, sale, net_total, tax_payable)
+            payments.entries += 1
+            payments.credit += net_total
+            payments.commit()
+
+    return invoices, payments
+
+
+def _write_invoice(writer, rows):
+    """Write one Invoice from its joined item rows, returning (net, tax)"""
+    sale = rows[0]
+    invoice_date = sale.sale_date.strftime('%Y-%m-%d')
+    source_id = sale.username
+
+    writer.start('Invoice')
+    writer.elements([
+        ('InvoiceNo', _document_number('FT', sale.invoice_number, sale.id)),
+        ('ATCUD', '0'),
+    ])
+    writer.start('DocumentStatus')
+    writer.elements([
+        ('InvoiceStatus', 'A' if sale.status == 'cancelado' else 'N'),
+        ('InvoiceStatusDate', _timestamp(sale.updated_at or sale.created_at)),
+        ('SourceID', source_id),
+        ('SourceBilling', 'P'),
+    ])
+    writer.end()
+    writer.elements([
+        ('Hash', '0'),
+        ('HashControl', '0'),
+        ('Period', sale.sale_date.month),
+        ('InvoiceDate', invoice_date),
+        ('InvoiceType', 'FT'),
+    ])
+    writer.start('SpecialRegimes')
+    writer.elements([
+        ('SelfBillingIndicator', '0'),
+        ('CashVATSchemeIndicator', '0'),
+        ('ThirdPartiesBillingIndicator', '0'),
+    ])
+    writer.end()
+    writer.elements([
+        ('SourceID', source_id),
+        ('SystemEntryDate', _timestamp(sale.created_at)),
+        ('CustomerID', sale.customer_id),
+    ])
+
+    net_total = Decimal('0')
+    tax_payable = Decimal('0')
+    line_number = 0
+    for row in rows:
+        if row.quantity is None:
+            continue
+        line_number += 1
+        rate = to_decimal(row.tax_rate, 0)
+        net, tax = line_amounts(row.quantity, row.unit_price, rate)
+        net_total += net
+        tax_payable += tax
+
+        writer.start('Line')
+        writer.elements([
+            ('LineNumber', line_number),
+            ('ProductCode', row.product_code),
+            ('ProductDescription', row.product_name),
+            ('Quantity', row.quantity),
+            ('UnitOfMeasure', row.product_unit or 'UN'),
+            ('UnitPrice', _money(row.unit_price)),
+            ('TaxPointDate', invoice_date),
+            ('Description', row.product_name),
+            ('CreditAmount', _money(net)),
+        ])
+        writer.start('Tax')
+        writer.elements([
+            ('TaxType', 'IVA'),
+            ('TaxCountryRegion', 'PT'),
+            ('TaxCode', _tax_code(rate)),
+            ('TaxPercentage', _money(rate)),
+        ])
+        writer.end()
+        writer.end()
+
+    writer.start('DocumentTotals')
+    writer.elements([
+        ('TaxPayable', _money(tax_payable)),
+        ('NetTotal', _money(net_total)),
+        ('GrossTotal', _money(net_total + tax_payable)),
+    ])
+    writer.end()
+    writer.end()
+
+    return net_total, tax_payable
+
+
+def _write_payment(writer, sale, net_total, tax_payable):
+    """Write the receipt (RG) of a paid sale"""
+    payment_date = sale.sale_date.strftime('%Y-%m-%d')
+    gross_total = net_total + tax_payable
+
+    writer.start('Payment')
+    writer.elements([
+        ('PaymentRefNo', _document_number('RG', sale.invoice_number, sale.id)),
+        ('ATCUD', '0'),
+        ('Period', sale.sale_date.month),
+        ('TransactionDate', payment_date),
+        ('PaymentType', 'RG'),
+    ])
+    writer.start('DocumentStatus')
+    writer.elements([
+        ('PaymentStatus', 'N'),
+        ('PaymentStatusDate', _timestamp(sale.updated_at or sale.created_at)),
+        ('SourceID', sale.username),
+        ('SourcePayment', 'P'),
+    ])
+    writer.end()
+    writer.start('PaymentMethod')
+    writer.elements([
+        ('PaymentMechanism', PAYMENT_MECHANISMS.get(sale.payment_method, 'OU')),
+        ('PaymentAmount', _money(gross_total)),
+        ('PaymentDate', payment_date),
+    ])
+    writer.end()
+    writer.elements([
+        ('SourceID', sale.username),
+        ('SystemEntryDate', _timestamp(sale.created_at)),
+        ('CustomerID', sale.customer_id),
+    ])
+    writer.start('Line')
+    writer.element('LineNumber', 1)
+    writer.start('SourceDocumentID')
+    writer.elements([
+        ('OriginatingON', _document_number('FT', sale.invoice_number, sale.id)),
+        ('InvoiceDate', payment_date),
+    ])
+    writer.end()
+    writer.element('CreditAmount', _money(net_total))
+    writer.end()
+    writer.start('DocumentTotals')
+    writer.elements([
+        ('TaxPayable', _money(tax_payable)),
+        ('NetTotal', _money(net_total)),
+        ('GrossTotal', _money(gross_total)),
+    ])
+    writer.end()
+    writer.end()
@@ -0,0 +1,76 @@
+"""Product lookup for the sale/purchase forms (``/api/products/search``).
+
+Matches, best first:
+
+1. an exact ``code`` (what a barcode scanner types), through the unique
+   index on ``products.code``;
+2. names starting with the term;
+3. names containing the term, or similar to it (typos), ranked by trigram
+   ``similarity()``.
+
+On PostgreSQL steps 2 and 3 are served by ``ix_products_name_trgm``, a GIN
+``gin_trgm_ops`` index, so a lookup does not scan the catalogue. Trigrams
+need at least three characters, so shorter terms only match on the name
+prefix. Other databases fall back to plain ``LIKE`` without the fuzzy part.
+"""
+from sqlalchemy import func, or_, select
+
+from app import db
+from models import Product
+
+LIMIT = 10
+MAX_LIMIT = 50
+TRIGRAM_MIN_LENGTH = 3
+
+COLUMNS = (Product.id, Product.code, Product.name, Product.unit, Product.sale_price, Product.purchase_price,
+           Product.tax_rate, Product.stock_quantity, Product.min_stock)
+
+
+def _like_escape(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def search_statement(term, limit=LIMIT, in_stock=False):
+    """The SELECT of the active products matching ``term``, best first (``limit`` is kept within 1..MAX_LIMIT)"""
+    trigrams = db.session.get_bind().dialect.name == 'postgresql'
+    prefix = _like_escape(term) + '%'
+    starts_with = Product.name.ilike(prefix, escape='\\')
+
+    matches = [Product.code == term]
+    ranking = [(Product.code == term).desc()]
+    if len(term) >= TRIGRAM_MIN_LENGTH:
+        matches.append(Product.name.ilike('%' + prefix, escape='\\'))
+        ranking.append(starts_with.desc())
+        if trigrams:
+            matches.append(Product.name.bool_op('%')(term))
+            ranking.append(func.similarity(Product.name, term).desc())
+    else:
+        matches.append(starts_with)
+    ranking.extend((Product.name, Product.id))
+
+    stmt = select(*COLUMNS).where(Product.is_active == True, or_(*matches))  # noqa: E712
+    if in_stock:
+        stmt = stmt.where(Product.stock_quantity > 0)
+    return stmt.order_by(*ranking).limit(max(1, min(limit, MAX_LIMIT)))
+
+
+def search_products(term, limit=LIMIT, in_stock=False):
+    """Rows of the active products matching ``term``, best first"""
+    term = (term or '').strip()
+    if not term:
+        return []
+    return db.session.execute(search_statement(term, limit, in_stock)).all()
+
+
+def as_json(row):
+    return {
+        'id': row.id,
+        'code': row.code,
+        'name': row.name,
+        'unit': row.unit,
+        'sale_price': float(row.sale_price or 0),
+        'purchase_price': float(row.purchase_price or 0),
+        'tax_rate': float(row.tax_rate or 0),
+        'stock_quantity': row.stock_quantity,
+        'low_stock': row.stock_quantity <= (row.min_stock or 0),
+    }
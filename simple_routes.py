@@ -1,8 +1,41 @@
-from flask import render_template, request, redirect, url_for, flash, session
+from flask import render_template, request, redirect, url_for, flash, session, jsonify, stream_with_context
 from app import app, db
+from query_budget import query_budget
+from stock import InsufficientStock, open_stock, post_movement
+from pricing import lines_from_form, price_document
+from numbering import PURCHASE, SALE, current_terminal, next_number
+from metrics import sale_posted
+from cache import cache
+from sqlalchemy import select
 from datetime import datetime
 import secrets
 
+# =============== CACHED LOOKUPS ===============
+# Rows, not ORM objects (see cache.py); tags are the tables read.
+
+@cache.cached('active_categories', tags=('categories',))
+def active_categories():
+    from models import Category
+    return db.session.execute(
+        select(Category.id, Category.name).where(Category.is_active == True).order_by(Category.name)
+    ).all()
+
+@cache.cached('dashboard_totals', tags=('sales', 'purchases'))
+def dashboard_totals(month_start):
+    """All-time and month-to-date totals from the daily rollups"""
+    from rollups import SALES, PURCHASES, totals
+    return {
+        'total_sales': totals(SALES)['total_amount'],
+        'total_purchases': totals(PURCHASES)['total_amount'],
+        'monthly_sales': totals(SALES, start=month_start)['total_amount'],
+        'monthly_purchases': totals(PURCHASES, start=month_start)['total_amount'],
+    }
+
+def recent_sales_query(limit=5):
+    """Latest sales with their customer's name (also planned by ``flask check-indexes``)"""
+    from models import Sale, Customer
+    return db.session.query(Sale, Customer.name).join(Customer).order_by(Sale.created_at.desc()).limit(limit)
+
 @app.route('/')
 def index():
     return render_template('login.html')
@@ -41,47 +74,38 @@ def login():
             else:
                 flash('Credenciais inválidas. Verifique o utilizador/email e palavra-passe.', 'error')
                 
-        except Exception as e:
-            print(f"Error during login: {e}")
+        except Exception:
+            app.logger.exception("Error during login")
             flash('Erro de base de dados. Tente novamente.', 'error')
     
     return render_template('login.html')
 
 @app.route('/dashboard')
+@query_budget(8)
 def dashboard():
     if not session.get('user_id'):
         return redirect(url_for('login'))
     
     try:
-        from models import Sale, Purchase, Product, Customer
-        from datetime import datetime, timedelta
-        from sqlalchemy import func
-        
-        # Calculate real statistics
-        total_sales = db.session.query(func.sum(Sale.total_amount)).scalar() or 0
-        total_purchases = db.session.query(func.sum(Purchase.total_amount)).scalar() or 0
+        from models import Sale, Product, Customer
         
-        # Monthly data
-        month_start = datetime.now().replace(day=1)
-        monthly_sales = db.session.query(func.sum(Sale.total_amount)).filter(
-            Sale.created_at >= month_start
-        ).scalar() or 0
-        monthly_purchases = db.session.query(func.sum(Purchase.total_amount)).filter(
-            Purchase.created_at >= month_start
-        ).scalar() or 0
+        # Totals come from the daily rollups (cached until a sale or purchase is posted)
+        month_start = datetime.now().date().replace(day=1)
+        totals = dashboard_totals(month_start)
+        total_sales = totals['total_sales']
+        total_purchases = totals['total_purchases']
+        monthly_sales = totals['monthly_sales']
+        monthly_purchases = totals['monthly_purchases']
         
-        # Stock alerts
-        low_stock_alerts = Product.query.filter(
-            Product.stock_quantity <= Product.min_stock
-        ).count()
+        # Stock alerts: live stock against the nightly reorder points
+        from replenishment import restock_query
+        low_stock_alerts = restock_query().count()
         
         # Recent sales
-        recent_sales = Sale.query.order_by(Sale.created_at.desc()).limit(5).all()
+        recent_sales = recent_sales_query().all()
         
-        # Products needing restock
-        restock_products = Product.query.filter(
-            Product.stock_quantity <= Product.min_stock
-        ).limit(5).all()
+        # Products needing restock, furthest below their reorder point first
+        restock_products = restock_query().limit(5).all()
         
         stats = {
             'monthly_sales': float(monthly_sales),
@@ -96,8 +120,8 @@ def dashboard():
         
         return render_template('index.html', stats=stats)
         
-    except Exception as e:
-        print(f"Dashboard error: {e}")
+    except Exception:
+        app.logger.exception("Dashboard error")
         # Fallback to basic stats
         stats = {
             'monthly_sales': 0,
@@ -118,51 +142,22 @@ def logout():
     return redirect(url_for('login'))
 
 @app.route('/analytics')
+@query_budget(12)
 def analytics():
     if not session.get('user_id'):
         return redirect(url_for('login'))
     
-    # Simplified analytics with all required fields
-    analytics_data = {
-        # Basic metrics
-        'total_sales': 1250.50,
-        'total_purchases': 800.30,
-        'total_customers': 15,
-        'total_products': 25,
-        'monthly_sales': 450.25,
-        'weekly_sales': 125.75,
-        'profit': 450.20,
-        'profit_margin': 36.0,
-        'avg_order_value': 83.37,
-        'revenue_growth': 15.5,
-        
-        # Chart data
-        'sales_data': [450, 125, 1250],
-        'purchase_data': [800, 0, 0],
-        'category_labels': ['Eletrónicos', 'Roupas', 'Casa', 'Alimentação', 'Livros'],
-        'category_data': [250, 200, 300, 150, 350],
-        
-        # Additional metrics
-        'inventory_turnover': 2.5,
-        'top_products_labels': ['Smartphone', 'Laptop', 'Tablet', 'Headphones', 'Keyboard'],
-        'top_products_data': [300, 250, 200, 150, 100],
-        'top_customers': [],
-        'margin_analysis': [],
-        
-        # Template expected fields
-        'total_revenue': 1250.50,
-        'monthly_revenue': 450.25,
-        'purchase_cost': 800.30,
-        'stock_alerts': 3,
-        'total_costs': 800.30,
-        'gross_profit': 450.20,
-        'roi': 56.3,
-        
-        # Stock management
-        'low_stock_products': []
-    }
-    
-    return render_template('analytics_simple.html', analytics=analytics_data)
+    try:
+        from analytics_service import compute_analytics
+        
+        analytics_data = compute_analytics()
+        
+        return render_template('analytics.html', analytics=analytics_data)
+        
+    except Exception:
+        app.logger.exception("Error in analytics")
+        flash('Erro ao carregar análises.', 'error')
+        return redirect(url_for('dashboard'))
 
 @app.route('/saft')
 def saft():
@@ -177,8 +172,7 @@ def generate_saft():
         return redirect(url_for('login'))
     
     from datetime import datetime
-    from xml.etree.ElementTree import Element, SubElement, tostring
-    from xml.dom import minidom
+    from jobs import enqueue
     
     # Get date range from form
     start_date = request.form.get('start_date', '')
@@ -189,301 +183,112 @@ def generate_saft():
         return redirect(url_for('saft'))
     
     try:
-        # Convert dates
-        start_dt = datetime.strptime(start_date, '%Y-%m-%d')
-        end_dt = datetime.strptime(end_date, '%Y-%m-%d')
+        # Validate dates
+        datetime.strptime(start_date, '%Y-%m-%d')
+        datetime.strptime(end_date, '%Y-%m-%d')
         
-        # Generate SAFT XML
-        xml_content = generate_saft_xml(start_dt, end_dt)
+        # The file is built by the job worker; the status page offers the download
+        job = enqueue('saft', {'start_date': start_date, 'end_date': end_date}, session['user_id'])
         
-        # Create response with XML file
-        from flask import Response
+        flash(f'Ficheiro SAF-T em preparação para o período {start_date} a {end_date}.', 'success')
+        return redirect(url_for('job_status', id=job.id))
         
-        filename = f"SAF-T_PT_{start_date}_{end_date}.xml"
-        response = Response(
-            xml_content,
-            mimetype='application/xml',
-            headers={'Content-Disposition': f'attachment; filename={filename}'}
-        )
-        
-        flash(f'Ficheiro SAF-T gerado com sucesso para o período {start_date} a {end_date}.', 'success')
-        return response
-        
-    except Exception as e:
-        print(f"SAFT generation error: {e}")
+    except Exception:
+        app.logger.exception("SAFT generation error")
         flash('Erro ao gerar ficheiro SAF-T. Tente novamente.', 'error')
         return redirect(url_for('saft'))
 
-def generate_saft_xml(start_date, end_date):
-    """Generate SAF-T PT XML according to Portuguese regulation"""
-    from xml.etree.ElementTree import Element, SubElement
-    from xml.dom import minidom
-    from datetime import datetime
+# Background jobs
+def _visible_job(id):
+    """The job, if the logged in user may see it (owner or admin)"""
+    from models import Job
+    
+    job = Job.query.get_or_404(id)
+    if job.user_id != session.get('user_id') and session.get('user_role') != 'admin':
+        return None
+    return job
+
+@app.route('/jobs')
+def jobs():
+    if not session.get('user_id'):
+        return redirect(url_for('login'))
     
-    # Root element
-    root = Element('AuditFile', xmlns="urn:OECD:StandardAuditFile-Tax:PT_1.04_01")
-    
-    # Header
-    header = SubElement(root, 'Header')
-    SubElement(header, 'AuditFileVersion').text = '1.04_01'
-    SubElement(header, 'CompanyID').text = '999999990'
-    SubElement(header, 'TaxRegistrationNumber').text = '999999990'
-    SubElement(header, 'TaxAccountingBasis').text = 'F'
-    SubElement(header, 'CompanyName').text = 'GestVendas'
-    
-    # Company address
-    business_address = SubElement(header, 'BusinessAddress')
-    SubElement(business_address, 'AddressDetail').text = 'Rua Exemplo, 123'
-    SubElement(business_address, 'City').text = 'Lisboa'
-    SubElement(business_address, 'PostalCode').text = '1000-000'
-    SubElement(business_address, 'Country').text = 'PT'
-    
-    # Fiscal year
-    SubElement(header, 'FiscalYear').text = str(start_date.year)
-    SubElement(header, 'StartDate').text = start_date.strftime('%Y-%m-%d')
-    SubElement(header, 'EndDate').text = end_date.strftime('%Y-%m-%d')
-    SubElement(header, 'CurrencyCode').text = 'EUR'
-    SubElement(header, 'DateCreated').text = datetime.now().strftime('%Y-%m-%d')
-    SubElement(header, 'TaxEntity').text = 'Global'
-    SubElement(header, 'ProductCompanyTaxID').text = '999999990'
-    SubElement(header, 'SoftwareCertificateNumber').text = '0'
-    SubElement(header, 'ProductID').text = 'GestVendas/2025'
-    SubElement(header, 'ProductVersion').text = '1.0'
-    
-    # Master Files
-    master_files = SubElement(root, 'MasterFiles')
-    
-    # General Ledger Accounts
-    general_ledger_accounts = SubElement(master_files, 'GeneralLedgerAccounts')
-    
-    # Add sample accounts
-    accounts = [
-        ('11', 'Caixa'),
-        ('12', 'Depósitos à Ordem'),
-        ('21', 'Clientes'),
-        ('22', 'Fornecedores'),
-        ('31', 'Existências'),
-        ('71', 'Vendas'),
-        ('61', 'Compras')
-    ]
-    
-    for acc_id, acc_name in accounts:
-        account = SubElement(general_ledger_accounts, 'Account')
-        SubElement(account, 'AccountID').text = acc_id
-        SubElement(account, 'AccountDescription').text = acc_name
-        SubElement(account, 'StandardAccountID').text = acc_id
-        SubElement(account, 'GroupingCategory').text = 'GR' if acc_id.startswith(('1', '2', '3')) else 'AR'
-        SubElement(account, 'GroupingCode').text = acc_id[0]
-        SubElement(account, 'TaxonomyCode').text = acc_id
-    
-    # Customers
-    customers = SubElement(master_files, 'Customer')
+    from models import Job
     
-    try:
-        from models import Customer
-        db_customers = Customer.query.filter(
-            Customer.created_at >= start_date,
-            Customer.created_at <= end_date
-        ).all()
-        
-        for i, customer in enumerate(db_customers[:10], 1):  # Limit to 10 customers
-            cust = SubElement(customers, 'Customer')
-            SubElement(cust, 'CustomerID').text = str(customer.id)
-            SubElement(cust, 'AccountID').text = '21'
-            SubElement(cust, 'CustomerTaxID').text = customer.tax_number or f'99999999{i:01d}'
-            SubElement(cust, 'CompanyName').text = customer.name
-            
-            # Billing address
-            billing_addr = SubElement(cust, 'BillingAddress')
-            SubElement(billing_addr, 'AddressDetail').text = customer.address or 'Endereço não especificado'
-            SubElement(billing_addr, 'City').text = customer.city or 'Lisboa'
-            SubElement(billing_addr, 'PostalCode').text = customer.postal_code or '1000-000'
-            SubElement(billing_addr, 'Country').text = customer.country or 'PT'
-            
-            SubElement(cust, 'SelfBillingIndicator').text = '0'
-            
-    except:
-        # Fallback customer data
-        cust = SubElement(customers, 'Customer')
-        SubElement(cust, 'CustomerID').text = '1'
-        SubElement(cust, 'AccountID').text = '21'
-        SubElement(cust, 'CustomerTaxID').text = '999999991'
-        SubElement(cust, 'CompanyName').text = 'Cliente Geral'
-        
-        billing_addr = SubElement(cust, 'BillingAddress')
-        SubElement(billing_addr, 'AddressDetail').text = 'Rua do Cliente, 456'
-        SubElement(billing_addr, 'City').text = 'Porto'
-        SubElement(billing_addr, 'PostalCode').text = '4000-000'
-        SubElement(billing_addr, 'Country').text = 'PT'
-        
-        SubElement(cust, 'SelfBillingIndicator').text = '0'
+    query = Job.query
+    if session.get('user_role') != 'admin':
+        query = query.filter(Job.user_id == session['user_id'])
+    recent_jobs = query.order_by(Job.id.desc()).limit(50).all()
     
-    # Suppliers
-    suppliers = SubElement(master_files, 'Supplier')
+    return render_template('jobs.html', jobs=recent_jobs)
+
+@app.route('/jobs/<int:id>')
+def job_status(id):
+    if not session.get('user_id'):
+        return redirect(url_for('login'))
     
-    try:
-        from models import Supplier
-        db_suppliers = Supplier.query.filter(
-            Supplier.created_at >= start_date,
-            Supplier.created_at <= end_date
-        ).all()
-        
-        for i, supplier in enumerate(db_suppliers[:5], 1):  # Limit to 5 suppliers
-            supp = SubElement(suppliers, 'Supplier')
-            SubElement(supp, 'SupplierID').text = str(supplier.id)
-            SubElement(supp, 'AccountID').text = '22'
-            SubElement(supp, 'SupplierTaxID').text = supplier.tax_number or f'99999998{i:01d}'
-            SubElement(supp, 'CompanyName').text = supplier.name
-            
-            # Billing address
-            billing_addr = SubElement(supp, 'BillingAddress')
-            SubElement(billing_addr, 'AddressDetail').text = supplier.address or 'Endereço não especificado'
-            SubElement(billing_addr, 'City').text = supplier.city or 'Lisboa'
-            SubElement(billing_addr, 'PostalCode').text = supplier.postal_code or '1000-000'
-            SubElement(billing_addr, 'Country').text = supplier.country or 'PT'
-            
-            SubElement(supp, 'SelfBillingIndicator').text = '0'
-            
-    except:
-        # Fallback supplier data
-        supp = SubElement(suppliers, 'Supplier')
-        SubElement(supp, 'SupplierID').text = '1'
-        SubElement(supp, 'AccountID').text = '22'
-        SubElement(supp, 'SupplierTaxID').text = '999999989'
-        SubElement(supp, 'CompanyName').text = 'Fornecedor Geral'
-        
-        billing_addr = SubElement(supp, 'BillingAddress')
-        SubElement(billing_addr, 'AddressDetail').text = 'Rua do Fornecedor, 789'
-        SubElement(billing_addr, 'City').text = 'Braga'
-        SubElement(billing_addr, 'PostalCode').text = '4700-000'
-        SubElement(billing_addr, 'Country').text = 'PT'
-        
-        SubElement(supp, 'SelfBillingIndicator').text = '0'
+    job = _visible_job(id)
+    if job is None:
+        flash('Acesso negado.', 'error')
+        return redirect(url_for('jobs'))
     
-    # Products
-    products = SubElement(master_files, 'Product')
+    return render_template('job_status.html', job=job)
+
+@app.route('/jobs/<int:id>/download')
+def job_download(id):
+    if not session.get('user_id'):
+        return redirect(url_for('login'))
     
-    try:
-        from models import Product
-        db_products = Product.query.filter(
-            Product.created_at >= start_date,
-            Product.created_at <= end_date
-        ).all()
-        
-        for product in db_products[:20]:  # Limit to 20 products
-            prod = SubElement(products, 'Product')
-            SubElement(prod, 'ProductType').text = 'P'
-            SubElement(prod, 'ProductCode').text = product.code or f'PROD{product.id:04d}'
-            SubElement(prod, 'ProductGroup').text = product.category.name if product.category else 'Geral'
-            SubElement(prod, 'ProductDescription').text = product.name
-            SubElement(prod, 'ProductNumberCode').text = str(product.id)
-            
-    except:
-        # Fallback product data
-        prod = SubElement(products, 'Product')
-        SubElement(prod, 'ProductType').text = 'P'
-        SubElement(prod, 'ProductCode').text = 'PROD0001'
-        SubElement(prod, 'ProductGroup').text = 'Geral'
-        SubElement(prod, 'ProductDescription').text = 'Produto Demonstração'
-        SubElement(prod, 'ProductNumberCode').text = '1'
-    
-    # Tax Table
-    tax_table = SubElement(master_files, 'TaxTable')
-    
-    # IVA Normal (23%)
-    tax_entry = SubElement(tax_table, 'TaxTableEntry')
-    SubElement(tax_entry, 'TaxType').text = 'IVA'
-    SubElement(tax_entry, 'TaxCountryRegion').text = 'PT'
-    SubElement(tax_entry, 'TaxCode').text = 'NOR'
-    SubElement(tax_entry, 'Description').text = 'IVA Normal'
-    SubElement(tax_entry, 'TaxPercentage').text = '23.00'
-    
-    # IVA Reduzida (6%)
-    tax_entry2 = SubElement(tax_table, 'TaxTableEntry')
-    SubElement(tax_entry2, 'TaxType').text = 'IVA'
-    SubElement(tax_entry2, 'TaxCountryRegion').text = 'PT'
-    SubElement(tax_entry2, 'TaxCode').text = 'RED'
-    SubElement(tax_entry2, 'Description').text = 'IVA Reduzida'
-    SubElement(tax_entry2, 'TaxPercentage').text = '6.00'
-    
-    # IVA Intermédia (13%)
-    tax_entry3 = SubElement(tax_table, 'TaxTableEntry')
-    SubElement(tax_entry3, 'TaxType').text = 'IVA'
-    SubElement(tax_entry3, 'TaxCountryRegion').text = 'PT'
-    SubElement(tax_entry3, 'TaxCode').text = 'INT'
-    SubElement(tax_entry3, 'Description').text = 'IVA Intermédia'
-    SubElement(tax_entry3, 'TaxPercentage').text = '13.00'
-    
-    # Generate Sales Invoices section
-    source_documents = SubElement(root, 'SourceDocuments')
-    sales_invoices = SubElement(source_documents, 'SalesInvoices')
-    
-    # Sales invoices summary
-    SubElement(sales_invoices, 'NumberOfEntries').text = '0'
-    SubElement(sales_invoices, 'TotalDebit').text = '0.00'
-    SubElement(sales_invoices, 'TotalCredit').text = '0.00'
-    
-    # Payments section
-    payments = SubElement(source_documents, 'Payments')
-    SubElement(payments, 'NumberOfEntries').text = '0'
-    SubElement(payments, 'TotalDebit').text = '0.00'
-    SubElement(payments, 'TotalCredit').text = '0.00'
-    
-    # Convert to string with proper formatting
-    rough_string = tostring(root, encoding='unicode')
-    reparsed = minidom.parseString(rough_string)
-    pretty = reparsed.toprettyxml(indent='  ', encoding='UTF-8')
-    
-    return pretty
+    import os
+    from flask import send_file
+    
+    job = _visible_job(id)
+    if job is None or not job.artifact_path or not os.path.exists(job.artifact_path):
+        flash('Ficheiro não disponível.', 'error')
+        return redirect(url_for('jobs'))
+    
+    # HTML reports open in the browser, everything else is downloaded
+    return send_file(job.artifact_path,
+                     mimetype=job.artifact_mimetype,
+                     as_attachment=job.artifact_mimetype != 'text/html',
+                     download_name=job.artifact_name)
 
 @app.route('/settings')
 def settings():
     if not session.get('user_id'):
         return redirect(url_for('login'))
     
-    return render_template('settings.html')
+    import configuration
+    return render_template('settings.html', system=configuration.system())
 
 @app.route('/company-settings')
 def company_settings():
     if not session.get('user_id'):
         return redirect(url_for('login'))
     
-    return render_template('company_settings.html')
+    import configuration
+    return render_template('company_settings.html', company=configuration.company())
 
 @app.route('/update-company-settings', methods=['POST'])
 def update_company_settings():
     if not session.get('user_id'):
         return redirect(url_for('login'))
     
+    import configuration
+    
     try:
-        # Get form data
-        company_name = request.form.get('company_name', 'GestVendas')
-        tax_number = request.form.get('tax_number', '999999990')
-        address = request.form.get('address', '')
-        city = request.form.get('city', '')
-        postal_code = request.form.get('postal_code', '')
-        country = request.form.get('country', 'PT')
-        phone = request.form.get('phone', '')
-        email = request.form.get('email', '')
-        website = request.form.get('website', '')
-        
-        # For now, store in session (could be extended to database)
-        session['company_settings'] = {
-            'company_name': company_name,
-            'tax_number': tax_number,
-            'address': address,
-            'city': city,
-            'postal_code': postal_code,
-            'country': country,
-            'phone': phone,
-            'email': email,
-            'website': website
-        }
+        configuration.update({key: request.form.get(key, '').strip() for key in configuration.COMPANY
+                              if key in request.form})
+        db.session.commit()
         
         flash('Configurações da empresa atualizadas com sucesso!', 'success')
         
-    except Exception as e:
-        print(f"Company settings error: {e}")
+    except ValueError as e:
+        db.session.rollback()
+        flash(f'Erro ao atualizar configurações da empresa: {e}', 'error')
+    except Exception:
+        db.session.rollback()
+        app.logger.exception("Company settings error")
         flash('Erro ao atualizar configurações da empresa.', 'error')
     
     return redirect(url_for('company_settings'))
@@ -493,33 +298,26 @@ def update_system_settings():
     if not session.get('user_id'):
         return redirect(url_for('login'))
     
+    import configuration
+    
     try:
-        # Get form data
-        currency = request.form.get('currency', 'EUR')
-        date_format = request.form.get('date_format', 'dd/mm/yyyy')
-        decimal_places = int(request.form.get('decimal_places', 2))
-        thousand_separator = request.form.get('thousand_separator', ',')
-        decimal_separator = request.form.get('decimal_separator', '.')
-        auto_backup = request.form.get('auto_backup') == 'on'
-        email_notifications = request.form.get('email_notifications') == 'on'
-        low_stock_threshold = int(request.form.get('low_stock_threshold', 10))
-        
-        # Store in session
-        session['system_settings'] = {
-            'currency': currency,
-            'date_format': date_format,
-            'decimal_places': decimal_places,
-            'thousand_separator': thousand_separator,
-            'decimal_separator': decimal_separator,
-            'auto_backup': auto_backup,
-            'email_notifications': email_notifications,
-            'low_stock_threshold': low_stock_threshold
-        }
+        changes = {}
+        for key, (data_type, _, _) in configuration.SYSTEM.items():
+            if data_type == 'boolean':
+                changes[key] = request.form.get(key) == 'on'  # unchecked boxes are not posted
+            elif key in request.form:
+                changes[key] = request.form[key]
+        configuration.update(changes)
+        db.session.commit()
         
         flash('Configurações do sistema atualizadas com sucesso!', 'success')
         
-    except Exception as e:
-        print(f"System settings error: {e}")
+    except ValueError as e:
+        db.session.rollback()
+        flash(f'Erro ao atualizar configurações do sistema: {e}', 'error')
+    except Exception:
+        db.session.rollback()
+        app.logger.exception("System settings error")
         flash('Erro ao atualizar configurações do sistema.', 'error')
     
     return redirect(url_for('settings'))
@@ -574,9 +372,9 @@ def setup_db():
         for sql in sql_commands:
             try:
                 db.session.execute(db.text(sql))
-            except Exception as e:
+            except Exception:
                 # Continue even if individual commands fail
-                print(f"SQL command failed: {e}")
+                app.logger.exception("SQL command failed")
         
         db.session.commit()
         
@@ -619,279 +417,401 @@ def test_db():
 
 # Products routes
 @app.route('/products')
+@query_budget(4)
 def products():
     if not session.get('user_id'):
         return redirect(url_for('login'))
     
     try:
-        from models import Category, Product
+        from listing import PRODUCTS
         
         # Get categories safely
         categories = []
         try:
-            categories_query = Category.query.filter_by(is_active=True)
-            categories = list(categories_query.all())
-        except Exception as cat_error:
-            print(f"Category query error: {cat_error}")
+            categories = active_categories()
+        except Exception:
+            app.logger.exception("Category query error")
         
-        # Get products safely
-        products_list = []
-        try:
-            products_query = Product.query.filter_by(is_active=True)
-            products_list = list(products_query.all())
-        except Exception as prod_error:
-            print(f"Product query error: {prod_error}")
-        
-        products_data = {
-            'data': products_list,
-            'total': len(products_list)
-        }
+        products_data = PRODUCTS.page(request.args)
         
         return render_template('products.html', 
                              products=products_data, 
                              categories=categories, 
-                             search='', 
-                             selected_category='')
+                             search=request.args.get('search', ''), 
+                             selected_category=request.args.get('category', type=int),
+                             selected_abc=request.args.get('abc', ''),
+                             selected_xyz=request.args.get('xyz', ''))
     except Exception as e:
-        print(f"Products route error: {e}")
+        app.logger.exception("Products route error")
         flash(f'Erro ao carregar produtos: {str(e)}', 'error')
         return redirect(url_for('dashboard'))
 
-# Customers routes  
+@app.route('/api/products/search')
+def api_search_products():
+    if not session.get('user_id'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    from search import LIMIT, as_json, search_products
+    
+    rows = search_products(request.args.get('q', ''),
+                           limit=request.args.get('limit', LIMIT, type=int),
+                           in_stock=request.args.get('in_stock') == '1')
+    return jsonify([as_json(row) for row in rows])
+
+@app.route('/api/catalogue/<name>')
+def api_catalogue(name):
+    if not session.get('user_id'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    from catalogue import CATALOGUES
+    
+    catalogue = CATALOGUES.get(name)
+    if catalogue is None:
+        return jsonify({'error': 'Not found'}), 404
+    
+    since = request.args.get('since')
+    version, count = catalogue.meta()
+    etag = catalogue.etag(version, count, since)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(catalogue.snapshot(since))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/export/<name>.<format>')
+def export_list(name, format):
+    if not session.get('user_id'):
+        return redirect(url_for('login'))
+
+    from exports import EXPORTS, FORMATS
+
+    export = EXPORTS.get(name)
+    if export is None or format not in FORMATS:
+        flash('Exportação não disponível.', 'error')
+        return redirect(url_for('dashboard'))
+
+    # Rows are read and encoded while the response is sent (see exports.py)
+    response = app.response_class(stream_with_context(export.generate(format, request.args)),
+                                  mimetype=FORMATS[format])
+    response.headers['Content-Disposition'] = f'attachment; filename="{export.filename(format)}"'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/import/<name>', methods=['GET', 'POST'])
+def import_list(name):
+    if not session.get('user_id'):
+        return redirect(url_for('login'))
+
+    from importer import IMPORTS
+
+    entity = IMPORTS.get(name)
+    if entity is None:
+        flash('Importação não disponível.', 'error')
+        return redirect(url_for('dashboard'))
+
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Selecione um ficheiro CSV.', 'error')
+            return redirect(url_for('import_list', name=name))
+
+        try:
+            import os
+            from jobs import artifacts_dir, enqueue
+
+            # The worker reads the file from the jobs directory and removes it when done
+            path = os.path.join(artifacts_dir(), f"import_{name}_{secrets.token_hex(8)}.csv")
+            upload.save(path)
+            job = enqueue('import', {'name': name, 'path': path, 'filename': upload.filename}, session['user_id'])
+            flash('Importação em fila. Pode acompanhar o progresso nesta página.', 'info')
+            return redirect(url_for('job_status', id=job.id))
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception("Error queuing import")
+            flash(f'Erro ao importar ficheiro: {str(e)}', 'error')
+
+    return render_template('import.html', entity=entity)
+
+# Customers routes
 @app.route('/customers')
+@query_budget(3)
 def customers():
     if not session.get('user_id'):
         return redirect(url_for('login'))
     
-    customers_list = []
-    # Simple, safe query without complex error handling
     try:
-        from models import Customer
-        results = Customer.query.all()
-        customers_list = [customer for customer in results if customer.is_active]
-    except Exception as e:
-        print(f"Customer query error: {e}")
-        customers_list = []
-    
-    customers_data = {
-        'data': customers_list,
-        'total': len(customers_list)
-    }
+        from listing import CUSTOMERS
+        customers_data = CUSTOMERS.page(request.args)
+    except Exception:
+        app.logger.exception("Customer query error")
+        customers_data = {'data': [], 'total': 0}
     
     return render_template('customers.html', 
                          customers=customers_data, 
-                         search='')
+                         search=request.args.get('search', ''))
 
 # Suppliers routes
 @app.route('/suppliers') 
+@query_budget(3)
 def suppliers():
     if not session.get('user_id'):
         return redirect(url_for('login'))
     
-    suppliers_list = []
-    # Simple, safe query without complex error handling
     try:
-        from models import Supplier
-        results = Supplier.query.all()
-        suppliers_list = [supplier for supplier in results if supplier.is_active]
-    except Exception as e:
-        print(f"Supplier query error: {e}")
-        suppliers_list = []
-    
-    suppliers_data = {
-        'data': suppliers_list,
-        'total': len(suppliers_list)
-    }
+        from listing import SUPPLIERS
+        suppliers_data = SUPPLIERS.page(request.args)
+    except Exception:
+        app.logger.exception("Supplier query error")
+        suppliers_data = {'data': [], 'total': 0}
     
     return render_template('suppliers.html', 
                          suppliers=suppliers_data, 
-                         search='')
+                         search=request.args.get('search', ''))
 
 # Sales routes
 @app.route('/sales')
+@query_budget(3)
 def sales():
     if not session.get('user_id'):
         return redirect(url_for('login'))
     
     try:
-        sales_list = []
-        try:
-            from models import Sale
-            sales_query = Sale.query
-            sales_list = list(sales_query.all())
-        except Exception as sales_error:
-            print(f"Sales query error: {sales_error}")
-        
-        sales_data = {
-            'data': sales_list,
-            'total': len(sales_list)
-        }
+        from listing import SALES
+        sales_data = SALES.page(request.args)
         
         return render_template('sales.html', sales=sales_data)
     except Exception as e:
-        print(f"Sales route error: {e}")
+        app.logger.exception("Sales route error")
         flash(f'Erro ao carregar vendas: {str(e)}', 'error')
         return redirect(url_for('dashboard'))
 
 # Purchases routes  
 @app.route('/purchases')
+@query_budget(3)
 def purchases():
     if not session.get('user_id'):
         return redirect(url_for('login'))
     
     try:
-        purchases_list = []
-        try:
-            from models import Purchase
-            purchases_query = Purchase.query
-            purchases_list = list(purchases_query.all())
-        except Exception as purch_error:
-            print(f"Purchase query error: {purch_error}")
-        
-        purchases_data = {
-            'data': purchases_list,
-            'total': len(purchases_list)
-        }
+        from listing import PURCHASES
+        purchases_data = PURCHASES.page(request.args)
         
         return render_template('purchases.html', purchases=purchases_data)
     except Exception as e:
-        print(f"Purchases route error: {e}")
+        app.logger.exception("Purchases route error")
         flash(f'Erro ao carregar compras: {str(e)}', 'error')
         return redirect(url_for('dashboard'))
 
 # Inventory routes
 @app.route('/inventory')
+@query_budget(3)
 def inventory():
     if not session.get('user_id'):
         return redirect(url_for('login'))
     
     try:
-        inventory_list = []
-        try:
-            from models import InventoryMovement
-            inventory_query = InventoryMovement.query
-            inventory_list = list(inventory_query.all())
-        except Exception as inv_error:
-            print(f"Inventory query error: {inv_error}")
-        
-        inventory_data = {
-            'data': inventory_list,
-            'total': len(inventory_list)
-        }
+        from listing import INVENTORY
+        inventory_data = INVENTORY.page(request.args)
         
         return render_template('inventory.html', inventory=inventory_data)
     except Exception as e:
-        print(f"Inventory route error: {e}")
+        app.logger.exception("Inventory route error")
         flash(f'Erro ao carregar inventário: {str(e)}', 'error')
         return redirect(url_for('dashboard'))
 
-# Reports routes
-@app.route('/reports')
-def reports():
+@app.route('/replenishment')
+def replenishment():
+    if not session.get('user_id'):
+        return redirect(url_for('login'))
+    
+    try:
+        from sqlalchemy import func
+        from models import ReplenishmentSuggestion
+        from replenishment import DEMAND_DAYS, suggestions_by_supplier
+        
+        groups = suggestions_by_supplier()
+        computed_at = db.session.query(func.max(ReplenishmentSuggestion.computed_at)).scalar()
+        return render_template('replenishment.html',
+                               groups=groups,
+                               computed_at=computed_at,
+                               demand_days=DEMAND_DAYS,
+                               products_count=sum(len(items) for _, items in groups))
+    except Exception as e:
+        app.logger.exception("Replenishment error")
+        flash(f'Erro ao carregar as sugestões de encomenda: {str(e)}', 'error')
+        return redirect(url_for('inventory'))
+
+@app.route('/admin/classify-products', methods=['POST'])
+def admin_classify_products():
+    if not session.get('user_id') or session.get('user_role') != 'admin':
+        flash('Acesso negado.', 'error')
+        return redirect(url_for('login'))
+    
+    from jobs import enqueue
+    
+    try:
+        job = enqueue('classify_products', {}, session['user_id'])
+        flash('Classificação ABC/XYZ em fila.', 'success')
+        return redirect(url_for('job_status', id=job.id))
+    except Exception:
+        db.session.rollback()
+        app.logger.exception("Error queueing product classification")
+        flash('Erro ao colocar a tarefa em fila.', 'error')
+        return redirect(url_for('products'))
+
+@app.route('/admin/replenishment', methods=['POST'])
+def admin_replenishment():
+    if not session.get('user_id') or session.get('user_role') != 'admin':
+        flash('Acesso negado.', 'error')
+        return redirect(url_for('login'))
+    
+    from jobs import enqueue
+    
+    try:
+        job = enqueue('replenishment', {}, session['user_id'])
+        flash('Cálculo das sugestões de encomenda em fila.', 'success')
+        return redirect(url_for('job_status', id=job.id))
+    except Exception:
+        db.session.rollback()
+        app.logger.exception("Error queueing replenishment")
+        flash('Erro ao colocar a tarefa em fila.', 'error')
+        return redirect(url_for('replenishment'))
+
+@app.route('/inventory/valuation')
+def inventory_valuation():
     if not session.get('user_id'):
         return redirect(url_for('login'))
     
-    from models import Sale, Purchase, Product, Customer, Supplier, SaleItem, PurchaseItem
+    try:
+        from datetime import timedelta
+        from ledger import latest_snapshot, valuation_by_category
+        
+        # Stock at the end of the chosen day (default: now), from the stock ledger
+        day = request.args.get('day', '')
+        try:
+            at = datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1) if day else datetime.now()
+        except ValueError:
+            flash('Data inválida.', 'error')
+            return redirect(url_for('inventory_valuation'))
+        
+        categories = valuation_by_category(at)
+        return render_template('inventory_valuation.html',
+                               day=day,
+                               categories=categories,
+                               snapshot=latest_snapshot(at),
+                               total_units=sum(row[2] or 0 for row in categories),
+                               total_value=sum(row[3] or 0 for row in categories))
+    except Exception as e:
+        app.logger.exception("Inventory valuation error")
+        flash(f'Erro ao calcular a valorização do stock: {str(e)}', 'error')
+        return redirect(url_for('inventory'))
+
+# Reports routes
+REPORT_SYNC_MAX_DAYS = 90
+
+def report_context(period_days):
+    """Template variables of reports.html for the last ``period_days`` days"""
+    from models import Sale, Purchase, Product, Customer, Supplier, SaleItem
     from datetime import datetime, timedelta
     from sqlalchemy import func, desc
+    from sqlalchemy.orm import joinedload, selectinload
+    from rollups import SALES, PURCHASES, totals, daily_totals
+    from costing import cost_of_sales
+    
+    start_date = datetime.now() - timedelta(days=period_days)
+    
+    # Totals come from the daily rollups
+    sales_totals = totals(SALES, start=start_date.date())
+    purchases_totals = totals(PURCHASES, start=start_date.date())
+    # Gross profit is net revenue minus the cost of the goods sold
+    net_sales, sales_cost = cost_of_sales(start=start_date)
+    
+    # Recent documents
+    recent_sales = Sale.query.filter(Sale.sale_date >= start_date).options(
+        joinedload(Sale.customer)
+    ).order_by(desc(Sale.sale_date)).limit(20).all()
+    recent_purchases = Purchase.query.filter(Purchase.purchase_date >= start_date).options(
+        joinedload(Purchase.supplier)
+    ).order_by(desc(Purchase.purchase_date)).limit(20).all()
+    
+    # Products data with sales performance
+    products_with_stats = db.session.query(
+        Product,
+        func.coalesce(func.sum(SaleItem.quantity), 0).label('sales_count'),
+        func.coalesce(func.sum(SaleItem.quantity * SaleItem.unit_price), 0).label('total_revenue')
+    ).outerjoin(SaleItem).outerjoin(Sale).filter(
+        func.coalesce(Sale.sale_date, datetime.now()) >= start_date
+    ).options(selectinload(Product.category)).group_by(Product.id).order_by(desc('total_revenue')).limit(20).all()
+    
+    # Format products data
+    top_products = []
+    for product, sales_count, total_revenue in products_with_stats:
+        product.sales_count = sales_count
+        product.total_revenue = total_revenue
+        top_products.append(product)
+    
+    # Financial chart data (last 7 days)
+    financial_data = None
+    if period_days <= 30:
+        chart_days = min(period_days, 7)
+        days = [(datetime.now() - timedelta(days=chart_days - 1 - i)).date() for i in range(chart_days)]
+        day_sales = daily_totals(SALES, days[0])
+        day_purchases = daily_totals(PURCHASES, days[0])
+        
+        financial_data = {
+            'labels': [day.strftime('%d/%m') for day in days],
+            'sales': [day_sales.get(day.isoformat(), 0.0) for day in days],
+            'purchases': [day_purchases.get(day.isoformat(), 0.0) for day in days]
+        }
+    
+    return dict(recent_sales=recent_sales,
+                recent_purchases=recent_purchases,
+                top_products=top_products,
+                total_sales=sales_totals['total_amount'],
+                total_purchases=purchases_totals['total_amount'],
+                net_sales=float(net_sales),
+                cost_of_sales=float(sales_cost),
+                gross_profit=float(net_sales - sales_cost),
+                sales_count=sales_totals['count'],
+                purchases_count=purchases_totals['count'],
+                products_count=Product.query.count(),
+                low_stock_count=Product.query.filter(
+                    Product.stock_quantity <= Product.min_stock
+                ).count(),
+                customers_count=Customer.query.count(),
+                suppliers_count=Supplier.query.count(),
+                # Tax calculations
+                total_tax=sales_totals['tax_amount'] - purchases_totals['tax_amount'],
+                financial_data=financial_data)
+
+@app.route('/reports')
+# 13: the cost of sales (costing.cost_of_sales) is one aggregate over the
+# sale lines on top of the rollup reads; it is not part of the daily rollups
+@query_budget(13)
+def reports():
+    if not session.get('user_id'):
+        return redirect(url_for('login'))
     
     try:
         # Get period filter (default 30 days)
         period_days = int(request.args.get('period', 30))
-        start_date = datetime.now() - timedelta(days=period_days)
-        
-        # Sales data
-        sales_query = Sale.query.filter(Sale.sale_date >= start_date)
-        recent_sales = sales_query.order_by(desc(Sale.sale_date)).limit(20).all()
-        sales_count = sales_query.count()
-        total_sales = sales_query.with_entities(func.sum(Sale.total_amount)).scalar() or 0
-        
-        # Purchases data
-        purchases_query = Purchase.query.filter(Purchase.purchase_date >= start_date)
-        recent_purchases = purchases_query.order_by(desc(Purchase.purchase_date)).limit(20).all()
-        purchases_count = purchases_query.count()
-        total_purchases = purchases_query.with_entities(func.sum(Purchase.total_amount)).scalar() or 0
-        
-        # Products data with sales performance
-        products_with_stats = db.session.query(
-            Product,
-            func.coalesce(func.sum(SaleItem.quantity), 0).label('sales_count'),
-            func.coalesce(func.sum(SaleItem.quantity * SaleItem.unit_price), 0).label('total_revenue')
-        ).outerjoin(SaleItem).outerjoin(Sale).filter(
-            func.coalesce(Sale.sale_date, datetime.now()) >= start_date
-        ).group_by(Product.id).order_by(desc('total_revenue')).limit(20).all()
-        
-        # Format products data
-        top_products = []
-        for product, sales_count, total_revenue in products_with_stats:
-            product.sales_count = sales_count
-            product.total_revenue = total_revenue
-            top_products.append(product)
-        
-        # General stats
-        products_count = Product.query.count()
-        low_stock_count = Product.query.filter(
-            Product.stock_quantity <= Product.min_stock
-        ).count()
-        customers_count = Customer.query.count()
-        suppliers_count = Supplier.query.count()
-        
-        # Tax calculations
-        total_tax = (sales_query.with_entities(func.sum(Sale.tax_amount)).scalar() or 0) - \
-                   (purchases_query.with_entities(func.sum(Purchase.tax_amount)).scalar() or 0)
-        
-        # Financial chart data (last 7 days)
-        financial_data = None
-        if period_days <= 30:
-            chart_days = min(period_days, 7)
-            labels = []
-            sales_data = []
-            purchases_data = []
-            
-            for i in range(chart_days):
-                day = datetime.now() - timedelta(days=chart_days - 1 - i)
-                labels.append(day.strftime('%d/%m'))
-                
-                day_sales = Sale.query.filter(
-                    func.date(Sale.sale_date) == day.date()
-                ).with_entities(func.sum(Sale.total_amount)).scalar() or 0
-                
-                day_purchases = Purchase.query.filter(
-                    func.date(Purchase.purchase_date) == day.date()
-                ).with_entities(func.sum(Purchase.total_amount)).scalar() or 0
-                
-                sales_data.append(float(day_sales))
-                purchases_data.append(float(day_purchases))
-            
-            financial_data = {
-                'labels': labels,
-                'sales': sales_data,
-                'purchases': purchases_data
-            }
-        
-        return render_template('reports.html',
-                             recent_sales=recent_sales,
-                             recent_purchases=recent_purchases,
-                             top_products=top_products,
-                             total_sales=total_sales,
-                             total_purchases=total_purchases,
-                             sales_count=sales_count,
-                             purchases_count=purchases_count,
-                             products_count=products_count,
-                             low_stock_count=low_stock_count,
-                             customers_count=customers_count,
-                             suppliers_count=suppliers_count,
-                             total_tax=total_tax,
-                             financial_data=financial_data)
+        
+        # Long periods are rendered by the job worker instead of this request
+        if period_days > app.config.get('REPORT_SYNC_MAX_DAYS', REPORT_SYNC_MAX_DAYS):
+            from jobs import enqueue
+            job = enqueue('report', {'period': period_days}, session['user_id'])
+            flash(f'Relatório de {period_days} dias em preparação.', 'success')
+            return redirect(url_for('job_status', id=job.id))
+        
+        return render_template('reports.html', **report_context(period_days))
     
-    except Exception as e:
-        print(f"Error generating reports: {e}")
+    except Exception:
+        app.logger.exception("Error generating reports")
         flash('Erro ao gerar relatórios.', 'error')
         return redirect(url_for('dashboard'))
 
-# Analytics routes  
-# Analytics route moved to routes.py to avoid duplication
-
 @app.context_processor
 def inject_user():
     return dict(
@@ -947,7 +867,7 @@ def add_product():
                 purchase_price=float(request.form.get('purchase_price') or 0),
                 sale_price=float(request.form.get('sale_price') or 0),
                 tax_rate=float(request.form.get('tax_rate') or 23),
-                stock_quantity=int(request.form.get('stock_quantity') or 0),
+                stock_quantity=0,
                 min_stock=int(request.form.get('min_stock') or 0),
                 max_stock=int(request.form.get('max_stock') or 100),
                 is_active=True,
@@ -956,6 +876,9 @@ def add_product():
             )
             
             db.session.add(new_product)
+            db.session.flush()
+            # The opening stock goes through the stock ledger
+            open_stock(new_product.id, int(request.form.get('stock_quantity') or 0), session['user_id'])
             db.session.commit()
             
             flash('Produto adicionado com sucesso!', 'success')
@@ -963,16 +886,15 @@ def add_product():
             
         except Exception as e:
             db.session.rollback()
-            print(f"Error adding product: {e}")
+            app.logger.exception("Error adding product")
             flash(f'Erro ao adicionar produto: {str(e)}', 'error')
     
     # Get categories for dropdown
     categories = []
     try:
-        from models import Category
-        categories = Category.query.all()
-    except Exception as e:
-        print(f"Error loading categories: {e}")
+        categories = active_categories()
+    except Exception:
+        app.logger.exception("Error loading categories")
     
     return render_template('forms/add_product.html', categories=categories)
 
@@ -1009,7 +931,7 @@ def add_customer():
             
         except Exception as e:
             db.session.rollback()
-            print(f"Error adding customer: {e}")
+            app.logger.exception("Error adding customer")
             flash(f'Erro ao adicionar cliente: {str(e)}', 'error')
     
     return render_template('forms/add_customer.html')
@@ -1047,7 +969,7 @@ def add_supplier():
             
         except Exception as e:
             db.session.rollback()
-            print(f"Error adding supplier: {e}")
+            app.logger.exception("Error adding supplier")
             flash(f'Erro ao adicionar fornecedor: {str(e)}', 'error')
     
     return render_template('forms/add_supplier.html')
@@ -1060,10 +982,7 @@ def add_sale():
     
     if request.method == 'POST':
         try:
-            from models import Sale, SaleItem, Product, InventoryMovement
-            
-            # Generate unique invoice number
-            invoice_number = f"VEN{datetime.now().strftime('%Y%m%d')}{secrets.token_hex(3).upper()}"
+            from models import Sale, SaleItem
             
             # Parse dates
             sale_date_str = request.form.get('sale_date')
@@ -1072,6 +991,14 @@ def add_sale():
             sale_date = datetime.strptime(sale_date_str, '%Y-%m-%d').date() if sale_date_str else datetime.now().date()
             due_date = datetime.strptime(due_date_str, '%Y-%m-%d').date() if due_date_str else None
             
+            # Price the lines server-side; amounts posted by the browser are ignored
+            document = price_document(lines_from_form(request.form))
+            if not document.lines:
+                raise ValueError('Adicione pelo menos um produto.')
+            
+            # Next number of this terminal's series, released again if the sale rolls back
+            invoice_number = next_number(SALE, current_terminal(), sale_date)
+            
             # Create sale
             new_sale = Sale(
                 invoice_number=invoice_number,
@@ -1079,9 +1006,9 @@ def add_sale():
                 user_id=session['user_id'],
                 sale_date=sale_date,
                 due_date=due_date,
-                subtotal=float(request.form.get('subtotal', 0)),
-                tax_amount=float(request.form.get('tax_amount', 0)),
-                total_amount=float(request.form.get('total_amount', 0)),
+                subtotal=document.subtotal,
+                tax_amount=document.tax_amount,
+                total_amount=document.total_amount,
                 status='concluida',
                 payment_method=request.form.get('payment_method', 'multibanco'),
                 notes=request.form.get('notes', ''),
@@ -1092,86 +1019,46 @@ def add_sale():
             db.session.add(new_sale)
             db.session.flush()  # Get the sale ID
             
-            # Process sale items
-            products_data = {}
-            for key, value in request.form.items():
-                if key.startswith('products[') and key.endswith(']'):
-                    # Parse products[0][id], products[0][price], etc.
-                    import re
-                    match = re.match(r'products\[(\d+)\]\[(\w+)\]', key)
-                    if match:
-                        index, field = match.groups()
-                        if index not in products_data:
-                            products_data[index] = {}
-                        products_data[index][field] = value
-            
-            # Create sale items and update inventory
-            for product_data in products_data.values():
-                if not all(k in product_data for k in ['id', 'price', 'quantity', 'tax_rate']):
-                    continue
-                    
-                product_id = int(product_data['id'])
-                quantity = int(product_data['quantity'])
-                unit_price = float(product_data['price'])
-                tax_rate = float(product_data['tax_rate'])
-                
-                # Calculate totals
-                subtotal = quantity * unit_price
-                tax_amount = subtotal * (tax_rate / 100)
-                total_price = subtotal + tax_amount
-                
-                # Create sale item
-                sale_item = SaleItem(
+            sale_items = [
+                SaleItem(
                     sale_id=new_sale.id,
-                    product_id=product_id,
-                    quantity=quantity,
-                    unit_price=unit_price,
-                    tax_rate=tax_rate,
-                    total_price=total_price
+                    product_id=line.product_id,
+                    quantity=line.quantity,
+                    unit_price=line.unit_price,
+                    tax_rate=line.tax_rate,
+                    total_price=line.total
                 )
-                db.session.add(sale_item)
-                
-                # Update product stock
-                product = Product.query.get(product_id)
-                if product:
-                    product.stock_quantity = max(0, product.stock_quantity - quantity)
-                    product.updated_at = datetime.now()
-                    
-                    # Create inventory movement
-                    movement = InventoryMovement(
-                        product_id=product_id,
-                        movement_type='saida',
-                        quantity=-quantity,
-                        reference_type='venda',
-                        reference_id=new_sale.id,
-                        notes=f'Venda {invoice_number}',
-                        user_id=session['user_id'],
-                        created_at=datetime.now()
-                    )
-                    db.session.add(movement)
+                for line in document.lines
+            ]
+            
+            # Lock the products, reject oversell, update stock and add items/movements
+            from stock import post_sale
+            post_sale(new_sale, sale_items, session['user_id'])
+            
+            from rollups import record_sale
+            record_sale(new_sale, sale_items)
             
             db.session.commit()
+            sale_posted(new_sale)
             
             flash('Venda registada com sucesso!', 'success')
             return redirect(url_for('sales'))
             
+        except InsufficientStock as e:
+            db.session.rollback()
+            flash(str(e), 'warning')
         except Exception as e:
             db.session.rollback()
-            print(f"Error adding sale: {e}")
+            app.logger.exception("Error adding sale")
             flash(f'Erro ao registar venda: {str(e)}', 'error')
     
     # GET request - load form data
     try:
-        from models import Customer, Product
-        customers = Customer.query.filter_by(is_active=True).all()
-        products = Product.query.filter_by(is_active=True).filter(Product.stock_quantity > 0).all()
-        
+        # Customers and products are loaded by the page from /api/catalogue
         return render_template('forms/advanced_sale.html', 
-                             customers=customers, 
-                             products=products,
                              today=datetime.now().strftime('%Y-%m-%d'))
-    except Exception as e:
-        print(f"Error loading form data: {e}")
+    except Exception:
+        app.logger.exception("Error loading form data")
         flash('Erro ao carregar dados do formulário.', 'error')
         return redirect(url_for('sales'))
 
@@ -1183,10 +1070,7 @@ def add_purchase():
     
     if request.method == 'POST':
         try:
-            from models import Purchase
-            
-            # Generate unique invoice number
-            invoice_number = f"COM{datetime.now().strftime('%Y%m%d')}{secrets.token_hex(3).upper()}"
+            from models import Purchase, PurchaseItem
             
             # Safely parse dates
             purchase_date_str = request.form.get('purchase_date')
@@ -1195,15 +1079,23 @@ def add_purchase():
             purchase_date = datetime.strptime(purchase_date_str, '%Y-%m-%d').date() if purchase_date_str else datetime.now().date()
             due_date = datetime.strptime(due_date_str, '%Y-%m-%d').date() if due_date_str else None
             
+            # Price the lines server-side; amounts posted by the browser are ignored
+            document = price_document(lines_from_form(request.form))
+            if not document.lines:
+                raise ValueError('Adicione pelo menos um produto.')
+            
+            # Next number of this terminal's series, released again if the purchase rolls back
+            invoice_number = next_number(PURCHASE, current_terminal(), purchase_date)
+            
             new_purchase = Purchase(
                 invoice_number=invoice_number,
                 supplier_id=int(request.form.get('supplier_id') or 1),
                 user_id=session['user_id'],
                 purchase_date=purchase_date,
                 due_date=due_date,
-                subtotal=float(request.form.get('subtotal') or 0),
-                tax_amount=float(request.form.get('tax_amount') or 0),
-                total_amount=float(request.form.get('total_amount') or 0),
+                subtotal=document.subtotal,
+                tax_amount=document.tax_amount,
+                total_amount=document.total_amount,
                 status=request.form.get('status', 'concluida'),
                 payment_method=request.form.get('payment_method', 'transferencia'),
                 notes=request.form.get('notes', ''),
@@ -1214,66 +1106,24 @@ def add_purchase():
             db.session.add(new_purchase)
             db.session.flush()  # Get purchase ID
             
-            # Process products from form
-            products_data = {}
-            for key, value in request.form.items():
-                if key.startswith('products['):
-                    # Parse products[0][id], products[0][price], etc.
-                    import re
-                    match = re.match(r'products\[(\d+)\]\[(\w+)\]', key)
-                    if match:
-                        index, field = match.groups()
-                        if index not in products_data:
-                            products_data[index] = {}
-                        products_data[index][field] = value
-            
-            # Create purchase items and update inventory
-            for product_data in products_data.values():
-                if not all(k in product_data for k in ['id', 'price', 'quantity', 'tax_rate']):
-                    continue
-                    
-                product_id = int(product_data['id'])
-                quantity = int(product_data['quantity'])
-                unit_price = float(product_data['price'])
-                tax_rate = float(product_data['tax_rate'])
-                
-                # Calculate totals
-                subtotal = quantity * unit_price
-                tax_amount = subtotal * (tax_rate / 100)
-                total_price = subtotal + tax_amount
-                
-                # Create purchase item
-                from models import PurchaseItem
-                purchase_item = PurchaseItem(
+            purchase_items = [
+                PurchaseItem(
                     purchase_id=new_purchase.id,
-                    product_id=product_id,
-                    quantity=quantity,
-                    unit_price=unit_price,
-                    tax_rate=tax_rate,
-                    total_price=total_price
+                    product_id=line.product_id,
+                    quantity=line.quantity,
+                    unit_price=line.unit_price,
+                    tax_rate=line.tax_rate,
+                    total_price=line.total
                 )
-                db.session.add(purchase_item)
-                
-                # Update product stock (increase for purchase)
-                from models import Product
-                product = Product.query.get(product_id)
-                if product:
-                    product.stock_quantity += quantity
-                    product.updated_at = datetime.now()
-                    
-                    # Create inventory movement
-                    from models import InventoryMovement
-                    movement = InventoryMovement(
-                        product_id=product_id,
-                        movement_type='entrada',
-                        quantity=quantity,
-                        reference_type='compra',
-                        reference_id=new_purchase.id,
-                        notes=f'Compra {invoice_number}',
-                        user_id=session['user_id'],
-                        created_at=datetime.now()
-                    )
-                    db.session.add(movement)
+                for line in document.lines
+            ]
+            
+            # Lock the products, increase stock and add items/movements
+            from stock import post_purchase
+            post_purchase(new_purchase, purchase_items, session['user_id'])
+            
+            from rollups import record_purchase
+            record_purchase(new_purchase, purchase_items)
             
             db.session.commit()
             
@@ -1282,29 +1132,67 @@ def add_purchase():
             
         except Exception as e:
             db.session.rollback()
-            print(f"Error adding purchase: {e}")
+            app.logger.exception("Error adding purchase")
             flash(f'Erro ao registar compra: {str(e)}', 'error')
     
-    # Get suppliers for dropdown
-    suppliers = []
+    # Suppliers and products are loaded by the page from /api/catalogue
+    return render_template('forms/advanced_purchase.html', 
+                         today=datetime.now().strftime('%Y-%m-%d'))
+
+# Draft purchase orders from the replenishment needs
+@app.route('/purchases/drafts', methods=['GET', 'POST'])
+def purchase_drafts():
+    if not session.get('user_id'):
+        return redirect(url_for('login'))
+    
+    from purchase_orders import create_drafts, preview
+    
+    if request.method == 'POST':
+        supplier_ids = [int(value) for value in request.form.getlist('supplier_ids') if value.isdigit()]
+        if not supplier_ids:
+            flash('Selecione pelo menos um fornecedor.', 'warning')
+            return redirect(url_for('purchase_drafts'))
+        
+        created, errors = create_drafts(supplier_ids, session['user_id'], current_terminal())
+        if created:
+            flash(f'{len(created)} encomendas em rascunho criadas.', 'success')
+        elif not errors:
+            flash('Não há produtos a encomendar aos fornecedores selecionados.', 'info')
+        for supplier_id, message in errors:
+            flash(f'Erro na encomenda ao fornecedor #{supplier_id}: {message}', 'error')
+        return redirect(url_for('purchases', status='rascunho'))
+    
     try:
-        from models import Supplier
-        suppliers = Supplier.query.filter_by(is_active=True).all()
+        groups = preview()
+        return render_template('purchase_drafts.html',
+                               groups=groups,
+                               lines_count=sum(len(lines) for _, lines, _ in groups),
+                               total_amount=sum(totals['total_amount'] for _, _, totals in groups))
     except Exception as e:
-        print(f"Error loading suppliers: {e}")
+        app.logger.exception("Purchase drafts preview error")
+        flash(f'Erro ao preparar as encomendas: {str(e)}', 'error')
+        return redirect(url_for('purchases'))
+
+@app.route('/purchases/<int:id>/receive', methods=['POST'])
+def receive_purchase(id):
+    if not session.get('user_id'):
+        return redirect(url_for('login'))
     
-    # Get products for selection
-    products = []
     try:
-        from models import Product
-        products = Product.query.filter_by(is_active=True).all()
+        from models import Purchase
+        from purchase_orders import receive
+        purchase = Purchase.query.get_or_404(id)
+        
+        receive(purchase, session['user_id'])
+        db.session.commit()
+        
+        flash(f'Encomenda {purchase.invoice_number} recebida e lançada em stock.', 'success')
     except Exception as e:
-        print(f"Error loading products: {e}")
+        db.session.rollback()
+        app.logger.exception("Error receiving purchase")
+        flash(f'Erro ao receber encomenda: {str(e)}', 'error')
     
-    return render_template('forms/advanced_purchase.html', 
-                         suppliers=suppliers, 
-                         products=products,
-                         today=datetime.now().strftime('%Y-%m-%d'))
+    return redirect(url_for('purchases'))
 
 # Add Inventory Movement
 @app.route('/inventory/add', methods=['GET', 'POST'])
@@ -1314,28 +1202,27 @@ def add_inventory():
     
     if request.method == 'POST':
         try:
-            from models import InventoryMovement
-            
-            new_movement = InventoryMovement(
+            # Updates the product's stock too, with the row locked (stock.py)
+            post_movement(
                 product_id=int(request.form.get('product_id') or 1),
                 movement_type=request.form.get('movement_type', 'entrada'),
                 quantity=int(request.form.get('quantity') or 0),
                 reference_type=request.form.get('reference_type', 'manual'),
                 reference_id=int(request.form.get('reference_id') or 0) if request.form.get('reference_id') else None,
                 notes=request.form.get('notes', ''),
-                user_id=session['user_id'],
-                created_at=datetime.now()
+                user_id=session['user_id']
             )
-            
-            db.session.add(new_movement)
             db.session.commit()
             
             flash('Movimento de inventário registado com sucesso!', 'success')
             return redirect(url_for('inventory'))
             
+        except InsufficientStock as e:
+            db.session.rollback()
+            flash(str(e), 'warning')
         except Exception as e:
             db.session.rollback()
-            print(f"Error adding inventory movement: {e}")
+            app.logger.exception("Error adding inventory movement")
             flash(f'Erro ao registar movimento: {str(e)}', 'error')
     
     # Get products for dropdown
@@ -1343,8 +1230,8 @@ def add_inventory():
     try:
         from models import Product
         products = Product.query.all()
-    except Exception as e:
-        print(f"Error loading products: {e}")
+    except Exception:
+        app.logger.exception("Error loading products")
     
     return render_template('forms/add_inventory.html', products=products)
 
@@ -1366,7 +1253,7 @@ def delete_product(id):
         flash('Produto eliminado com sucesso!', 'success')
     except Exception as e:
         db.session.rollback()
-        print(f"Error deleting product: {e}")
+        app.logger.exception("Error deleting product")
         flash(f'Erro ao eliminar produto: {str(e)}', 'error')
     
     return redirect(url_for('products'))
@@ -1387,7 +1274,7 @@ def delete_customer(id):
         flash('Cliente eliminado com sucesso!', 'success')
     except Exception as e:
         db.session.rollback()
-        print(f"Error deleting customer: {e}")
+        app.logger.exception("Error deleting customer")
         flash(f'Erro ao eliminar cliente: {str(e)}', 'error')
     
     return redirect(url_for('customers'))
@@ -1408,71 +1295,102 @@ def delete_supplier(id):
         flash('Fornecedor eliminado com sucesso!', 'success')
     except Exception as e:
         db.session.rollback()
-        print(f"Error deleting supplier: {e}")
+        app.logger.exception("Error deleting supplier")
         flash(f'Erro ao eliminar fornecedor: {str(e)}', 'error')
     
     return redirect(url_for('suppliers'))
 
-# Delete Sale
-@app.route('/sales/delete/<int:id>')
-def delete_sale(id):
+# Cancel Sale
+# Numbered invoices are never deleted, so the series stays gap-free (numbering.py)
+@app.route('/sales/<int:id>/cancel', methods=['POST'])
+def cancel_sale(id):
     if not session.get('user_id'):
         return redirect(url_for('login'))
     
     try:
         from models import Sale
-        sale = Sale.query.get_or_404(id)
-        
-        db.session.delete(sale)
+        from rollups import record_sale
+        from stock import return_sale
+        # Locked, so two clicks cannot both return the stock
+        sale = Sale.query.filter_by(id=id).with_for_update().populate_existing().first_or_404()
+        if sale.status == 'cancelado':
+            raise ValueError(f'A venda {sale.invoice_number} já está anulada.')
+        
+        items = list(sale.items)
+        record_sale(sale, items, sign=-1)
+        sale.status = 'cancelado'
+        sale.updated_at = datetime.now()
+        return_sale(sale, items, session['user_id'])
         db.session.commit()
         
-        flash('Venda eliminada com sucesso!', 'success')
+        flash(f'Venda {sale.invoice_number} anulada com sucesso!', 'success')
+    except ValueError as e:
+        db.session.rollback()
+        flash(str(e), 'warning')
     except Exception as e:
         db.session.rollback()
-        print(f"Error deleting sale: {e}")
-        flash(f'Erro ao eliminar venda: {str(e)}', 'error')
+        app.logger.exception("Error cancelling sale")
+        flash(f'Erro ao anular venda: {str(e)}', 'error')
     
     return redirect(url_for('sales'))
 
-# Delete Purchase
-@app.route('/purchases/delete/<int:id>')
-def delete_purchase(id):
+# Cancel Purchase
+@app.route('/purchases/<int:id>/cancel', methods=['POST'])
+def cancel_purchase(id):
     if not session.get('user_id'):
         return redirect(url_for('login'))
     
     try:
         from models import Purchase
-        purchase = Purchase.query.get_or_404(id)
-        
-        db.session.delete(purchase)
+        from rollups import record_purchase
+        from stock import return_purchase
+        # Numbered documents are cancelled, never deleted, so the series keeps no gaps
+        purchase = Purchase.query.filter_by(id=id).with_for_update().populate_existing().first_or_404()
+        if purchase.status == 'cancelado':
+            raise ValueError(f'A compra {purchase.invoice_number} já está anulada.')
+        
+        items = list(purchase.items)
+        record_purchase(purchase, items, sign=-1)
+        received = purchase.status != 'rascunho'  # drafts never entered stock
+        purchase.status = 'cancelado'
+        purchase.updated_at = datetime.now()
+        if received:
+            return_purchase(purchase, items, session['user_id'])
         db.session.commit()
         
-        flash('Compra eliminada com sucesso!', 'success')
+        flash(f'Compra {purchase.invoice_number} anulada com sucesso!', 'success')
+    except ValueError as e:  # includes InsufficientStock
+        db.session.rollback()
+        flash(str(e), 'warning')
     except Exception as e:
         db.session.rollback()
-        print(f"Error deleting purchase: {e}")
-        flash(f'Erro ao eliminar compra: {str(e)}', 'error')
+        app.logger.exception('Error cancelling purchase %s', id)
+        flash(f'Erro ao anular compra: {str(e)}', 'error')
     
     return redirect(url_for('purchases'))
 
-# Delete Inventory Movement
-@app.route('/inventory/delete/<int:id>')
-def delete_inventory_movement(id):
+# Reverse Inventory Movement
+@app.route('/inventory/reverse/<int:id>', methods=['POST'])
+def reverse_inventory_movement(id):
     if not session.get('user_id'):
         return redirect(url_for('login'))
     
     try:
         from models import InventoryMovement
+        from stock import reverse_movement
         movement = InventoryMovement.query.get_or_404(id)
         
-        db.session.delete(movement)
+        reverse_movement(movement, session['user_id'])
         db.session.commit()
         
-        flash('Movimento de inventário eliminado com sucesso!', 'success')
+        flash('Movimento de inventário estornado com sucesso!', 'success')
+    except ValueError as e:  # includes InsufficientStock
+        db.session.rollback()
+        flash(str(e), 'warning')
     except Exception as e:
         db.session.rollback()
-        print(f"Error deleting inventory movement: {e}")
-        flash(f'Erro ao eliminar movimento: {str(e)}', 'error')
+        app.logger.exception("Error reversing inventory movement")
+        flash(f'Erro ao estornar movimento: {str(e)}', 'error')
     
     return redirect(url_for('inventory'))
 
@@ -1543,9 +1461,9 @@ def register():
                 flash('Registo realizado com sucesso! A sua conta foi ativada automaticamente. Pode fazer login agora.', 'success')
             return redirect(url_for('login'))
             
-        except Exception as e:
+        except Exception:
             db.session.rollback()
-            print(f"Error during registration: {e}")
+            app.logger.exception("Error during registration")
             flash('Erro durante o registo. Tente novamente.', 'error')
     
     return render_template('register.html')
@@ -1571,8 +1489,8 @@ def confirm_email(token):
         flash('Email confirmado com sucesso! Pode agora fazer login.', 'success')
         return render_template('email_confirmed.html')
         
-    except Exception as e:
-        print(f"Error confirming email: {e}")
+    except Exception:
+        app.logger.exception("Error confirming email")
         flash('Erro ao confirmar email. Tente novamente.', 'error')
         return redirect(url_for('login'))
 
@@ -1635,8 +1553,8 @@ def send_confirmation_email(email, full_name, token):
         print(f"Email sent successfully: {response.status_code}")
         return True
         
-    except Exception as e:
-        print(f"Error sending email: {e}")
+    except Exception:
+        app.logger.exception("Error sending email")
         return False
 
 # Admin routes for user management
@@ -1658,8 +1576,8 @@ def admin_activate_users():
         return render_template('admin_activate_users.html', 
                              pending_users=pending_users,
                              all_users=all_users)
-    except Exception as e:
-        print(f"Error loading users: {e}")
+    except Exception:
+        app.logger.exception("Error loading users")
         flash('Erro ao carregar utilizadores.', 'error')
         return redirect(url_for('dashboard'))
 
@@ -1680,13 +1598,76 @@ def admin_activate_user(id):
         db.session.commit()
         
         flash(f'Utilizador {user.username} ativado com sucesso!', 'success')
-    except Exception as e:
+    except Exception:
         db.session.rollback()
-        print(f"Error activating user: {e}")
+        app.logger.exception("Error activating user")
         flash('Erro ao ativar utilizador.', 'error')
     
     return redirect(url_for('admin_activate_users'))
 
+@app.route('/admin/rebuild-rollups', methods=['POST'])
+def admin_rebuild_rollups():
+    if not session.get('user_id') or session.get('user_role') != 'admin':
+        flash('Acesso negado.', 'error')
+        return redirect(url_for('login'))
+    
+    from jobs import enqueue
+    
+    try:
+        job = enqueue('rebuild_rollups', {}, session['user_id'])
+        flash('Reconstrução dos resumos diários em fila.', 'success')
+        return redirect(url_for('job_status', id=job.id))
+    except Exception:
+        db.session.rollback()
+        app.logger.exception("Error queueing rollup rebuild")
+        flash('Erro ao colocar a tarefa em fila.', 'error')
+        return redirect(url_for('jobs'))
+
+@app.route('/admin/rebuild-costs', methods=['POST'])
+def admin_rebuild_costs():
+    if not session.get('user_id') or session.get('user_role') != 'admin':
+        flash('Acesso negado.', 'error')
+        return redirect(url_for('login'))
+    
+    from jobs import enqueue
+    
+    try:
+        job = enqueue('rebuild_costs', {}, session['user_id'])
+        flash('Recálculo de custos em fila.', 'success')
+        return redirect(url_for('job_status', id=job.id))
+    except Exception:
+        db.session.rollback()
+        app.logger.exception("Error queueing cost rebuild")
+        flash('Erro ao colocar a tarefa em fila.', 'error')
+        return redirect(url_for('jobs'))
+
+@app.route('/admin/reconcile-stock', methods=['POST'])
+def admin_reconcile_stock():
+    if not session.get('user_id') or session.get('user_role') != 'admin':
+        flash('Acesso negado.', 'error')
+        return redirect(url_for('login'))
+    
+    from jobs import enqueue
+    
+    try:
+        job = enqueue('reconcile_stock', {'fix': bool(request.form.get('fix'))}, session['user_id'])
+        flash('Reconciliação de stock em fila.', 'success')
+        return redirect(url_for('job_status', id=job.id))
+    except Exception:
+        db.session.rollback()
+        app.logger.exception("Error queueing stock reconciliation")
+        flash('Erro ao colocar a tarefa em fila.', 'error')
+        return redirect(url_for('inventory'))
+
+@app.route('/admin/cache')
+def admin_cache_stats():
+    if not session.get('user_id') or session.get('user_role') != 'admin':
+        flash('Acesso negado.', 'error')
+        return redirect(url_for('login'))
+    
+    # Stats of the worker that answers; /metrics has them for all workers
+    return cache.stats()
+
 @app.route('/admin/delete-user/<int:id>')
 def delete_user(id):
     if not session.get('user_id') or session.get('user_role') != 'admin':
@@ -1703,9 +1684,9 @@ def delete_user(id):
         db.session.commit()
         
         flash(f'Utilizador {username} eliminado com sucesso!', 'success')
-    except Exception as e:
+    except Exception:
         db.session.rollback()
-        print(f"Error deleting user: {e}")
+        app.logger.exception("Error deleting user")
         flash('Erro ao eliminar utilizador.', 'error')
     
     return redirect(url_for('admin_activate_users'))
\ No newline at end of file
@@ -0,0 +1,94 @@
+// Client side of /api/catalogue (see catalogue.py).
+// Keeps the last copy of each catalogue in localStorage and only asks the
+// server for the rows changed since that version.
+const Catalogue = {
+    storageKey(name) {
+        return `gestvendas:catalogue:${name}`;
+    },
+
+    // Load a catalogue; resolves to an array of row objects
+    async load(name) {
+        const cached = this.read(name);
+        const url = cached ? `/api/catalogue/${name}?since=${encodeURIComponent(cached.version)}`
+                           : `/api/catalogue/${name}`;
+
+        const response = await fetch(url, {credentials: 'same-origin'});
+        if (response.status === 304 && cached) {
+            return Object.values(cached.rows);
+        }
+        if (!response.ok) {
+            throw new Error(`Catálogo ${name}: ${response.status}`);
+        }
+
+        const data = await response.json();
+        const rows = data.delta && cached ? cached.rows : {};
+        data.rows.forEach(values => {
+            const row = {};
+            data.columns.forEach((column, i) => row[column] = values[i]);
+            rows[row.id] = row;
+        });
+        data.removed.forEach(id => delete rows[id]);
+
+        // Deleted rows leave no trace in a delta: start over when the count is off
+        if (data.delta && Object.keys(rows).length !== data.count) {
+            localStorage.removeItem(this.storageKey(name));
+            return this.load(name);
+        }
+
+        this.write(name, {version: data.version, rows: rows});
+        return Object.values(rows);
+    },
+
+    read(name) {
+        try {
+            return JSON.parse(localStorage.getItem(this.storageKey(name)));
+        } catch (e) {
+            return null;
+        }
+    },
+
+    write(name, value) {
+        try {
+            localStorage.setItem(this.storageKey(name), JSON.stringify(value));
+        } catch (e) {
+            // Quota exceeded: the HTTP cache (ETag) still avoids most downloads
+            localStorage.removeItem(this.storageKey(name));
+        }
+    },
+
+    // Rows whose name or code contains the search term, at most `limit`
+    filter(rows, term, limit = 100) {
+        const needle = (term || '').trim().toLowerCase();
+        const matches = [];
+        for (const row of rows) {
+            if (!needle || (row.name || '').toLowerCase().includes(needle) ||
+                    (row.code || '').toLowerCase().includes(needle)) {
+                matches.push(row);
+                if (matches.length >= limit) break;
+            }
+        }
+        return matches;
+    },
+
+    // Fill a <select> with one option per row (name as label, contacts as data-*)
+    fillSelect(select, rows) {
+        const fragment = document.createDocumentFragment();
+        rows.sort((a, b) => (a.name || '').localeCompare(b.name || ''));
+        rows.forEach(row => {
+            const option = document.createElement('option');
+            option.value = row.id;
+            option.textContent = row.name;
+            option.dataset.email = row.email || '';
+            option.dataset.phone = row.phone || '';
+            option.dataset.city = row.city || '';
+            fragment.appendChild(option);
+        });
+        select.appendChild(fragment);
+    },
+
+    escape(value) {
+        const div = document.createElement('div');
+        div.textContent = value == null ? '' : String(value);
+        return div.innerHTML.replace(/"/g, '&quot;');
+    }
+};
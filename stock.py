@@ -0,0 +1,197 @@
+"""Stock postings for sales and purchases.
+
+``post_sale``/``post_purchase`` take the new document and its (unsaved) item
+objects and, in the caller's transaction:
+
+* lock every product on the document with one
+  ``SELECT ... WHERE id IN (...) ORDER BY id FOR UPDATE`` (id order, so two
+  tills posting the same products cannot deadlock),
+* reject the sale with ``InsufficientStock`` if any product would go below
+  zero, instead of clamping the stock,
+* apply the stock change to the locked rows and add the items and their
+  ``InventoryMovement`` rows in bulk (one multi-row INSERT per table on flush).
+
+Because the rows stay locked until the caller commits, concurrent postings
+of the same product are serialised and no stock update is lost. For the same
+reason each movement can record the product's stock right after it
+(``balance``), which makes ``inventory_movements`` a running-balance stock
+ledger (see ledger.py). The product's weighted-average cost is kept up to
+date under the same lock: receipts move it, and sale lines are costed at it
+(see costing.py). Every stock change must therefore come through here.
+That includes manual movements (``post_movement``) and the opening stock of
+a new product (``open_stock``). Movements are never deleted: a wrong manual
+movement is undone by an ``ajuste`` in the opposite direction
+(``reverse_movement``), and cancelling a document posts the opposite
+movements (``return_purchase``, ``return_sale``), so the ledger keeps both.
+"""
+from datetime import datetime
+
+from app import db
+from costing import issue, receive
+from models import InventoryMovement, Product
+
+DOCUMENT_REFERENCES = ('venda', 'compra')
+
+
+class InsufficientStock(ValueError):
+    """A sale asks for more units than a product has in stock"""
+
+    def __init__(self, shortages):
+        self.shortages = shortages
+        details = ', '.join(
+            f"{product.name} (disponível {product.stock_quantity}, pedido {requested})"
+            for product, requested in shortages
+        )
+        super().__init__(f"Stock insuficiente: {details}")
+
+
+def lock_products(product_ids):
+    """{id: Product} for ``product_ids``, row-locked until the transaction ends"""
+    if not product_ids:
+        return {}
+    products = Product.query.filter(Product.id.in_(sorted(product_ids))).order_by(
+        Product.id
+    ).with_for_update().populate_existing().all()
+
+    missing = set(product_ids) - {product.id for product in products}
+    if missing:
+        raise ValueError(f"Produto não encontrado: {', '.join(str(i) for i in sorted(missing))}")
+    return {product.id: product for product in products}
+
+
+def _quantities(items):
+    quantities = {}
+    for item in items:
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + int(item.quantity)
+    return quantities
+
+
+def _post(items, sign, movement_type, reference_type, reference_id, note, user_id, cost=None):
+    quantities = _quantities(items)
+    products = lock_products(quantities)
+
+    if sign < 0:
+        shortages = [
+            (products[product_id], quantity)
+            for product_id, quantity in quantities.items()
+            if (products[product_id].stock_quantity or 0) < quantity
+        ]
+        if shortages:
+            raise InsufficientStock(shortages)
+
+    now = datetime.now()
+    movements = []
+    for item in items:
+        product = products[item.product_id]
+        if sign > 0:
+            receive(product, int(item.quantity), cost(item) if cost else item.unit_price)
+        elif reference_type == 'venda':
+            issue(product, item)
+        product.stock_quantity = (product.stock_quantity or 0) + sign * int(item.quantity)
+        product.updated_at = now
+        movements.append(InventoryMovement(
+            product_id=item.product_id,
+            movement_type=movement_type,
+            quantity=sign * int(item.quantity),
+            balance=product.stock_quantity,
+            reference_type=reference_type,
+            reference_id=reference_id,
+            notes=note,
+            user_id=user_id,
+            created_at=now
+        ))
+
+    db.session.add_all(items)
+    db.session.add_all(movements)
+    return products
+
+
+def post_sale(sale, items, user_id):
+    """Take the sale's items out of stock (raises ``InsufficientStock``)"""
+    return _post(items, -1, 'saida', 'venda', sale.id, f'Venda {sale.invoice_number}', user_id)
+
+
+def post_purchase(purchase, items, user_id):
+    """Put the purchase's items into stock"""
+    return _post(items, 1, 'entrada', 'compra', purchase.id, f'Compra {purchase.invoice_number}', user_id)
+
+
+def return_sale(sale, items, user_id):
+    """Put the items of a cancelled sale back into stock, at the cost they left at"""
+    return _post(items, 1, 'entrada', 'venda', sale.id, f'Anulação da venda {sale.invoice_number}', user_id,
+                 cost=lambda item: item.unit_cost)
+
+
+def return_purchase(purchase, items, user_id):
+    """Take the items of a cancelled purchase back out of stock (raises ``InsufficientStock``)
+
+    Like any issue other than a sale, this leaves the average cost alone.
+    """
+    return _post(items, -1, 'saida', 'compra', purchase.id, f'Anulação da compra {purchase.invoice_number}', user_id)
+
+
+def post_movement(product_id, movement_type, quantity, user_id, reference_type='manual',
+                  reference_id=None, notes=''):
+    """Record a manual movement and apply it to the stock
+
+    ``entrada`` adds ``quantity`` units and ``saida`` removes them (raises
+    ``InsufficientStock`` below zero). ``ajuste`` is a signed correction.
+    """
+    quantity = int(quantity)
+    if movement_type == 'entrada':
+        change = abs(quantity)
+    elif movement_type == 'saida':
+        change = -abs(quantity)
+    elif movement_type == 'ajuste':
+        change = quantity
+    else:
+        raise ValueError(f"Tipo de movimento desconhecido: {movement_type}")
+
+    product = lock_products([product_id])[product_id]
+    if (product.stock_quantity or 0) + change < 0 and movement_type == 'saida':
+        raise InsufficientStock([(product, -change)])
+
+    if change > 0:
+        receive(product, change)
+    now = datetime.now()
+    product.stock_quantity = (product.stock_quantity or 0) + change
+    product.updated_at = now
+    movement = InventoryMovement(
+        product_id=product_id,
+        movement_type=movement_type,
+        quantity=change,
+        balance=product.stock_quantity,
+        reference_type=reference_type,
+        reference_id=reference_id,
+        notes=notes,
+        user_id=user_id,
+        created_at=now
+    )
+    db.session.add(movement)
+    return movement
+
+
+def reverse_movement(movement, user_id):
+    """Undo a manual movement with an opposite ``ajuste`` (reference ``estorno``)
+
+    Movements of a sale or purchase are undone by cancelling the document.
+    Raises ``InsufficientStock`` if the stock would go below zero.
+    """
+    if movement.reference_type in DOCUMENT_REFERENCES:
+        raise ValueError('Este movimento pertence a um documento; anule o documento.')
+    if movement.reference_type == 'estorno' or InventoryMovement.query.filter_by(
+            reference_type='estorno', reference_id=movement.id).first():
+        raise ValueError(f'O movimento #{movement.id} já foi estornado.')
+
+    product = lock_products([movement.product_id])[movement.product_id]
+    if (product.stock_quantity or 0) - movement.quantity < 0:
+        raise InsufficientStock([(product, movement.quantity)])
+    return post_movement(movement.product_id, 'ajuste', -movement.quantity, user_id, reference_type='estorno',
+                         reference_id=movement.id, notes=f'Estorno do movimento #{movement.id}')
+
+
+def open_stock(product_id, quantity, user_id):
+    """Opening stock of a new product, flushed with zero stock"""
+    if quantity:
+        return post_movement(product_id, 'ajuste', quantity, user_id, reference_type='inicial',
+                             notes='Stock inicial')
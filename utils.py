@@ -1,7 +1,3 @@
-from datetime import datetime
-import secrets
-import string
-
 def format_currency(amount, currency_symbol='€'):
     """Format amount as currency with Euro symbol"""
     if amount is None:
@@ -9,28 +5,22 @@ def format_currency(amount, currency_symbol='€'):
     return f"{amount:,.2f} {currency_symbol}".replace(',', ' ').replace('.', ',').replace(' ', '.')
 
 def generate_invoice_number(prefix='V'):
-    """Generate unique invoice number with prefix"""
-    year = datetime.now().year
-    timestamp = datetime.now().strftime('%m%d%H%M%S')
-    random_part = ''.join(secrets.choice(string.digits) for _ in range(3))
-    return f"{prefix}{year}{timestamp}{random_part}"
+    """Allocate the next sale (V) or purchase (C) number of the default series"""
+    from numbering import PURCHASE, SALE, next_number
+    return next_number(PURCHASE if prefix == 'C' else SALE)
 
 def calculate_totals(items):
-    """Calculate subtotal, tax and total for a list of items"""
-    subtotal = 0
-    tax_total = 0
-    
-    for item in items:
-        item_total = item['quantity'] * item['unit_price']
-        item_tax = item_total * (item.get('tax_rate', 23) / 100)
-        
-        subtotal += item_total
-        tax_total += item_tax
+    """Calculate subtotal, tax and total for a list of items (see pricing)"""
+    from pricing import price_document
     
+    document = price_document(
+        (item.get('product_id', 0), item['quantity'], item['unit_price'], item['tax_rate'])
+        for item in items
+    )
     return {
-        'subtotal': subtotal,
-        'tax_total': tax_total,
-        'total': subtotal + tax_total
+        'subtotal': document.subtotal,
+        'tax_total': document.tax_amount,
+        'total': document.total_amount
     }
 
 def get_stock_status_class(stock_quantity, min_stock, max_stock):
@@ -94,6 +84,9 @@ def pagination_info(pagination):
     start = (pagination.page - 1) * pagination.per_page + 1
     end = min(pagination.page * pagination.per_page, pagination.total)
     
+    if getattr(pagination, 'total_is_estimate', False):
+        return f"Mostrando {start} a {end} de cerca de {pagination.total} registos"
+    
     return f"Mostrando {start} a {end} de {pagination.total} registos"
 
 def safe_float(value, default=0.0):